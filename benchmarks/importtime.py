@@ -0,0 +1,129 @@
+# importtime.py
+"""Startup benchmark for the services.
+
+Cold start is on the critical path of every scheduled run, since the
+services scale to zero. For each service this imports the entry point
+(main.py) in a fresh interpreter with `python -X importtime`, then pings
+it with the Flask test client (GET /, or GET /metrics for the pipeline,
+whose / runs the pipeline), and reports:
+
+  import_ms: wall time of `import main`.
+  importtime_ms: cumulative import time of main from -X importtime.
+  slowest: the modules with the largest cumulative import time.
+  ping_imports: heavy modules (see HEAVY) imported by the ping, which
+    should be none.
+
+Usage (from the repository root):
+
+  python benchmarks/importtime.py
+  python benchmarks/importtime.py model --budget 300 --out startup.json
+
+With --budget (milliseconds), exits with status 1 if a service's import
+time exceeds it or its ping imports a heavy module. The services use
+the memory storage backend, so no cloud credentials are needed; a
+service whose dependencies aren't installed is reported as skipped.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# service -> (app directory, name of the Flask app in main.py, ping path)
+SERVICES = {
+  'model': ('model/app', 'app', '/'),
+  'data-pipeline': ('data-pipeline/app', 'app', '/metrics'),
+  'dashboard': ('dashboard/app', 'server', '/')
+}
+
+# top-level packages that must not be imported to answer a ping
+HEAVY = ('numpy', 'pandas', 'google', 'plotly', 'grpc', 'requests')
+
+# run in the service directory by the child interpreter
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+import_ms = 1000 * (time.perf_counter() - start)
+before = set(sys.modules)
+status = getattr(main, {app!r}).test_client().get({path!r}).status_code
+imported = sorted(name for name in set(sys.modules) - before if '.' not in name)
+print(json.dumps({{'import_ms': import_ms, 'ping_status': status, 'ping_new_modules': imported}}))
+"""
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+  """Cumulative import time (us) of each module from -X importtime output."""
+  cumulative = {}
+  for line in stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 or not fields[1].strip().isdigit():
+      # the header line
+      continue
+    name = fields[2].strip()
+    cumulative[name] = max(int(fields[1]), cumulative.get(name, 0))
+  return cumulative
+
+def measure(service: str, top: int=10) -> Dict:
+  """Measure the startup of a service (see the module docstring)."""
+  directory, app, path = SERVICES[service]
+  env = dict(os.environ, **{'STORAGE-BACKEND': 'memory', 'PYTHONDONTWRITEBYTECODE': '1'})
+  proc = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', PROBE.format(app=app, path=path)],
+    cwd=os.path.join(ROOT, directory), env=env, capture_output=True, text=True
+  )
+  if proc.returncode != 0:
+    return {'service': service, 'skipped': proc.stderr.strip().splitlines()[-1]}
+
+  probe = json.loads(proc.stdout.strip().splitlines()[-1])
+  cumulative = parse_importtime(proc.stderr)
+  slowest = sorted(
+    ((name, us) for name, us in cumulative.items() if '.' not in name and name != 'main'),
+    key=lambda item: -item[1]
+  )[:top]
+  return {
+    'service': service,
+    'import_ms': round(probe['import_ms'], 1),
+    'importtime_ms': round(cumulative.get('main', 0) / 1000, 1),
+    'slowest': [{'module': name, 'ms': round(us / 1000, 1)} for name, us in slowest],
+    'ping_status': probe['ping_status'],
+    'ping_imports': [name for name in probe['ping_new_modules'] if name in HEAVY]
+  }
+
+
+parser = argparse.ArgumentParser(description="Measure the import time of the services.")
+parser.add_argument("services", help=f"services to measure (default: all of {', '.join(SERVICES)})",
+                    nargs='*', default=[])
+parser.add_argument("--top", help="number of slowest modules to report", type=int, default=10)
+parser.add_argument("--budget", help="maximum import time in ms", type=float, default=None)
+parser.add_argument("--out", help="write the results to this json file", type=str, default=None)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  unknown = set(args.services) - set(SERVICES)
+  if unknown:
+    parser.error(f"unknown services: {', '.join(sorted(unknown))}")
+  results = [measure(service, args.top) for service in args.services or SERVICES]
+
+  failed = False
+  for r in results:
+    if 'skipped' in r:
+      print(f"{r['service']}: skipped ({r['skipped']})")
+      continue
+    print(f"{r['service']}: import {r['import_ms']:.0f} ms (importtime {r['importtime_ms']:.0f} ms), "
+          f"ping {r['ping_status']}, heavy imports on ping: {r['ping_imports'] or 'none'}")
+    for m in r['slowest']:
+      print(f"  {m['module']:<30}{m['ms']:>8.1f} ms")
+    if args.budget is not None and (r['import_ms'] > args.budget or r['ping_imports']):
+      failed = True
+      print(f"  over budget ({args.budget:.0f} ms, no heavy imports on ping)")
+
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(results, f, indent=2)
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,171 @@
+# figure_cache.py
+"""Cache of the postseason race figure.
+
+The figure is built once per version of the dashboard data blob (see
+load.py), serialized to JSON and kept in memory, so requests never build
+it. At most every FIGURE-REFRESH-SECONDS (default 300) a request
+triggers a check of the blob's version in a background thread; if the
+pipeline has published new data, the figure is rebuilt there while the
+old one is still served. New data goes live without a redeploy.
+
+FIGURE-DECIMATE (default 1) plots every n-th day only, to shrink the
+figure for long seasons (see visualize.generate_traces).
+
+The version of the figure doubles as its HTTP ETag. plotly (see
+visualize.py) is only imported by the first build, which runs in the
+background while the server starts.
+
+Each season has its own cache (see SeasonFigures). Finished seasons are
+never republished, so their figures are built once per process.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional
+
+import load
+from instrument import span
+from store import Store, Version
+
+
+class Figure(NamedTuple):
+  """A built figure."""
+  key: str
+  version: Version
+  created: datetime
+  json: str
+  figure: Dict
+
+  @property
+  def etag(self) -> str:
+    return str(self.version)
+
+
+class FigureCache():
+  """The current figure, refreshed when the dashboard data changes.
+
+  Args:
+  -----
+  store (optional): the data bucket, default load.data_store().
+  interval (optional): minimum seconds between version checks, default
+    FIGURE-REFRESH-SECONDS or 300.
+  decimate (optional): see visualize.generate_traces, default
+    FIGURE-DECIMATE or 1.
+  season (optional): e.g. 2022, default the latest season.
+  """
+  def __init__(self,
+               store: Store=None,
+               interval: float=None,
+               decimate: int=None,
+               season: int=None) -> None:
+    self._store = store
+    self.season = season
+    if interval is None:
+      interval = float(os.getenv('FIGURE-REFRESH-SECONDS', 300))
+    self.interval = interval
+    if decimate is None:
+      decimate = int(os.getenv('FIGURE-DECIMATE', 1))
+    self.decimate = max(1, decimate)
+    self._figure: Optional[Figure] = None
+    self._checked = float('-inf')
+    # held while a refresh runs (released by the refreshing thread)
+    self._lock = threading.Lock()
+
+  @property
+  def store(self) -> Store:
+    if self._store is None:
+      self._store = load.data_store()
+    return self._store
+
+  def current(self, wait: bool=True) -> Optional[Figure]:
+    """The current figure.
+
+    If there is none yet, build it (or wait for the refresh in progress)
+    unless wait is False, in which case None is returned. Raises
+    KeyError if there is no dashboard data to build it from. Starts a
+    background version check if the last one is older than interval.
+    """
+    if self._figure is None:
+      if not wait:
+        self.start()
+        return None
+      with self._lock:
+        if self._figure is None:
+          self.refresh()
+    elif time.monotonic() - self._checked > self.interval:
+      self.start()
+    return self._figure
+
+  def start(self) -> None:
+    """Refresh in a background thread, unless a refresh is running."""
+    if self._lock.acquire(blocking=False):
+      threading.Thread(target=self._refresh_and_release, daemon=True).start()
+
+  def _refresh_and_release(self) -> None:
+    try:
+      self.refresh()
+    except Exception as e:
+      # keep serving the current figure, try again after interval
+      print(f"Figure refresh failed: {e!r}")
+    finally:
+      self._lock.release()
+
+  def refresh(self) -> bool:
+    """Rebuild the figure if the dashboard data has a new version.
+
+    The caller must hold the lock. Returns True if the figure was rebuilt.
+    Raises KeyError if there is no dashboard data.
+    """
+    self._checked = time.monotonic()
+    info = load.dashboard_blob(self.store, self.season)
+    if info is None:
+      raise KeyError(load.DASHBOARD_KEY)
+    figure = self._figure
+    if figure is not None and (figure.key, figure.version) == (info.key, info.version):
+      return False
+
+    from visualize import postseason_race
+    with span('figure.refresh'):
+      fig, created = postseason_race(load.dashboard_data(info, store=self.store), self.decimate)
+      fig_json = fig.to_json()
+    self._figure = Figure(info.key, info.version, created, fig_json, json.loads(fig_json))
+    print(f"Built figure for {info.key} version {info.version}")
+    return True
+
+
+class SeasonFigures():
+  """A FigureCache per season, created when the season is first requested.
+
+  Args:
+  -----
+  store (optional): the data bucket, default load.data_store().
+  kwargs: passed to each FigureCache.
+  """
+  def __init__(self, store: Store=None, **kwargs) -> None:
+    self._store = store
+    self.kwargs = kwargs
+    self.latest = FigureCache(store, **kwargs)
+    self._caches: Dict[int, FigureCache] = {}
+    self._lock = threading.Lock()
+
+  @property
+  def store(self) -> Store:
+    if self._store is None:
+      self._store = load.data_store()
+    return self._store
+
+  def get(self, season: int=None) -> Optional[FigureCache]:
+    """The cache of a season (default: the latest season), or None if
+    the pipeline hasn't stored the season."""
+    if season is None:
+      return self.latest
+    with self._lock:
+      cache = self._caches.get(season)
+    if cache is None:
+      if str(season) not in load.seasons(self.store):
+        return None
+      with self._lock:
+        cache = self._caches.setdefault(season, FigureCache(self.store, season=season, **self.kwargs))
+    return cache
@@ -3,33 +3,77 @@
 import os
 import json
 from datetime import date, timedelta
-from google.cloud import storage
 from dotenv import load_dotenv
-from typing import Dict
+from typing import Dict, Optional
 
+from store import BlobInfo, Store, get_store
 
-def dashboard_data() -> Dict:
+
+# written by the data pipeline (see standings.py there)
+SEASONS_PREFIX = 'seasons/'
+INDEX_KEY = SEASONS_PREFIX + 'index.json'
+DASHBOARD_KEY = 'dashboard-data.json'
+
+def data_store() -> Store:
+  """The bucket with the dashboard data."""
+  load_dotenv()
+  return get_store(os.environ.get('MLB-DATA-BUCKET-NAME'))
+
+def seasons(store: Store=None) -> Dict[str, Dict]:
+  """Stored seasons: season -> 'start', 'end' and 'through' (the last
+  day of results), from the pipeline's season index."""
+  store = store or data_store()
+  try:
+    return json.loads(store.read(INDEX_KEY))['seasons']
+  except KeyError:
+    return {}
+
+def dashboard_blob(store: Store=None, season: int=None) -> Optional[BlobInfo]:
+  """Metadata (key and version) of a season's dashboard data blob.
+
+  Without a season, the blob of the latest season is returned, falling
+  back to the blobs written by older versions of the pipeline. Returns
+  None if there is no dashboard data.
+  """
+  store = store or data_store()
+  if season is None:
+    stored = seasons(store)
+    keys = [f"{SEASONS_PREFIX}{max(stored, key=int)}/{DASHBOARD_KEY}"] if stored else []
+    keys += [
+      DASHBOARD_KEY,
+      str(date.today()) + '-dashboard-data.json',
+      str(date.today() - timedelta(days=1)) + '-dashboard-data.json'
+    ]
+  else:
+    keys = [f"{SEASONS_PREFIX}{season}/{DASHBOARD_KEY}"]
+  for key in keys:
+    info = store.stat(key)
+    if info is not None:
+      return info
+  return None
+
+def dashboard_data(info: BlobInfo=None, season: int=None, store: Store=None) -> Dict:
   """Load team records for plotting.
 
+  Args:
+  -----
+    info (optional): the blob to load (see dashboard_blob). Raises
+      store.PreconditionFailed if it has been replaced since.
+    season (optional): the season to load if info isn't given, default
+      the latest.
+    store (optional): the data bucket, default data_store().
+
   Returns:
   --------
     Dict of dashboard data. See docstring for visualize.generate_traces
-    for more info about this dict.
+    for more info about this dict. Raises KeyError if there is no
+    dashboard data.
   """
-  load_dotenv()
-
-  storage_client = storage.Client()
-
-  bucket_name = os.environ.get('MLB-DATA-BUCKET-NAME')
-  bucket = storage_client.bucket(bucket_name)
+  store = store or data_store()
+  info = info or dashboard_blob(store, season)
+  if info is None:
+    raise KeyError(DASHBOARD_KEY)
 
-  blob_id = str(date.today()) + '-dashboard-data.json'
-  blob = bucket.blob(blob_id)
-  
-  if not blob.exists(storage_client):
-    blob_id = str(date.today() - timedelta(days=1)) + '-dashboard-data.json'
-    blob = bucket.blob(blob_id)
-  
-  dashboard_data = json.loads(blob.download_as_string())
+  dashboard_data = json.loads(store.read(info.key, version=info.version))
 
   return dashboard_data
@@ -1,28 +1,127 @@
 # main.py
-"""Dashboard entry point."""
-from dash import Dash, html, dcc
-from flask import Flask
-from visualize import postseason_race
+"""Dashboard entry point.
+
+The figure is served from a cache that is refreshed when the pipeline
+publishes new data (see figure_cache.py). The page layout is generated
+per page load from the cached figure, and GET /figure.json serves the
+serialized figure. Both carry the figure's version as an ETag, so
+clients revalidate instead of downloading unchanged data.
+
+The page and /figure.json show the latest season; past seasons are
+served with the query parameter ?season=2022, from their own cache.
+
+GET /metrics serves request and span timings (see instrument.py).
+"""
+from typing import Optional
+from urllib.parse import parse_qs
+
+from dash import Dash, Input, Output, html, dcc
+from dash.exceptions import PreventUpdate
+from flask import Flask, Response, g, has_request_context, request
+from figure_cache import Figure, SeasonFigures
+from instrument import install
 
 server = Flask(__name__)
+install(server)
+
+seasons = SeasonFigures()
+figures = seasons.latest
+
+# build the figure in the background while the server starts
+figures.start()
 
-# get data
-fig, created = postseason_race()
 code_src = "[View code on github](https://github.com/lanej5/mlb)."
 data_src = "[Data sources and attribution](https://github.com/lanej5/mlb/blob/main/data.md)."
-updated = f"Last updated {created.strftime('%B %-d, %Y')}."   
-text = " ".join([code_src, data_src, updated])
+
+def get_season(value: str) -> Optional[int]:
+  """Parse a season query parameter (None if missing or invalid)."""
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+
+def page_text(figure: Figure=None) -> str:
+  """Text below the figure."""
+  text = [code_src, data_src]
+  if figure is not None:
+    text.append(f"Last updated {figure.created.strftime('%B %-d, %Y')}.")
+  return " ".join(text)
+
+def layout(figure: Figure=None) -> html.Div:
+  """Page layout showing a figure (or an empty graph)."""
+  return html.Div(children=[
+    dcc.Location(id='url', refresh=False),
+    dcc.Graph(
+      id='postseason_race',
+      figure=figure.figure if figure is not None else {}
+    ),
+    dcc.Markdown(id='page_text', children=page_text(figure))
+  ])
+
+def serve_layout() -> html.Div:
+  """Layout for a page load, with the current figure."""
+  # dash also calls this at startup to validate the layout; don't wait
+  # for the figure then
+  if not has_request_context():
+    return layout(figures.current(wait=False))
+  try:
+    g.figure = figures.current()
+  except KeyError:
+    # the pipeline hasn't published any data yet
+    g.figure = None
+  return layout(g.figure)
+
+def cache_headers(response: Response, figure: Figure, max_age: int=0) -> Response:
+  """Add the figure's ETag and Cache-Control, and answer If-None-Match."""
+  response.set_etag(figure.etag)
+  response.headers['Cache-Control'] = f"public, max-age={max_age}"
+  return response.make_conditional(request)
 
 # create the dashboard
 app = Dash(__name__, server=server)
 app.title = 'Postseason Race'
-app.layout = html.Div(children=[
-  dcc.Graph(
-    id='postseason_race',
-    figure=fig
-  ),
-  dcc.Markdown(children=text)
-])
+app.layout = serve_layout
+
+@app.callback(
+  Output('postseason_race', 'figure'),
+  Output('page_text', 'children'),
+  Input('url', 'search')
+)
+def select_season(search: str):
+  """Show the season of the page's query string (?season=2022), if any."""
+  season = get_season(parse_qs((search or '').lstrip('?')).get('season', [None])[0])
+  cache = seasons.get(season) if season is not None else None
+  if cache is None:
+    raise PreventUpdate
+  try:
+    figure = cache.current()
+  except KeyError:
+    # the season's data hasn't been published yet
+    raise PreventUpdate
+  return figure.figure, page_text(figure)
+
+@server.route("/figure.json", methods=['GET'])
+def figure_json():
+  """The current figure of a season (?season=, default the latest),
+  serialized."""
+  season = get_season(request.args.get('season'))
+  cache = seasons.get(season)
+  if cache is None:
+    return Response("Unknown season.", status=404, mimetype='text/plain')
+  try:
+    figure = cache.current()
+  except KeyError:
+    return Response("No dashboard data yet.", status=503, mimetype='text/plain')
+  response = Response(figure.json, mimetype='application/json')
+  return cache_headers(response, figure, int(cache.interval))
+
+@server.after_request
+def layout_cache_headers(response: Response) -> Response:
+  """Let clients revalidate the layout (which embeds the figure)."""
+  figure = g.get('figure')
+  if figure is not None and request.path.endswith('/_dash-layout') and response.status_code == 200:
+    return cache_headers(response, figure)
+  return response
 
 if __name__ == '__main__':
   app.run_server(debug=True)
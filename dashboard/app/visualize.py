@@ -1,17 +1,41 @@
 # visualize.py
-"""Generate plotly figure visualizing the postseason race."""
+"""Generate plotly figure visualizing the postseason race.
+
+The figure is kept compact, since it is sent to every browser: all teams
+share one date axis, given by x0 (first day) and dx (one day, or
+`decimate` days) instead of an array of dates per trace; records are
+integers, and forecasts are rounded to FORECAST_DECIMALS.
+
+The season and its dates come with the dashboard data (see dashboard_view
+in the data pipeline); data written by older pipelines is from 2022.
+"""
 from datetime import datetime, timedelta
 from collections import OrderedDict
 from typing import OrderedDict as OrderedDictType
 from typing import List, Dict, Tuple
-from copy import copy
 
 import plotly.graph_objects as go
 
+from instrument import span, timed
+
 
 ScatterDict = OrderedDictType[str, go.Scatter]
 
-def generate_traces(teams: Dict[str, Dict]) -> ScatterDict:
+# season of dashboard data without 'season', 'season_start' and 'season_end'
+DEFAULT_SEASON = 2022
+DEFAULT_SEASON_START = '2022-04-07'
+DEFAULT_SEASON_END = '2022-10-02'
+
+# dx of date axes is in milliseconds
+DAY_MS = 24 * 60 * 60 * 1000
+
+# decimals of forecasted wins over .500 (expected values) in the figure
+FORECAST_DECIMALS = 1
+
+@timed('figure.traces')
+def generate_traces(teams: Dict[str, Dict],
+                    decimate: int=1,
+                    season_start: datetime=None) -> ScatterDict:
   """Generate traces for the plot.
 
   Args:
@@ -33,6 +57,13 @@ def generate_traces(teams: Dict[str, Dict]) -> ScatterDict:
           Ties are possible.
         'forecast' (optional): List[int] containing wins over 500 for a
           given number of days beyond the current day.
+        'odds' (optional): postseason odds from simulating the rest of
+          the season, see simulate_season in the model service.
+    decimate: plot every decimate-th day (e.g., 2 halves the size of
+      the traces). The last day of the record is always plotted.
+      Values below 1 are treated as 1.
+    season_start: first day of the season (record[0]), default
+      DEFAULT_SEASON_START.
 
   Returns:
   --------
@@ -45,23 +76,25 @@ def generate_traces(teams: Dict[str, Dict]) -> ScatterDict:
       rank in the legend.
   """
   traces = OrderedDict()
+  decimate = max(1, int(decimate))
+  season_start = season_start or datetime.strptime(DEFAULT_SEASON_START, "%Y-%m-%d")
 
   # add line plots of team records
   # teams are sorted by rank so that legend is ordered
   for team, data in sorted(teams.items(), key=lambda x: x[1]['rank']):
     trace_name = f"{data['name']} ({str(data['wins'])}-{str(data['losses'])})"
     
-    # x-axis and y=-axis values for the plot
-    y_vals = copy(data['record'])
+    # y-axis values for the plot; the x-axis is the days since the start
+    # of the season, the same for every team
+    y_vals = [int(y) for y in data['record']]
     if 'forecast' in data:
-      y_vals += data['forecast']
-    x_vals = [
-      datetime(2022, 4, 7) + timedelta(days=i) for i in range(len(y_vals))
-    ]
+      y_vals += [round(y, FORECAST_DECIMALS) for y in data['forecast']]
+    first = (len(data['record']) - 1) % decimate
 
     traces[team] = go.Scatter(
-      x=x_vals,
-      y=y_vals,
+      x0=str((season_start + timedelta(days=first)).date()),
+      dx=decimate * DAY_MS,
+      y=y_vals[first::decimate],
       mode='lines',
       visible=(data['div'] == 'AL East'), # only AL East visible on page load
       legendgroup=data['div'],
@@ -72,6 +105,7 @@ def generate_traces(teams: Dict[str, Dict]) -> ScatterDict:
 
   return traces
 
+@timed('figure.buttons')
 def generate_buttons(traces: ScatterDict, teams: Dict[str, Dict]) -> List[Dict]:
   """Generate buttons for dropdown menu.
 
@@ -167,13 +201,14 @@ def generate_buttons(traces: ScatterDict, teams: Dict[str, Dict]) -> List[Dict]:
 
   return buttons
 
-def postseason_race(dashboard_data: Dict=None) -> Tuple[go.Figure, datetime]:
-  """Generate plotly figure visualizing the 2022 postseason race.
+def postseason_race(dashboard_data: Dict=None, decimate: int=1) -> Tuple[go.Figure, datetime]:
+  """Generate plotly figure visualizing a season's postseason race.
 
   Args:
   -----
     dashboard_data (optional): pass dashboard data directly instead of loading
       from bucket. For testing purposes.
+    decimate: see generate_traces.
 
   Returns:
   --------
@@ -182,11 +217,15 @@ def postseason_race(dashboard_data: Dict=None) -> Tuple[go.Figure, datetime]:
   """
   if dashboard_data is None:
     import load
-    dashboard_data = load.dashboard_data()
+    with span('dashboard.load'):
+      dashboard_data = load.dashboard_data()
 
   date_created = datetime.strptime(dashboard_data['created'], "%Y-%m-%d")
+  season = dashboard_data.get('season', DEFAULT_SEASON)
+  season_start = datetime.strptime(dashboard_data.get('season_start', DEFAULT_SEASON_START), "%Y-%m-%d")
+  season_end = datetime.strptime(dashboard_data.get('season_end', DEFAULT_SEASON_END), "%Y-%m-%d")
 
-  traces = generate_traces(dashboard_data['teams'])
+  traces = generate_traces(dashboard_data['teams'], decimate, season_start)
   buttons = generate_buttons(traces, dashboard_data['teams'])
 
   # create the layout 
@@ -202,7 +241,7 @@ def postseason_race(dashboard_data: Dict=None) -> Tuple[go.Figure, datetime]:
       )
     ],
     title=dict(
-      text=f'{2022} MLB Postseason Race',
+      text=f'{season} MLB Postseason Race',
       x=0.1
     ),
     yaxis_title='Wins over .500',
@@ -211,10 +250,12 @@ def postseason_race(dashboard_data: Dict=None) -> Tuple[go.Figure, datetime]:
     margin={'r': 300}
   )
 
-  fig = go.Figure(data=list(traces.values()), layout=layout)
+  with span('figure.build'):
+    fig = go.Figure(data=list(traces.values()), layout=layout)
 
-  # fix axis ranges so that selecting buttons doesn't shift things around
-  fig.update_xaxes(range=[datetime(2022, 4, 7), datetime(2022, 10, 2)])
+  # fix axis ranges so that selecting buttons doesn't shift things around.
+  # the type can't be inferred from x0 / dx alone
+  fig.update_xaxes(type='date', range=[season_start, season_end])
 
   y_min = min([min(trace['y']) for trace in traces.values()]) - 2
   y_max = max([max(trace['y']) for trace in traces.values()]) + 2
@@ -222,10 +263,13 @@ def postseason_race(dashboard_data: Dict=None) -> Tuple[go.Figure, datetime]:
   fig.update_yaxes(range=[y_min, y_max])
 
   # add shapes to highlight forecast
-  if 'forecast' in dashboard_data['teams']['TOR']:
+  if dashboard_data['teams']['TOR'].get('forecast'):
     forcast_length = len(dashboard_data['teams']['TOR']['forecast'])
 
-    record_end = date_created - timedelta(days=1)
+    if 'through' in dashboard_data:
+      record_end = datetime.strptime(dashboard_data['through'], "%Y-%m-%d")
+    else:
+      record_end = date_created - timedelta(days=1)
     fig.add_vline(
       x=record_end,
       line_width=1.5,
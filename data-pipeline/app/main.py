@@ -6,21 +6,66 @@ pipeline that scrapes, processes, and saves
 data for the dashboard.
 
 This process is invoked every morning.
+
+GET /standings serves the standings of a stored season on any day.
+
+GET /metrics serves request and span timings (see instrument.py).
 """
 import os
+from datetime import datetime
 from pipeline import Pipeline
-from flask import Flask
+from flask import Flask, jsonify, request
+
+from instrument import install
 
 app = Flask(__name__)
+install(app)
 
 
 @app.route("/", methods=['GET', 'POST'])
 def index():
-  """Run the pipeline."""
+  """Run the pipeline.
+
+  Missed days are caught up automatically. The optional query parameter
+  'through' (YYYY-MM-DD) sets the last day of results to apply, and
+  'season' (e.g. 2022) the season to update, default the year of
+  'through'. Days after yesterday are never applied.
+  """
+  try:
+    through = request.args.get('through')
+    if through is not None:
+      through = datetime.strptime(through, '%Y-%m-%d').date()
+    season = request.args.get('season')
+    if season is not None:
+      season = int(season)
+  except ValueError as e:
+    return (f"Invalid parameter: {e}", 400)
   pipeline = Pipeline()
-  status = pipeline.run()
+  status = pipeline.run(through, season)
   return ("", status)
 
 
+@app.route("/standings", methods=['GET'])
+def standings():
+  """Standings of a stored season (see Pipeline.get_standings).
+
+  Query parameters: 'season' (e.g. 2022), and optionally 'date'
+  (YYYY-MM-DD, default the last applied day) and 'from' (YYYY-MM-DD,
+  to get each team's record from that day to 'date').
+  """
+  try:
+    season = int(request.args['season'])
+    day, start_date = (
+      datetime.strptime(request.args[arg], '%Y-%m-%d').date() if arg in request.args else None
+      for arg in ('date', 'from')
+    )
+  except (KeyError, ValueError) as e:
+    return (f"Invalid parameter: {e}", 400)
+  try:
+    return jsonify(Pipeline().get_standings(season, day, start_date))
+  except KeyError:
+    return (f"Unknown season: {season}", 404)
+
+
 if __name__ == "__main__":
   app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
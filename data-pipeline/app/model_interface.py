@@ -1,52 +1,156 @@
 # model_interface.py
-"""Interface for the model API."""
-import urllib
+"""Interface for the model API.
+
+Requests reuse one keep-alive connection per thread, and the Google ID
+token is cached until shortly before it expires. A request is sent again
+on a new connection only if the kept-alive one failed before the request
+was sent, or, for requests that are safe to repeat (ping, forecast and
+simulate), before the response arrived. Use batch to send
+several jobs (e.g., train then forecast, or one job per model) in one
+request; the model service runs jobs for different models concurrently.
+"""
+import base64
+import http.client
 import json
 import os
+import threading
+import time
 from typing import Dict, List
-
-import google.auth.transport.requests
-import google.oauth2.id_token
-
-# endpoint = os.environ.get('MODEL-API-URL')
-endpoint = 'https://model-5odpqk6ypq-ue.a.run.app'
-
-def make_request(method: str=None, data: Dict=None):
+from urllib.parse import urlsplit
+
+from instrument import span
+
+endpoint = os.environ.get('MODEL-API-URL', 'https://model-5odpqk6ypq-ue.a.run.app')
+
+# refresh the ID token this many seconds before it expires
+TOKEN_MARGIN = 300
+
+# socket timeout of requests in seconds; simulations can take minutes
+TIMEOUT = float(os.environ.get('MODEL-API-TIMEOUT', 600))
+
+# methods that can be sent again if the response was lost
+IDEMPOTENT = {None, 'forecast', 'simulate'}
+
+
+class ModelAPIError(Exception):
+  """Request to the model API failed."""
+
+
+_token = None
+_token_expiry = 0.0
+_token_lock = threading.Lock()
+
+def id_token() -> str:
+  """Google ID token for the model API, cached until it expires."""
+  global _token, _token_expiry
+  with _token_lock:
+    if _token is None or time.time() > _token_expiry - TOKEN_MARGIN:
+      import google.auth.transport.requests
+      import google.oauth2.id_token
+      auth_req = google.auth.transport.requests.Request()
+      _token = google.oauth2.id_token.fetch_id_token(auth_req, endpoint)
+      _token_expiry = token_expiry(_token)
+    return _token
+
+def token_expiry(token: str) -> float:
+  """Expiry time (exp claim) of a JWT, or one hour from now if unknown."""
+  try:
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+  except (IndexError, ValueError, KeyError):
+    return time.time() + 3600
+
+_local = threading.local()
+
+def _connection() -> http.client.HTTPConnection:
+  """Keep-alive connection to the model API for the current thread."""
+  conn = getattr(_local, 'conn', None)
+  if conn is None:
+    url = urlsplit(endpoint)
+    if url.scheme == 'https':
+      conn = http.client.HTTPSConnection(url.netloc, timeout=TIMEOUT)
+    else:
+      conn = http.client.HTTPConnection(url.netloc, timeout=TIMEOUT)
+    _local.conn = conn
+  return conn
+
+def make_request(method: str=None, data: Dict=None) -> bytes:
   """Make API request.
 
   Args:
   -----
-  method (optional): None, train', or 'forecast'.
-  data (optional): request content for 'train' and 'forecast'
-    methods. Must not be None if method is 'train' or 'forecast'.
+  method (optional): None, 'train', 'forecast', 'simulate' or 'batch'.
+  data (optional): request content for the method. Must not be
+    None if method is not None.
 
-  Assumes data conforms to the model API requirements.
+  Assumes data conforms to the model API requirements. Only https
+  endpoints are sent an ID token (a local model service doesn't need
+  one).
 
   Returns:
   --------
-  HTTPResponse.
+  Response body. Raises ModelAPIError if the status is not 2xx.
   """
   if method is not None:
-    assert method in {'train', 'forecast'}
+    assert method in {'train', 'forecast', 'simulate', 'batch'}
     assert data is not None
     print(endpoint, method)
-    url = os.path.join(endpoint, method)
+    path = urlsplit(endpoint).path.rstrip('/') + '/' + method
   else:
-    url = endpoint # in this case we just ping the API.
+    path = urlsplit(endpoint).path or '/' # in this case we just ping the API.
 
-  # get id token for request
-  auth_req = google.auth.transport.requests.Request()
-  id_token = google.oauth2.id_token.fetch_id_token(auth_req, endpoint)
-
-  # create request
-  req = urllib.request.Request(url)
-  req.add_header("Authorization", f"Bearer {id_token}")
+  headers = {}
+  if urlsplit(endpoint).scheme == 'https':
+    headers['Authorization'] = f"Bearer {id_token()}"
+  body = None
   if method is not None:
-    req.add_header("Content-Type", "application/json; charset=utf-8")
-    req.data = bytes(json.dumps(data), encoding="utf-8")
+    headers['Content-Type'] = "application/json; charset=utf-8"
+    body = bytes(json.dumps(data), encoding="utf-8")
+
+  # send request, reconnecting once if the kept-alive connection was
+  # closed. Once the request is sent, the service may have run it, so
+  # only idempotent requests are sent again.
+  with span(f"model.{method or 'ping'}"):
+    while True:
+      reused = getattr(_local, 'conn', None) is not None
+      conn = _connection()
+      sent = False
+      try:
+        conn.request('POST' if body is not None else 'GET', path, body=body, headers=headers)
+        sent = True
+        response = conn.getresponse()
+        content = response.read()
+        break
+      except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        _local.conn = None
+        if not reused or isinstance(e, TimeoutError) or (sent and method not in IDEMPOTENT):
+          raise
+
+  if not 200 <= response.status < 300:
+    raise ModelAPIError(f"{response.status} {response.reason}: {content[:200]!r}")
+  return content
+
+def batch(jobs: List[Dict]) -> List[Dict]:
+  """Run several jobs in one request.
 
-  # send request  
-  return urllib.request.urlopen(req)
+  Args:
+  -----
+  jobs: list of dicts, each with 'op' ('train', 'forecast' or
+    'simulate'), 'model-name' and the data of the op (see the functions
+    below).
+
+  Returns:
+  --------
+  One dict per job with its response data (e.g., 'forecast') and
+  'status'. Raises ModelAPIError if a job failed.
+  """
+  results = json.loads(make_request(method='batch', data={'jobs': jobs}))['results']
+  for job, result in zip(jobs, results):
+    if not 200 <= result['status'] < 300:
+      raise ModelAPIError(f"{job['op']} {job['model-name']}: {result.get('error')}")
+  return results
 
 def ping() -> None:
   """Ping the model.
@@ -92,6 +196,39 @@ def forecast(model_name: str, games: List[Dict]) -> List[float]:
     'schedule': games
   }
 
-  response = make_request(method='forecast', data=data)
-  data = json.loads(response.read())
+  data = json.loads(make_request(method='forecast', data=data))
   return data['forecast']
+
+def simulate(model_name: str,
+             games: List[Dict],
+             standings: Dict[str, int],
+             divisions: Dict[str, List[str]],
+             leagues: Dict[str, List[str]],
+             n: int=10000) -> Dict[str, Dict]:
+  """Simulate the rest of the season.
+
+  Args:
+  -----
+  model_name: name of model used for the simulation.
+  games: remaining games of the season.
+  standings: current number of wins of each team.
+  divisions: division name -> list of teams.
+  leagues: league name -> list of division names.
+  n: number of simulations.
+
+  Returns:
+  --------
+  Dict of team -> postseason odds (division, wildcard, playoffs,
+  seed and win total distribution).
+  """
+  data = {
+    'model-name': model_name,
+    'schedule': games,
+    'standings': standings,
+    'divisions': divisions,
+    'leagues': leagues,
+    'n': n
+  }
+
+  data = json.loads(make_request(method='simulate', data=data))
+  return data['odds']
@@ -1,6 +1,5 @@
 # pipeline.py
 """Data pipeline."""
-import urllib
 import json
 import os
 from dotenv import load_dotenv
@@ -8,12 +7,17 @@ from datetime import datetime, date, timedelta
 from typing import List, Dict, Tuple
 from collections import defaultdict
 
-from google.cloud import storage
+from instrument import REGISTRY, span
+from statsapi import get_client
+from standings import (
+  DASHBOARD_KEY, SCHEDULE_KEY, SeasonStore, dashboard_view, day_range, record_between, standings_on
+)
+from store import PreconditionFailed, get_store
+from model_interface import batch
 
-from model_interface import train, forecast
 
-
-# gross, put this in a config file
+# divisions, leagues and team metadata of new seasons (see
+# Pipeline.season_metadata); each season keeps its own in the bucket
 divisions = {
   'al_east': ['NYY', 'TBR', 'TOR', 'BAL', 'BOS'],
   'al_central': ['CHW', 'CLE', 'DET', 'KCR', 'MIN'],
@@ -23,45 +27,63 @@ divisions = {
   'nl_west': ['LAD', 'COL', 'ARI', 'SFG', 'SDP']
 }
 
-teams = [team for div, teams in divisions.items() for team in teams]
+leagues = {
+  'al': ['al_east', 'al_central', 'al_west'],
+  'nl': ['nl_east', 'nl_central', 'nl_west']
+}
+
+# models trained by the daily run (all in one batch request)
+model_names = ['elo']
+
+# model used for the dashboard forecast and postseason odds
+forecast_model_name = 'elo'
+
+# team name, league, division and colour for the dashboard
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'season_data_2022.json')) as f:
+  team_metadata = json.load(f)
 
 team_div = {
   team: div for div, teams in divisions.items() for team in teams
 }
 
-team_name_abbr = {
-  'New York Yankees': 'NYY',
-  'Tampa Bay Rays': 'TBR',
-  'Toronto Blue Jays': 'TOR',
-  'Baltimore Orioles': 'BAL',
-  'Boston Red Sox': 'BOS',
-  'Chicago White Sox': 'CHW',
-  'Cleveland Guardians': 'CLE',
-  'Detroit Tigers': 'DET',
-  'Kansas City Royals': 'KCR',
-  'Minnesota Twins': 'MIN',
-  'Los Angeles Angels': 'LAA',
-  'Oakland Athletics': 'OAK',
-  'Seattle Mariners': 'SEA',
-  'Texas Rangers': 'TEX',
-  'Houston Astros': 'HOU',
-  'Atlanta Braves': 'ATL',
-  'New York Mets': 'NYM',
-  'Philadelphia Phillies': 'PHI',
-  'Miami Marlins': 'MIA',
-  'Washington Nationals': 'WSN',
-  'Chicago Cubs': 'CHC',
-  'Milwaukee Brewers': 'MIL',
-  'St. Louis Cardinals': 'STL',
-  'Pittsburgh Pirates': 'PIT',
-  'Cincinnati Reds': 'CIN',
-  'Los Angeles Dodgers': 'LAD',
-  'Colorado Rockies': 'COL',
-  'Arizona Diamondbacks': 'ARI',
-  'San Francisco Giants': 'SFG',
-  'San Diego Padres': 'SDP'
+# statsapi team id -> abbreviation. ids don't change when a team is
+# renamed (e.g. the Cleveland Indians / Guardians are 114)
+team_id_abbr = {
+  147: 'NYY',
+  139: 'TBR',
+  141: 'TOR',
+  110: 'BAL',
+  111: 'BOS',
+  145: 'CHW',
+  114: 'CLE',
+  116: 'DET',
+  118: 'KCR',
+  142: 'MIN',
+  108: 'LAA',
+  133: 'OAK',
+  136: 'SEA',
+  140: 'TEX',
+  117: 'HOU',
+  144: 'ATL',
+  121: 'NYM',
+  143: 'PHI',
+  146: 'MIA',
+  120: 'WSN',
+  112: 'CHC',
+  158: 'MIL',
+  138: 'STL',
+  134: 'PIT',
+  113: 'CIN',
+  119: 'LAD',
+  115: 'COL',
+  109: 'ARI',
+  137: 'SFG',
+  135: 'SDP'
 }
 
+# only regular season games count (not e.g. the All-Star Game)
+REGULAR_SEASON = 'R'
+
 class Pipeline():
   """Pipeline class.
 
@@ -70,33 +92,75 @@ class Pipeline():
   run().
   """
   def __init__(self):
-    # base url for statsapi calls
-    self.statsAPI_base_url = "https://statsapi.mlb.com"
+    # shared statsapi client (connection reuse, retries and caching)
+    self.statsapi = get_client()
 
     # bucket for dashboard data
     load_dotenv()
-    storage_client = storage.Client()
-    self.bucket = storage_client.bucket(os.environ.get('MLB-DATA-BUCKET-NAME'))
+    self.store = get_store(os.environ.get('MLB-DATA-BUCKET-NAME'))
+    self.seasons: Dict[int, SeasonStore] = {}
+
+  def season_metadata(self, season: int) -> Dict:
+    """Metadata of a new season (see SeasonStore.open).
+
+    The dates of the regular season and the team names of that season
+    come from MLB statsapi. Divisions, leagues and colours are those of
+    2022 (the divisions haven't changed since 2013).
+    """
+    start, end = self.statsapi.season_dates(season)
+    names = {
+      team_id_abbr[team['id']]: team['name']
+      for team in self.statsapi.teams(season) if team['id'] in team_id_abbr
+    }
+    return {
+      'start': str(start),
+      'end': str(end),
+      'divisions': divisions,
+      'leagues': leagues,
+      'teams': dict(team_metadata, name=dict(team_metadata['name'], **names))
+    }
+
+  def season(self, season: int) -> SeasonStore:
+    """The store of a season, created on first use."""
+    if season not in self.seasons:
+      self.seasons[season] = SeasonStore.open(self.store, season, self.season_metadata)
+    return self.seasons[season]
 
   @staticmethod
-  def parse_game_results(game: Dict) -> Tuple[Dict, int]:
+  def team_abbr(team: Dict) -> str:
+    """Abbreviation of a statsapi team, by its id.
+
+    Raises ValueError for unknown teams, so that their games aren't
+    silently dropped from the standings.
+    """
+    try:
+      return team_id_abbr[team['id']]
+    except KeyError:
+      raise ValueError(f"Unknown team: {team.get('name')} (id {team.get('id')})") from None
+
+  @classmethod
+  def parse_game(cls, game: Dict) -> Dict:
+    """Selected fields of a statsapi game, or None if it isn't a
+    regular season game."""
+    if game.get('gameType', REGULAR_SEASON) != REGULAR_SEASON:
+      return None
+    return {
+      'home': cls.team_abbr(game['teams']['home']['team']),
+      'visitor': cls.team_abbr(game['teams']['away']['team']),
+      'date': game['officialDate']
+    }
+
+  @classmethod
+  def parse_game_results(cls, game: Dict) -> Tuple[Dict, int]:
     """Parse data from MLB statsapi.
 
     Returns:
     --------
-    parsed_game: selected fields from statsAPI data
+    parsed_game: selected fields from statsAPI data, None if the game
+      isn't a regular season game
     result: 1 if home team won, 0 if home team lost, None if game was not played
     """
-    home_name = game['teams']['home']['team']['name']
-    visitor_name = game['teams']['away']['team']['name']
-    if (home_name in team_name_abbr) and (visitor_name in team_name_abbr):
-      parsed_game = {
-        'home': team_name_abbr[home_name],
-        'visitor': team_name_abbr[visitor_name],
-        'date': game['officialDate']
-      }
-    else:
-      parsed_game = None
+    parsed_game = cls.parse_game(game)
 
     if 'isWinner' in game['teams']['home']:
       result = int(game['teams']['home']['isWinner'])
@@ -106,59 +170,65 @@ class Pipeline():
 
   def get_game_results(self, day: date) -> Tuple[List[Dict], List[int]]:
     """Get game results for given day from MLB statsAPI."""
-    url = self.statsAPI_base_url + "/api/v1/schedule?language=en&sportId=1&date="
-    url += day.strftime("%m/%d/%Y")
+    return self.get_game_results_range(day, day)[day]
 
-    response = urllib.request.urlopen(url)
+  def get_game_results_range(self,
+                             start_date: date,
+                             end_date: date) -> Dict[date, Tuple[List[Dict], List[int]]]:
+    """Get game results for each day of a date range (inclusive).
 
-    data = json.loads(response.read())
+    The range is fetched with one request (or one per month for long
+    ranges, see StatsAPIClient.schedule_range).
 
-    games = []
-    results = []
-    if len(data['dates']) > 0:
-      for game in data['dates'][0]['games']:
+    Returns:
+    --------
+    Dict of day -> (games, results), with empty lists for days without
+    games.
+    """
+    day_results = {day: ([], []) for day in day_range(start_date, end_date)}
+    with span('statsapi.schedule_range'):
+      dates = self.statsapi.schedule_range(start_date, end_date)
+    for d in dates:
+      games, results = day_results[datetime.strptime(d['date'], '%Y-%m-%d').date()]
+      for game in d['games']:
         parsed_game, result = self.parse_game_results(game)
         if (parsed_game is not None) and (result is not None):
           games.append(parsed_game)
           results.append(result)
 
-    return games, results
+    return day_results
 
   def train_models(self,
                    model_names: List[str],
                    games: List[Dict],
-                   results: List[int]) -> None:
-    """Train models from game data."""
-    for model_name in model_names:
-      train(model_name, games, results)
-
-  @staticmethod
-  def parse_future_game(game: Dict) -> Dict:
-    """Parse future game from statsAPI."""
-    home_name = game['teams']['home']['team']['name']
-    visitor_name = game['teams']['away']['team']['name']
-    if (home_name in team_name_abbr) and (visitor_name in team_name_abbr):
-      parsed_future_game = {
-        'home': team_name_abbr[home_name],
-        'visitor': team_name_abbr[visitor_name],
-        'date': game['officialDate']
-      }
-    else:
-      parsed_future_game = None
-    return parsed_future_game
-
+                   results: List[int],
+                   season: int) -> None:
+    """Train models from game data, with one batch request for all models."""
+    print("Training models...")
+    with span('pipeline.train'):
+      batch([
+        {
+          'op': 'train',
+          'model-name': model_name,
+          'season': season,
+          'games': games,
+          'results': results
+        }
+        for model_name in model_names
+      ])
+
+  @classmethod
+  def parse_future_game(cls, game: Dict) -> Dict:
+    """Parse future game from statsAPI (see parse_game)."""
+    return cls.parse_game(game)
 
   def get_schedule(self, start_date: date, end_date: date) -> List[Dict]:
     """Get schedule for date range (inclusive)."""
-    url = self.statsAPI_base_url + "/api/v1/schedule?language=en&sportId=1"
-    url += "&startDate=" + start_date.strftime("%m/%d/%Y")
-    url += "&endDate=" + end_date.strftime("%m/%d/%Y")
-    response = urllib.request.urlopen(url)
-    data = json.loads(response.read())
-
     games = []
 
-    for day in data['dates']:
+    with span('statsapi.schedule_range'):
+      dates = self.statsapi.schedule_range(start_date, end_date)
+    for day in dates:
       for game in day['games']:
         parsed_future_game = self.parse_future_game(game)
         if parsed_future_game is not None:
@@ -166,88 +236,61 @@ class Pipeline():
 
     return games
 
-  def get_dashboard_data(self) -> Dict:
-    """Retrieve dashboard data from bucket."""
-    yesterday = date.today() - timedelta(days=1)
-    blob = self.bucket.blob(str(yesterday) + '-dashboard-data.json')
-    return json.loads(blob.download_as_string())
+  def get_standings(self, season: int, day: date=None, start_date: date=None) -> Dict:
+    """Standings of a stored season, without fetching anything.
+
+    Args:
+    -----
+    season: e.g. 2022. Raises KeyError if it isn't stored.
+    day (optional): standings after this day, default the last applied
+      day.
+    start_date (optional): only count games from this day to day (the
+      record over the range).
+
+    Returns:
+    --------
+    Dict with 'season', 'through' (last applied day), 'date', 'from'
+    and 'teams': team -> 'wins' and 'losses'.
+    """
+    season = SeasonStore.open(self.store, season)
+    snapshot, _ = season.load()
+    day = day or season.through(snapshot)
+    if start_date is None:
+      standings = standings_on(snapshot, day)
+    else:
+      standings = record_between(snapshot, start_date, day)
+    return {
+      'season': season.season,
+      'through': snapshot['through'],
+      'date': str(day),
+      'from': str(start_date or season.start),
+      'teams': {
+        team: {'wins': wins, 'losses': losses}
+        for team, (wins, losses) in standings.items()
+      }
+    }
 
-  def put_dashboard_data(self, dashboard_data: Dict) -> None:
-    """Put dashboard data in bucket."""
-    today = date.today()
-    blob = self.bucket.blob(str(today) + '-dashboard-data.json')
-    blob.upload_from_string(json.dumps(dashboard_data))
+  def get_dashboard_data(self, season: int) -> Dict:
+    """Retrieve the dashboard data of a season from bucket."""
+    return self.season(season).get_json(DASHBOARD_KEY)
 
   def update_dashboard(self,
-                       games: List[Dict],
-                       results: List[int],
+                       season: SeasonStore,
+                       snapshot: Dict,
                        schedule: List[Dict],
-                       forecast_results: List[float]) -> None:
-    """Update dashboard data with game results and forecast."""
-    # collect results by team
-    team_results = defaultdict(int)
-    for game, result in zip(games, results):
-      team_results[game['home']] += 2 * result - 1
-      team_results[game['visitor']] += 1 - 2 * result
-
-    # load dashboard data
-    dashboard_data = self.get_dashboard_data()
-
-    # update team records, win / loss, and rank
-    div_leader = {div: -10e5 for div, _ in divisions.items()}
-    num_days = (date.today() - date(2022, 4, 7)).days # number of days in season so far
-    for team in teams:
-      if len(dashboard_data['teams'][team]['record']) == num_days - 1:
-        dashboard_data['teams'][team]['record'].append(
-          dashboard_data['teams'][team]['record'][-1] + team_results[team]
-        )
-        if team_results[team] > 0:
-          dashboard_data['teams'][team]['wins'] += team_results[team]
-        else:
-          dashboard_data['teams'][team]['losses'] -= team_results[team]
+                       forecast_results: List[float],
+                       odds: Dict[str, Dict]=None) -> None:
+    """Derive the dashboard data from the standings and add the forecast.
 
-      elif len(dashboard_data['teams'][team]['record']) < num_days - 1:
-        print(f"Error: Record of {team} is missing days.")
-
-      # compute wins over 500 and update division leader
-      dashboard_data['teams'][team]['wins_over_500'] = dashboard_data['teams'][team]['wins'] - dashboard_data['teams'][team]['losses']
-      if dashboard_data['teams'][team]['wins_over_500'] > div_leader[team_div[team]]:
-        div_leader[team_div[team]] = dashboard_data['teams'][team]['wins_over_500']
+    If odds are given (see model_interface.simulate), each team gets its
+    postseason 'odds'.
+    """
+    dashboard_data = dashboard_view(snapshot, season.metadata, date.today())
+    teams = season.teams
 
-    # compute games back
-    for team in teams:
-      dashboard_data['teams'][team]['gb'] = (div_leader[team_div[team]] - dashboard_data['teams'][team]['wins_over_500']) / 2
-    
-    # rank divisions
-    def dense_rank(l: List[int]) -> List[int]:
-      # Dense rank non-increasing list of integers.
-      # Assumes l is sorted in decreasing order.
-      if not l:
-        return l
-      ranks = [1]
-      for i in range(1, len(l)):
-        if l[i] == l[i - 1]:
-          ranks.append(ranks[-1])
-        else:
-          ranks.append(ranks[-1] + 1)
-      return ranks
-    
-    def rank_division(team_list: List[Tuple[str, int]]):
-      # Rank division
-      # Args: Each item in the list is a pair x = ('TOR', 5)
-      # where x[1] is the number of games back
-      # Returns: pairs x = ('TOR', 3) where x[1] is division rank
-      team_list.sort(key=lambda x: x[1], reverse=False)
-      gb = [x[1] for x in team_list]
-      return [(x[0], rank) for (x, rank) in zip(team_list, dense_rank(gb))]
-
-    for div, ts in divisions.items():
-      team_list = [(t, dashboard_data['teams'][t]['gb']) for t in ts]
-      # print(team_list)
-      team_ranks = rank_division(team_list)
-      # print(team_ranks)
-      for x in team_ranks:
-        dashboard_data['teams'][x[0]]['rank'] = x[1]
+    if odds:
+      for team in teams:
+        dashboard_data['teams'][team]['odds'] = odds[team]
 
     # collect forecasted results by date and team
     forecast_team_results = defaultdict(float)
@@ -256,60 +299,134 @@ class Pipeline():
       forecast_team_results[(d, game['home'])] += 2 * prob - 1
       forecast_team_results[(d, game['visitor'])] += 1 - 2 * prob
         
-    # convert game forecasts to wins over 500 for each team
+    # convert game forecasts to wins over 500 for each team,
+    # starting the day after the last day of the standings
     for team in teams:
       dashboard_data['teams'][team]['forecast'] = []
-    dates = [date.today() + timedelta(days=i) for i in range(30)] # poor cohesion here
+    first_day = season.through(snapshot) + timedelta(days=1)
+    last_day = min(first_day + timedelta(days=29), season.end) # poor cohesion here
+    dates = day_range(first_day, last_day)
     for d in dates:
       for team in teams:
         if len(dashboard_data['teams'][team]['forecast']) == 0:
-          x = dashboard_data['teams'][team]['record'][-1] + forecast_team_results[(d, team)]
+          record = dashboard_data['teams'][team]['record']
+          x = (record[-1] if record else 0) + forecast_team_results[(d, team)]
           dashboard_data['teams'][team]['forecast'].append(x)
         else:
           x = dashboard_data['teams'][team]['forecast'][-1] + forecast_team_results[(d, team)]
           dashboard_data['teams'][team]['forecast'].append(x)
 
-    # update date
-    dashboard_data['created'] = datetime.today().strftime('%Y-%m-%d')
-
-    self.put_dashboard_data(dashboard_data)
+    season.put_json(DASHBOARD_KEY, dashboard_data)
   
-  def run(self) -> int:
+  def run(self, end_date: date=None, season: int=None) -> int:
     """Run data pipeline.
 
-    1. Get game results for previous day from MLB statsapi.
-    2. Train model(s) using game results (1). Depending on the model
-       this may require gathering additional data.
-    3. Get upcoming schedule from MLB statsAPI.
-    4. Get forecast from model using schedule from (3).
-    5. Load the dashboard data file from bucket
-    6. Update dashboard data with results (1) and forecast (4).
-    7. Put updated dashboard data file back into bucket.
+    1. Get game results for the days since the last run from MLB
+       statsapi (usually just yesterday, more if runs were missed) with
+       one range request and log them.
+    2. Train model(s) using the new game results (1). Depending on the
+       model this may require gathering additional data.
+    3. Apply the new results to the standings snapshot.
+    4. Get upcoming schedule from MLB statsAPI.
+    5. Get forecast from model using schedule from (4), and simulate
+       the rest of the season from the standings (3).
+    6. Derive the dashboard data from the standings (3), forecast and
+       postseason odds (5).
+    7. Put the dashboard data into the bucket.
+
+    Re-running the pipeline on the same day doesn't apply or train on
+    any results twice. Once a season is over and its last day has been
+    applied, runs for it do nothing.
+
+    Args:
+    -----
+    end_date (optional): last day of results to apply, default
+      yesterday. Use it to catch up to a given day. Days after
+      yesterday are ignored: their games may not be final yet, and a
+      logged day is never rewritten.
+    season (optional): e.g. 2022, default the year of end_date. Days
+      after the end of the season are ignored.
     """
-    season_end = date(2022, 10, 2)
-    if date.today() > season_end:
-      return
-    # 1. get results of yesterday's games
-    print("Retrieving game results...")
-    games, results = self.get_game_results(date.today() - timedelta(days=1))
-
-    # 2. train the models
-    if games:
-      print("Training models...")
-      model_names = ['elo']
-      self.train_models(model_names, games, results)
-
-    # 3 - 4. forecast next 30 days
-    print("Retrieving schedule...")
-    end_date = min(date.today() + timedelta(days=30), season_end)
-    schedule = self.get_schedule(date.today(), end_date)
-    model_name = 'elo'
-    print("Retrieving forecast...")
-    forecast_results = forecast(model_name, schedule)
-
-    # 5 - 7. update dashboard data
+    yesterday = date.today() - timedelta(days=1)
+    end_date = min(end_date or yesterday, yesterday)
+    season = self.season(season or end_date.year)
+
+    # 1 - 3. log new results, train the models and update the standings
+    print(f"Updating {season.season} standings...")
+    try:
+      with span('pipeline.standings'):
+        snapshot = season.update(
+          end_date,
+          self.get_game_results_range,
+          on_new_results=lambda games, results: self.train_models(
+            model_names, games, results, season.season
+          )
+        )
+    except PreconditionFailed:
+      print("Standings were updated by another run.")
+      return 409
+    season.update_index(snapshot)
+
+    # 4. the rest of the season after the standings
+    first_day = season.through(snapshot) + timedelta(days=1)
+    if first_day > season.end:
+      try:
+        if season.get_json(DASHBOARD_KEY)['through'] == snapshot['through']:
+          print(f"The {season.season} season is over.")
+          return 200
+      except KeyError:
+        pass
+      remaining_schedule = []
+    else:
+      print("Retrieving schedule...")
+      remaining_schedule = self.get_schedule(first_day, season.end)
+    season.put_json(SCHEDULE_KEY, {'through': snapshot['through'], 'games': remaining_schedule})
+
+    # 5. forecast next 30 days and simulate the rest of the season
+    # from the standings, in one request
+    forecast_end = str(min(first_day + timedelta(days=29), season.end))
+    schedule = [game for game in remaining_schedule if game['date'] <= forecast_end]
+    forecast_results, odds = [], None
+    if remaining_schedule:
+      standings = {
+        team: wins
+        for team, (wins, _) in standings_on(snapshot, season.through(snapshot)).items()
+      }
+      print("Retrieving forecast and simulating season...")
+      with span('pipeline.forecast'):
+        forecast_job, simulate_job = batch([
+          # simulate in rounds of 250 until every probability is within a
+          # standard error of 0.005. averaging the model's probabilities
+          # (rao-blackwell) usually gets there in the first round
+          {
+            'op': 'forecast',
+            'model-name': forecast_model_name,
+            'season': season.season,
+            'schedule': schedule,
+            'n': 5000,
+            'every': 250,
+            'target-se': 0.005,
+            'rao-blackwell': True
+          },
+          {
+            'op': 'simulate',
+            'model-name': forecast_model_name,
+            'season': season.season,
+            'schedule': remaining_schedule,
+            'standings': standings,
+            'divisions': season.divisions,
+            'leagues': season.leagues
+          }
+        ])
+      forecast_results, odds = forecast_job['forecast'], simulate_job['odds']
+
+    # 6 - 7. update dashboard data
     print("Updating dashboard...")
-    self.update_dashboard(games, results, schedule, forecast_results)
+    with span('pipeline.dashboard'):
+      self.update_dashboard(season, snapshot, schedule, forecast_results, odds)
+
+    # where the time went (totals since the process started)
+    for name, timing in REGISTRY.summary().items():
+      print(f"{name}: {timing['count']} calls, {timing['seconds']:.3f}s")
 
     return 200
-    
\ No newline at end of file
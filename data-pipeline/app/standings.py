@@ -0,0 +1,461 @@
+# standings.py
+"""Season store: metadata, results and standings of each season.
+
+Each season is kept in the data bucket under seasons/<season>/:
+
+  season.json: metadata: first and last day of the regular season,
+    divisions, leagues and team metadata (name, league, division,
+    colour). Written once, when the season is first opened.
+  results/<date>.json: the results of the games played on a day. One
+    blob per day, written once; this is an append-only log.
+  standings.json: snapshot of the standings through the last applied
+    day: each team's cumulative wins and losses after every day of the
+    season, so the standings on any day, and the record over any range
+    of days, are O(1) lookups (see standings_on and record_between).
+  schedule.json: the remaining schedule as of the last update.
+  dashboard-data.json: the dashboard view (see dashboard_view), derived
+    from the snapshot, the forecast and the postseason odds.
+
+seasons/index.json lists the stored seasons with their first, last and
+last applied days, so readers (e.g. the dashboard) find them without
+listing the bucket. Finished seasons are never fetched or recomputed
+again: their results are in the log and their views in the bucket. The
+model service keeps its parameters per season too (see utils.py there).
+
+A daily update writes the new day's results and the updated snapshot.
+Days are applied to the snapshot at most once, so re-running an update
+is a no-op. After missed runs, all days since the last applied day are
+caught up in one update: their results are fetched with one range
+request and passed to the models as one batch, and the snapshot and
+dashboard view are rebuilt once. The first update of a season
+bootstraps the snapshot from the unprefixed standings.json, or else the
+latest <date>-dashboard-data.json blob, written by earlier versions of
+the pipeline for that season, if there is one.
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from store import PreconditionFailed, Store, Version
+
+
+SEASONS_PREFIX = 'seasons/'
+INDEX_KEY = SEASONS_PREFIX + 'index.json'
+METADATA_KEY = 'season.json'
+RESULTS_PREFIX = 'results/'
+SNAPSHOT_KEY = 'standings.json'
+SCHEDULE_KEY = 'schedule.json'
+DASHBOARD_KEY = 'dashboard-data.json'
+LEGACY_DASHBOARD_SUFFIX = '-dashboard-data.json'
+
+# (games, results) of a day, see Pipeline.parse_game_results
+DayResults = Tuple[List[Dict], List[int]]
+
+# (wins, losses) of each team
+Standings = Dict[str, Tuple[int, int]]
+
+
+def parse_date(s: str) -> date:
+  return datetime.strptime(s, '%Y-%m-%d').date()
+
+def day_range(start_date: date, end_date: date) -> List[date]:
+  """Days from start_date to end_date (inclusive)."""
+  return [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+def season_prefix(season: int) -> str:
+  return f"{SEASONS_PREFIX}{season}/"
+
+def read_index(store: Store) -> Tuple[Dict, Version]:
+  """The season index and its version (0 if it isn't stored yet).
+
+  The index has a dict 'seasons' of season -> 'start', 'end' and
+  'through' (the last applied day).
+  """
+  info = store.stat(INDEX_KEY)
+  if info is None:
+    return {'seasons': {}}, 0
+  try:
+    return json.loads(store.read(INDEX_KEY, version=info.version)), info.version
+  except PreconditionFailed:
+    return read_index(store)
+
+
+class SeasonStore():
+  """One season, stored incrementally in a bucket.
+
+  Use open to create or load a season.
+
+  Args:
+  -----
+  store: the data bucket.
+  metadata: the season's metadata (see open).
+  """
+  def __init__(self, store: Store, metadata: Dict) -> None:
+    self.store = store
+    self.metadata = metadata
+    self.season = int(metadata['season'])
+    self.start = parse_date(metadata['start'])
+    self.end = parse_date(metadata['end'])
+    self.divisions = metadata['divisions']
+    self.leagues = metadata['leagues']
+    self.teams = [team for teams in self.divisions.values() for team in teams]
+    self.prefix = season_prefix(self.season)
+
+  @classmethod
+  def open(cls,
+           store: Store,
+           season: int,
+           create: Callable[[int], Dict]=None) -> 'SeasonStore':
+    """Load a season, or create it if it isn't stored yet.
+
+    Args:
+    -----
+    store: the data bucket.
+    season: e.g. 2022.
+    create: function of the season returning its metadata: 'start' and
+      'end' (YYYY-MM-DD) of the regular season, 'divisions' (division
+      -> teams), 'leagues' (league -> divisions) and 'teams' (field ->
+      team -> value, see dashboard_view). Only called for new seasons.
+      If None, seasons that aren't stored raise KeyError.
+    """
+    key = season_prefix(season) + METADATA_KEY
+    try:
+      return cls(store, json.loads(store.read(key)))
+    except KeyError:
+      if create is None:
+        raise
+
+    metadata = dict(create(season), season=season)
+    try:
+      store.write(
+        key,
+        json.dumps(metadata).encode('utf-8'),
+        if_version_match=0,
+        content_type='application/json'
+      )
+    except PreconditionFailed:
+      # created meanwhile
+      return cls(store, json.loads(store.read(key)))
+    return cls(store, metadata)
+
+  def key(self, name: str) -> str:
+    return self.prefix + name
+
+  def results_key(self, day: date) -> str:
+    return self.key(f"{RESULTS_PREFIX}{day}.json")
+
+  def get_results(self, day: date) -> Optional[DayResults]:
+    """Logged results of a day, or None if the day hasn't been logged."""
+    try:
+      data = json.loads(self.store.read(self.results_key(day)))
+    except KeyError:
+      return None
+    return data['games'], data['results']
+
+  def put_results(self, day: date, games: List[Dict], results: List[int]) -> None:
+    """Log the results of a day. Logged days are never rewritten."""
+    data = {'date': str(day), 'games': games, 'results': results}
+    try:
+      self.store.write(
+        self.results_key(day),
+        json.dumps(data).encode('utf-8'),
+        if_version_match=0,
+        content_type='application/json'
+      )
+    except PreconditionFailed:
+      pass
+
+  def new_snapshot(self) -> Dict:
+    """Snapshot before the first day of the season.
+
+    wins[i] and losses[i] of a team are its wins and losses after day
+    season_start + i.
+    """
+    return {
+      'season': self.season,
+      'season_start': str(self.start),
+      'through': str(self.start - timedelta(days=1)),
+      'teams': {team: {'wins': [], 'losses': []} for team in self.teams}
+    }
+
+  @staticmethod
+  def cumulative(record: List[int]) -> Tuple[List[int], List[int]]:
+    """Cumulative wins and losses from wins over .500 after each day.
+
+    Days on which a team split its games count as neither.
+    """
+    wins, losses = [], []
+    w, l, previous = 0, 0, 0
+    for x in record:
+      w += max(x - previous, 0)
+      l += max(previous - x, 0)
+      previous = x
+      wins.append(w)
+      losses.append(l)
+    return wins, losses
+
+  def legacy_snapshot(self) -> Optional[Dict]:
+    """Snapshot of this season written by earlier versions, if any.
+
+    The unprefixed standings.json, or else the latest legacy dashboard
+    data blob, converted to the current format.
+    """
+    records = None
+    try:
+      legacy = json.loads(self.store.read(SNAPSHOT_KEY))
+      if parse_date(legacy['season_start']) == self.start:
+        records = {team: legacy['teams'][team]['record'] for team in self.teams}
+    except KeyError:
+      pass
+
+    if records is None:
+      keys = [
+        key for key in self.store.list(str(self.season))
+        if key.endswith(LEGACY_DASHBOARD_SUFFIX)
+      ]
+      if not keys:
+        return None
+      dashboard_data = json.loads(self.store.read(max(keys)))
+      records = {team: dashboard_data['teams'][team]['record'] for team in self.teams}
+
+    snapshot = self.new_snapshot()
+    days = min(len(record) for record in records.values())
+    snapshot['through'] = str(self.start + timedelta(days=days - 1))
+    for team in self.teams:
+      wins, losses = self.cumulative(records[team][:days])
+      snapshot['teams'][team] = {'wins': wins, 'losses': losses}
+    return snapshot
+
+  def load(self) -> Tuple[Dict, Version]:
+    """Load the snapshot and its version (0 if it isn't stored yet)."""
+    info = self.store.stat(self.key(SNAPSHOT_KEY))
+    if info is None:
+      return self.legacy_snapshot() or self.new_snapshot(), 0
+    try:
+      return json.loads(self.store.read(info.key, version=info.version)), info.version
+    except PreconditionFailed:
+      # written since stat, try again
+      return self.load()
+
+  def save(self, snapshot: Dict, version: Version) -> Version:
+    """Save the snapshot if it is still at version.
+
+    Raises PreconditionFailed if another update saved it first.
+    """
+    return self.store.write(
+      self.key(SNAPSHOT_KEY),
+      json.dumps(snapshot, separators=(',', ':')).encode('utf-8'),
+      if_version_match=version,
+      content_type='application/json'
+    )
+
+  @staticmethod
+  def through(snapshot: Dict) -> date:
+    """Last day applied to the snapshot."""
+    return parse_date(snapshot['through'])
+
+  def pending_days(self, snapshot: Dict, end_date: date) -> List[date]:
+    """Days after the snapshot up to end_date (inclusive)."""
+    return day_range(self.through(snapshot) + timedelta(days=1), min(end_date, self.end))
+
+  def results(self,
+              days: List[date],
+              fetch: Callable[[date, date], Dict[date, DayResults]]) -> List[DayResults]:
+    """Results of each day, from the log or fetched and logged if missing.
+
+    Logged days are read concurrently, and the days that aren't logged
+    are fetched with a single call to fetch(first missing day, last
+    missing day).
+    """
+    logged = {}
+    for key, data in self.store.read_many([self.results_key(day) for day in days]):
+      if data is not None:
+        data = json.loads(data)
+        logged[data['date']] = (data['games'], data['results'])
+
+    missing = [day for day in days if str(day) not in logged]
+    if missing:
+      fetched = fetch(missing[0], missing[-1])
+      with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda day: self.put_results(day, *fetched[day]), missing))
+      for day in missing:
+        logged[str(day)] = fetched[day]
+
+    return [logged[str(day)] for day in days]
+
+  def apply(self, snapshot: Dict, day: date, games: List[Dict], results: List[int]) -> None:
+    """Apply the results of the day after the snapshot to it."""
+    assert day == self.through(snapshot) + timedelta(days=1)
+    wins = {team: 0 for team in self.teams}
+    losses = {team: 0 for team in self.teams}
+    for game, result in zip(games, results):
+      winner, loser = (game['home'], game['visitor']) if result else (game['visitor'], game['home'])
+      wins[winner] += 1
+      losses[loser] += 1
+
+    for team in self.teams:
+      data = snapshot['teams'][team]
+      data['wins'].append((data['wins'][-1] if data['wins'] else 0) + wins[team])
+      data['losses'].append((data['losses'][-1] if data['losses'] else 0) + losses[team])
+    snapshot['through'] = str(day)
+
+  def update(self,
+             end_date: date,
+             fetch: Callable[[date, date], Dict[date, DayResults]],
+             on_new_results: Callable[[List[Dict], List[int]], None]=None) -> Dict:
+    """Bring the standings up to date through end_date.
+
+    Args:
+    -----
+    end_date: last day to apply (at most the last day of the season).
+    fetch: function of (start_date, end_date) returning a dict of
+      day -> (games, results) for each day in the range (inclusive).
+      Used once, for the days that aren't logged yet.
+    on_new_results (optional): called with the games and results of all
+      newly applied days (e.g., to train models) before the snapshot is
+      saved. Not called if there are no new days. If the save fails,
+      the next update calls it again with the same days, so it must be
+      idempotent: the model service skips games on or before the last
+      day each model was trained on.
+
+    Returns:
+    --------
+    The updated snapshot.
+    """
+    snapshot, version = self.load()
+    days = self.pending_days(snapshot, end_date)
+    if not days:
+      if version == 0 and self.through(snapshot) >= self.start:
+        # migrated from a legacy snapshot
+        self.save(snapshot, version)
+      return snapshot
+    print(f"Applying results from {days[0]} to {days[-1]}...")
+
+    day_results = self.results(days, fetch)
+    new_games = [game for games, _ in day_results for game in games]
+    new_results = [result for _, results in day_results for result in results]
+    if new_games and on_new_results is not None:
+      on_new_results(new_games, new_results)
+
+    for day, (games, results) in zip(days, day_results):
+      self.apply(snapshot, day, games, results)
+    self.save(snapshot, version)
+    return snapshot
+
+  def update_index(self, snapshot: Dict) -> None:
+    """Record the season and its last applied day in the season index."""
+    entry = {'start': str(self.start), 'end': str(self.end), 'through': snapshot['through']}
+    while True:
+      index, version = read_index(self.store)
+      if index['seasons'].get(str(self.season)) == entry:
+        return
+      index['seasons'][str(self.season)] = entry
+      try:
+        self.store.write(
+          INDEX_KEY,
+          json.dumps(index, sort_keys=True).encode('utf-8'),
+          if_version_match=version,
+          content_type='application/json'
+        )
+        return
+      except PreconditionFailed:
+        # another season was indexed meanwhile
+        continue
+
+  def get_json(self, name: str) -> Dict:
+    """Read a json blob of the season, e.g. DASHBOARD_KEY.
+
+    Raises KeyError if it doesn't exist.
+    """
+    return json.loads(self.store.read(self.key(name)))
+
+  def put_json(self, name: str, data: Dict) -> None:
+    """Write a json blob of the season, e.g. SCHEDULE_KEY."""
+    self.store.write(
+      self.key(name),
+      json.dumps(data).encode('utf-8'),
+      content_type='application/json'
+    )
+
+
+def standings_on(snapshot: Dict, day: date) -> Standings:
+  """Each team's (wins, losses) after a day of the snapshot's season.
+
+  Days before the season give (0, 0), days after the snapshot the
+  standings through the snapshot.
+  """
+  i = (day - parse_date(snapshot['season_start'])).days
+  standings = {}
+  for team, data in snapshot['teams'].items():
+    j = min(i, len(data['wins']) - 1)
+    standings[team] = (data['wins'][j], data['losses'][j]) if j >= 0 else (0, 0)
+  return standings
+
+def record_between(snapshot: Dict, start_date: date, end_date: date) -> Standings:
+  """Each team's (wins, losses) from start_date to end_date (inclusive)."""
+  after = standings_on(snapshot, end_date)
+  before = standings_on(snapshot, start_date - timedelta(days=1))
+  return {
+    team: (wins - before[team][0], losses - before[team][1])
+    for team, (wins, losses) in after.items()
+  }
+
+
+def dense_rank(l: List[float]) -> List[int]:
+  """Dense rank a sorted list (equal values get the same rank)."""
+  if not l:
+    return l
+  ranks = [1]
+  for i in range(1, len(l)):
+    if l[i] == l[i - 1]:
+      ranks.append(ranks[-1])
+    else:
+      ranks.append(ranks[-1] + 1)
+  return ranks
+
+def dashboard_view(snapshot: Dict, metadata: Dict, created: date) -> Dict:
+  """Derive the dashboard data from a snapshot.
+
+  Args:
+  -----
+  snapshot: see SeasonStore.
+  metadata: the season's metadata (see SeasonStore.open). 'teams' has
+    the fields 'name', 'league', 'div' and 'color' (field -> team ->
+    value).
+  created: date of the view.
+
+  Returns:
+  --------
+  Dashboard data (see visualize.generate_traces in the dashboard),
+  without 'forecast' and 'odds'.
+  """
+  teams = {}
+  for team, data in snapshot['teams'].items():
+    wins = data['wins'][-1] if data['wins'] else 0
+    losses = data['losses'][-1] if data['losses'] else 0
+    teams[team] = {field: values[team] for field, values in metadata['teams'].items()}
+    teams[team].update(
+      record=[w - l for w, l in zip(data['wins'], data['losses'])],
+      wins=wins,
+      losses=losses,
+      wins_over_500=wins - losses
+    )
+
+  # games back and division rank
+  for div, div_teams in metadata['divisions'].items():
+    leader = max(teams[team]['wins_over_500'] for team in div_teams)
+    for team in div_teams:
+      teams[team]['gb'] = (leader - teams[team]['wins_over_500']) / 2
+    ranked = sorted(div_teams, key=lambda team: teams[team]['gb'])
+    for team, rank in zip(ranked, dense_rank([teams[team]['gb'] for team in ranked])):
+      teams[team]['rank'] = rank
+
+  return {
+    'created': str(created),
+    'season': metadata['season'],
+    'season_start': metadata['start'],
+    'season_end': metadata['end'],
+    'through': snapshot['through'],
+    'teams': teams
+  }
@@ -0,0 +1,338 @@
+# store.py
+"""Storage backends.
+
+All blob I/O goes through a Store, which is bound to one bucket. The
+backend is chosen by the STORAGE-BACKEND environment variable:
+
+  gcs (default): Google Cloud Storage.
+  local: files under the directory STORAGE-ROOT/<bucket name>.
+  memory: in-process dicts, shared by all stores in the process.
+
+Every stored blob has a version (the generation for GCS) which changes
+on every write. Writes are atomic, and can be made conditional on the
+current version with if_version_match (0 means the blob must not exist).
+Blob operations of the gcs and local backends are timed as spans named
+store.<operation> (see instrument.py).
+
+This file is shared by the services; keep the copies in sync.
+"""
+import io
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from instrument import timed
+
+
+Version = Union[int, str]
+
+
+class PreconditionFailed(Exception):
+  """A conditional write found a different version than expected."""
+
+
+class BlobInfo(NamedTuple):
+  """Metadata of a stored blob."""
+  key: str
+  version: Version
+  size: int
+
+
+class Store(ABC):
+  """Blob storage for one bucket."""
+  def __init__(self, bucket_name: str) -> None:
+    self.bucket_name = bucket_name
+
+  @abstractmethod
+  def stat(self, key: str) -> Optional[BlobInfo]:
+    """Get blob metadata, or None if the blob doesn't exist."""
+    pass
+
+  @abstractmethod
+  def read(self, key: str, version: Version=None) -> bytes:
+    """Read a blob.
+
+    Raises KeyError if the blob doesn't exist, and PreconditionFailed if
+    version is given and the blob has a different version.
+    """
+    pass
+
+  @abstractmethod
+  def write(self,
+            key: str,
+            data: bytes,
+            if_version_match: Version=None,
+            content_type: str=None) -> Version:
+    """Atomically write a blob and return its new version.
+
+    Raises PreconditionFailed if if_version_match is given and doesn't
+    match the current version (0: the blob must not exist).
+    """
+    pass
+
+  @abstractmethod
+  def list(self, prefix: str='') -> List[str]:
+    """List keys starting with prefix, in sorted order."""
+    pass
+
+  @abstractmethod
+  def delete(self, key: str) -> None:
+    """Delete a blob if it exists."""
+    pass
+
+  def exists(self, key: str) -> bool:
+    """Check if a blob exists."""
+    return self.stat(key) is not None
+
+  def open(self, key: str) -> BinaryIO:
+    """Open a blob for streamed reading."""
+    return io.BytesIO(self.read(key))
+
+  def read_many(self,
+                keys: Iterable[str],
+                workers: int=8) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """Read blobs concurrently.
+
+    Yields (key, data) in the order of keys, with data None for blobs
+    that don't exist.
+    """
+    def read(key: str) -> Optional[bytes]:
+      try:
+        return self.read(key)
+      except KeyError:
+        return None
+
+    keys = list(keys)
+    with ThreadPoolExecutor(max(1, min(workers, len(keys)))) as executor:
+      yield from zip(keys, executor.map(read, keys))
+
+
+class GCSStore(Store):
+  """Google Cloud Storage bucket. Versions are blob generations."""
+  _client = None
+  _client_lock = threading.Lock()
+
+  def __init__(self, bucket_name: str) -> None:
+    super().__init__(bucket_name)
+    self.bucket = self.client().bucket(bucket_name)
+
+  @classmethod
+  def client(cls):
+    """Storage client shared by all GCS stores in the process."""
+    with cls._client_lock:
+      if cls._client is None:
+        from google.cloud import storage
+        cls._client = storage.Client()
+      return cls._client
+
+  @timed('store.stat')
+  def stat(self, key: str) -> Optional[BlobInfo]:
+    blob = self.bucket.get_blob(key)
+    if blob is None:
+      return None
+    return BlobInfo(key, blob.generation, blob.size)
+
+  @timed('store.read')
+  def read(self, key: str, version: Version=None) -> bytes:
+    from google.api_core import exceptions
+    try:
+      return self.bucket.blob(key).download_as_bytes(if_generation_match=version)
+    except exceptions.NotFound:
+      raise KeyError(key)
+    except exceptions.PreconditionFailed:
+      raise PreconditionFailed(key)
+
+  @timed('store.write')
+  def write(self,
+            key: str,
+            data: bytes,
+            if_version_match: Version=None,
+            content_type: str=None) -> Version:
+    from google.api_core import exceptions
+    blob = self.bucket.blob(key)
+    try:
+      blob.upload_from_string(
+        data,
+        content_type=content_type or 'application/octet-stream',
+        if_generation_match=if_version_match
+      )
+    except exceptions.PreconditionFailed:
+      raise PreconditionFailed(key)
+    return blob.generation
+
+  @timed('store.list')
+  def list(self, prefix: str='') -> List[str]:
+    return sorted(blob.name for blob in self.client().list_blobs(self.bucket, prefix=prefix))
+
+  @timed('store.delete')
+  def delete(self, key: str) -> None:
+    from google.api_core import exceptions
+    try:
+      self.bucket.blob(key).delete()
+    except exceptions.NotFound:
+      pass
+
+  def open(self, key: str) -> BinaryIO:
+    return self.bucket.blob(key).open('rb')
+
+
+class LocalStore(Store):
+  """Directory on the local filesystem.
+
+  Versions combine the file's mtime, size and inode. Writes go to a
+  temporary file which is renamed over the blob, so readers never see a
+  partial write. Conditional writes are only atomic within a process.
+  """
+  _lock = threading.Lock()
+
+  def __init__(self, bucket_name: str, root: str=None) -> None:
+    super().__init__(bucket_name)
+    root = root or os.getenv('STORAGE-ROOT', 'storage')
+    self.root = os.path.join(root, bucket_name)
+    os.makedirs(self.root, exist_ok=True)
+
+  def path(self, key: str) -> str:
+    """Filesystem path of a blob."""
+    return os.path.join(self.root, *key.split('/'))
+
+  @timed('store.stat')
+  def stat(self, key: str) -> Optional[BlobInfo]:
+    try:
+      st = os.stat(self.path(key))
+    except FileNotFoundError:
+      return None
+    return BlobInfo(key, f"{st.st_mtime_ns}-{st.st_size}-{st.st_ino}", st.st_size)
+
+  @timed('store.read')
+  def read(self, key: str, version: Version=None) -> bytes:
+    try:
+      with open(self.path(key), 'rb') as f:
+        if version is not None:
+          st = os.fstat(f.fileno())
+          if f"{st.st_mtime_ns}-{st.st_size}-{st.st_ino}" != version:
+            raise PreconditionFailed(key)
+        return f.read()
+    except FileNotFoundError:
+      raise KeyError(key)
+
+  @timed('store.write')
+  def write(self,
+            key: str,
+            data: bytes,
+            if_version_match: Version=None,
+            content_type: str=None) -> Version:
+    path = self.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.chmod(tmp, 0o644)
+      with self._lock:
+        if if_version_match is not None:
+          info = self.stat(key)
+          current = info.version if info is not None else 0
+          if current != if_version_match:
+            raise PreconditionFailed(key)
+        os.replace(tmp, path)
+        return self.stat(key).version
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  @timed('store.list')
+  def list(self, prefix: str='') -> List[str]:
+    keys = []
+    for dirpath, _, filenames in os.walk(self.root):
+      for filename in filenames:
+        if filename.startswith('.tmp-'):
+          continue
+        key = os.path.relpath(os.path.join(dirpath, filename), self.root)
+        key = key.replace(os.sep, '/')
+        if key.startswith(prefix):
+          keys.append(key)
+    return sorted(keys)
+
+  @timed('store.delete')
+  def delete(self, key: str) -> None:
+    try:
+      os.remove(self.path(key))
+    except FileNotFoundError:
+      pass
+
+  def open(self, key: str) -> BinaryIO:
+    try:
+      return open(self.path(key), 'rb')
+    except FileNotFoundError:
+      raise KeyError(key)
+
+
+class MemoryStore(Store):
+  """In-process store. Versions count writes."""
+  _buckets: Dict[str, Dict[str, Tuple[int, bytes]]] = {}
+  _lock = threading.Lock()
+  _counter = 0
+
+  def __init__(self, bucket_name: str) -> None:
+    super().__init__(bucket_name)
+    with self._lock:
+      self.blobs = self._buckets.setdefault(bucket_name, {})
+
+  def stat(self, key: str) -> Optional[BlobInfo]:
+    with self._lock:
+      if key not in self.blobs:
+        return None
+      version, data = self.blobs[key]
+    return BlobInfo(key, version, len(data))
+
+  def read(self, key: str, version: Version=None) -> bytes:
+    with self._lock:
+      if key not in self.blobs:
+        raise KeyError(key)
+      current, data = self.blobs[key]
+    if version is not None and version != current:
+      raise PreconditionFailed(key)
+    return data
+
+  def write(self,
+            key: str,
+            data: bytes,
+            if_version_match: Version=None,
+            content_type: str=None) -> Version:
+    with self._lock:
+      if if_version_match is not None:
+        current = self.blobs[key][0] if key in self.blobs else 0
+        if current != if_version_match:
+          raise PreconditionFailed(key)
+      MemoryStore._counter += 1
+      self.blobs[key] = (MemoryStore._counter, bytes(data))
+      return MemoryStore._counter
+
+  def list(self, prefix: str='') -> List[str]:
+    with self._lock:
+      return sorted(key for key in self.blobs if key.startswith(prefix))
+
+  def delete(self, key: str) -> None:
+    with self._lock:
+      self.blobs.pop(key, None)
+
+
+BACKENDS = {
+  'gcs': GCSStore,
+  'local': LocalStore,
+  'memory': MemoryStore
+}
+
+_stores: Dict[Tuple[str, str], Store] = {}
+_stores_lock = threading.Lock()
+
+def get_store(bucket_name: str, backend: str=None) -> Store:
+  """Get the store for a bucket (one instance per bucket and backend)."""
+  backend = backend or os.getenv('STORAGE-BACKEND', 'gcs')
+  with _stores_lock:
+    if (backend, bucket_name) not in _stores:
+      _stores[(backend, bucket_name)] = BACKENDS[backend](bucket_name)
+    return _stores[(backend, bucket_name)]
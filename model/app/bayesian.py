@@ -1,13 +1,107 @@
 # bayesian.py
 """Bayesian Logistic Regression with Assumed Density Filtering."""
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, Tuple
 
 import numpy as np
 
-from model import Model
+from model import BatchModel
+from state import as_state
 from utils import np_sigmoid
 
-class BayesianLogisticRegressionWithADF(Model):
+METHODS = ('quadrature', 'probit', 'mc')
+
+
+@lru_cache(maxsize=None)
+def hermite_rule(order: int) -> Tuple[np.ndarray, np.ndarray]:
+  """Gauss-Hermite nodes and weights, normalized for N(0, 1/2)."""
+  nodes, weights = np.polynomial.hermite.hermgauss(order)
+  return nodes, weights / np.sqrt(np.pi)
+
+def logistic_gaussian_mean(mean: np.ndarray,
+                           var: np.ndarray,
+                           method: str='quadrature',
+                           order: int=16,
+                           samples: int=10000,
+                           rng: np.random.Generator=None) -> np.ndarray:
+  """Compute E[sigmoid(s)] for s ~ N(mean, var), element-wise.
+
+  method:
+    quadrature: Gauss-Hermite quadrature with the given order.
+    probit: sigmoid(mean / sqrt(1 + pi * var / 8)).
+    mc: Monte Carlo estimate with the given number of samples, drawn
+      from rng (default: a new unseeded generator).
+  """
+  mean = np.asarray(mean, dtype=np.float64)
+  var = np.asarray(var, dtype=np.float64)
+  if method == 'probit':
+    return np_sigmoid(mean / np.sqrt(1 + np.pi * var / 8))
+
+  s = _abscissae(mean, var, method, order, samples, rng)
+  if method == 'mc':
+    return np.mean(np_sigmoid(s), axis=-1)
+  _, weights = hermite_rule(order)
+  return np_sigmoid(s) @ weights
+
+def logistic_gaussian_moments(mean: np.ndarray,
+                              var: np.ndarray,
+                              result: np.ndarray,
+                              method: str='quadrature',
+                              order: int=16,
+                              samples: int=10000,
+                              rng: np.random.Generator=None
+                              ) -> Tuple[np.ndarray, np.ndarray]:
+  """Posterior mean and variance of the log-odds s after observing a game.
+
+  The prior is s ~ N(mean, var) and the likelihood is sigmoid(s) if the
+  home team won (result = 1) and sigmoid(-s) otherwise. All arguments
+  broadcast element-wise. See logistic_gaussian_mean for method.
+  """
+  mean = np.asarray(mean, dtype=np.float64)
+  var = np.asarray(var, dtype=np.float64)
+  y = 2 * np.asarray(result, dtype=np.float64) - 1
+
+  if method == 'probit':
+    # moments from derivatives of log Z where Z ~= sigmoid(y * kappa * mean)
+    kappa = 1 / np.sqrt(1 + np.pi * var / 8)
+    q = 1 - np_sigmoid(y * kappa * mean)
+    d_mean = y * kappa * q
+    d_var = -y * mean * q * (np.pi / 16) * kappa ** 3
+    post_mean = mean + var * d_mean
+    post_var = var - var ** 2 * (d_mean ** 2 - 2 * d_var)
+    return post_mean, post_var
+
+  s = _abscissae(mean, var, method, order, samples, rng)
+  if method == 'mc':
+    weights = np.full(samples, 1 / samples)
+  else:
+    _, weights = hermite_rule(order)
+  likelihood = np_sigmoid(y[..., np.newaxis] * s) * weights
+
+  z = np.sum(likelihood, axis=-1)
+  post_mean = np.sum(s * likelihood, axis=-1) / z
+  post_var = np.sum((s - post_mean[..., np.newaxis]) ** 2 * likelihood, axis=-1) / z
+  return post_mean, post_var
+
+def _abscissae(mean: np.ndarray,
+               var: np.ndarray,
+               method: str,
+               order: int,
+               samples: int,
+               rng: np.random.Generator=None) -> np.ndarray:
+  """Points at which to evaluate the integrand, shape mean.shape + (m,)."""
+  if method == 'mc':
+    if rng is None:
+      rng = np.random.default_rng()
+    z = rng.standard_normal((*mean.shape, samples))
+    return z * np.sqrt(var)[..., np.newaxis] + mean[..., np.newaxis]
+  elif method == 'quadrature':
+    nodes, _ = hermite_rule(order)
+    return nodes * np.sqrt(2 * var)[..., np.newaxis] + mean[..., np.newaxis]
+  raise ValueError(f"Unknown method: {method}")
+
+
+class BayesianLogisticRegressionWithADF(BatchModel):
   """Bayesian Logistic Regression with Assumed Density Filtering.
 
   See math.md for details.
@@ -18,71 +112,138 @@ class BayesianLogisticRegressionWithADF(Model):
     mu: array of team ratings means.
     var: array of team rating variances.
     k: transition variance.
+
+  The logistic-Gaussian integrals are computed with Gauss-Hermite
+  quadrature of the given order by default. method='probit' uses the
+  closed-form probit approximation instead (fastest, but least accurate
+  for surprising results) and method='mc' uses a Monte Carlo estimate
+  with the given number of samples (reference mode). Its draws come
+  from the rng passed to each method, so that concurrent requests don't
+  share random state.
   """
-  def __init__(self, params: Dict) -> None:
-    self.params = params
 
-  def predict_proba(self, game: Dict) -> float:
+  def __init__(self,
+               params: Dict,
+               method: str='quadrature',
+               order: int=16,
+               samples: int=10000) -> None:
+    if method not in METHODS:
+      raise ValueError(f"Unknown method: {method}")
+    self.params = as_state(params)
+    self.method = method
+    self.order = order
+    self.samples = samples
+
+  def predict_proba(self, game: Dict, rng: np.random.Generator=None) -> float:
     """Predict probability that home team wins.
 
     Uses posterior predictive.
     """
     h = self.params['map'][game['home']]
     v = self.params['map'][game['visitor']]
-
-    mu_h = self.params['mu'][h]
-    mu_v = self.params['mu'][v]
-    var_h = self.params['var'][h]
-    var_v = self.params['var'][v]
-
-    # compute mean and variance of log-odds
-    s_mean = self.params['a'] * (mu_h - mu_v) + self.params['b']
-    s_var = (self.params['a'] ** 2) * (var_h + var_v)
-
-    # sample log-odds and return monte-carlo estimate of posterior predictive
-    s = np.random.randn(10000) * s_var + s_mean
-    likelihood = np_sigmoid(s)
-    return np.mean(likelihood)
-
-  def step(self, game: Dict, result: float) -> None:
-    """Perform a single step of SGD."""
+    return self.predict_proba_index(h, v, rng)
+
+  def predict_proba_index(self,
+                          home: int,
+                          visitor: int,
+                          rng: np.random.Generator=None) -> float:
+    """Posterior predictive probability that home team wins, given team indices."""
+    return float(self.predict_proba_batch(self.params, home, visitor, rng))
+
+  def predict_matrix(self, rng: np.random.Generator=None) -> np.ndarray:
+    """Posterior predictive probability that the home team wins, for
+    every pair of teams."""
+    mu = np.asarray(self.params['mu'], dtype=np.float64)
+    var = np.asarray(self.params['var'], dtype=np.float64)
+    s_mean = self.params['a'] * (mu[:, np.newaxis] - mu[np.newaxis, :]) + self.params['b']
+    s_var = (self.params['a'] ** 2) * (var[:, np.newaxis] + var[np.newaxis, :])
+    return logistic_gaussian_mean(
+      s_mean, s_var, self.method, self.order, self.samples, rng
+    )
+
+  def step(self, game: Dict, result: float, rng: np.random.Generator=None) -> None:
+    """Perform a single step of ADF."""
     # get indices for home and visitor
     h = self.params['map'][game['home']]
     v = self.params['map'][game['visitor']]
-
+    self.step_index(h, v, result, rng)
+
+  def step_index(self,
+                 home: int,
+                 visitor: int,
+                 result: float,
+                 rng: np.random.Generator=None) -> None:
+    """Perform a single step of ADF, given team indices."""
+    mu, var = self._update(self.params, home, visitor, result, rng)
+    self.params['mu'][home], self.params['mu'][visitor] = float(mu[0]), float(mu[1])
+    self.params['var'][home], self.params['var'][visitor] = float(var[0]), float(var[1])
+
+  def init_batch(self, n: int) -> Dict[str, np.ndarray]:
+    """Replicate team rating distributions n times."""
+    mu = np.asarray(self.params['mu'], dtype=np.float64)
+    var = np.asarray(self.params['var'], dtype=np.float64)
+    return {
+      'mu': np.repeat(mu[:, np.newaxis], n, axis=1),
+      'var': np.repeat(var[:, np.newaxis], n, axis=1)
+    }
+
+  def predict_proba_batch(self,
+                          state: Dict[str, np.ndarray],
+                          home: int,
+                          visitor: int,
+                          rng: np.random.Generator=None) -> np.ndarray:
+    """Posterior predictive probability that home team wins in each replica."""
+    # compute mean and variance of log-odds
+    s_mean = self.params['a'] * (state['mu'][home] - state['mu'][visitor])
+    s_mean = s_mean + self.params['b']
+    s_var = (self.params['a'] ** 2) * (state['var'][home] + state['var'][visitor])
+    return logistic_gaussian_mean(
+      s_mean, s_var, self.method, self.order, self.samples, rng
+    )
+
+  def step_batch(self,
+                 state: Dict[str, np.ndarray],
+                 home: int,
+                 visitor: int,
+                 result: np.ndarray,
+                 p: np.ndarray=None,
+                 rng: np.random.Generator=None) -> None:
+    """Perform a single step of ADF in each replica."""
+    mu, var = self._update(state, home, visitor, result, rng)
+    state['mu'][home], state['mu'][visitor] = mu
+    state['var'][home], state['var'][visitor] = var
+
+  def _update(self,
+              state: Dict,
+              h: int,
+              v: int,
+              result,
+              rng: np.random.Generator=None) -> Tuple:
+    """Compute updated (mu_h, mu_v), (var_h, var_v) after a game."""
     # compute posterior parameters according to state transition
     # f(theta_t) = \int f(theta_t | theta_{t-1}) f(theta_{t-1}) dtheta_{t-1}
     # where f(theta_t | theta_{t-1}) = N(theta_t | theta_{t-1}, k)
-    mu_h = self.params['mu'][h]
-    mu_v = self.params['mu'][v]
-    var_h = self.params['var'][h] + self.params['k']
-    var_v = self.params['var'][v] + self.params['k']
+    a = self.params['a']
+    mu_h = np.asarray(state['mu'][h], dtype=np.float64)
+    mu_v = np.asarray(state['mu'][v], dtype=np.float64)
+    var_h = state['var'][h] + self.params['k']
+    var_v = state['var'][v] + self.params['k']
 
     # compute mean and variance of log odds s for the likelihood
-    s_mean = self.params['a'] * (mu_h - mu_v) + self.params['b']
-    s_var = (self.params['a'] ** 2) * (var_h + var_v)
-
-    # sample log-odds
-    s = np.random.randn(10000) * s_var + s_mean
-
-    # use monte-carlo to 
-    # estimate posterior mean and variance of log-odds
-    p = np_sigmoid(s)
-    likelihood = p ** result + (1 - p) ** (1 - result)
-
-    z = np.mean(likelihood)
-    post_s_mean = np.mean(s * likelihood) / z
-    post_s_var = np.mean((s ** 2) * likelihood) / z - (post_s_mean ** 2)
+    s_mean = a * (mu_h - mu_v) + self.params['b']
+    s_var = (a ** 2) * (var_h + var_v)
 
+    # posterior mean and variance of log-odds
+    post_s_mean, post_s_var = logistic_gaussian_moments(
+      s_mean, s_var, result, self.method, self.order, self.samples, rng
+    )
     delta_mean = post_s_mean - s_mean
     delta_var = post_s_var - s_var
 
     # update model parameters (eq 18.126 - 18.129)
-    denom = self.params['a'] *  (var_h ** 2 + var_v ** 2)
+    denom = a * (var_h + var_v)
     a_h = var_h / denom
     a_v = - var_v / denom
-    self.params['mu'][h] = mu_h + a_h * delta_mean
-    self.params['mu'][v] = mu_v + a_v * delta_mean
-    self.params['var'][h] = var_h + (a_h ** 2) * delta_var
-    self.params['var'][v] = var_v + (a_v ** 2) * delta_var
-    return
+    mu = (mu_h + a_h * delta_mean, mu_v + a_v * delta_mean)
+    var = (var_h + (a_h ** 2) * delta_var, var_v + (a_v ** 2) * delta_var)
+    return mu, var
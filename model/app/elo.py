@@ -3,8 +3,11 @@
 from typing import Dict
 # from dataclasses import dataclass
 
-from model import Model
-from utils import sigmoid
+import numpy as np
+
+from model import BatchModel
+from state import as_state
+from utils import sigmoid, np_sigmoid
 
 # @dataclass
 # class ELOParams():
@@ -15,7 +18,7 @@ from utils import sigmoid
 #   rating: Dict[str, float]
 
 
-class ELO(Model):
+class ELO(BatchModel):
   """Simple Elo Model.
 
   Online logistic regression model for paired comparison of teams.
@@ -26,22 +29,105 @@ class ELO(Model):
     ratings: array of team ratings.
     k: learning rate.
   """
+
   def __init__(self, params: Dict) -> None:
-    self.params = params
+    self.params = as_state(params)
 
-  def predict_proba(self, game: Dict) -> float:
+  def predict_proba(self, game: Dict, rng: np.random.Generator=None) -> float:
     """Predict probability that home team wins."""
     home = self.params['map'][game['home']]
     visitor = self.params['map'][game['visitor']]
+    return self.predict_proba_index(home, visitor)
+
+  def predict_proba_index(self,
+                          home: int,
+                          visitor: int,
+                          rng: np.random.Generator=None) -> float:
+    """Predict probability that home team wins, given team indices."""
     diff = self.params['rating'][home] - self.params['rating'][visitor]
     logit = self.params['a'] * diff
     logit += self.params['b']
     return sigmoid(logit)
 
-  def step(self, game: Dict, result: float) -> None:
+  def predict_matrix(self, rng: np.random.Generator=None) -> np.ndarray:
+    """Probability that the home team wins, for every pair of teams."""
+    rating = np.asarray(self.params['rating'], dtype=np.float64)
+    logit = self.params['a'] * (rating[:, np.newaxis] - rating[np.newaxis, :])
+    logit += self.params['b']
+    return np_sigmoid(logit)
+
+  def step(self, game: Dict, result: float, rng: np.random.Generator=None) -> None:
     """Perform a single step of SGD."""
-    p = self.predict_proba(game)
     home = self.params['map'][game['home']]
     visitor = self.params['map'][game['visitor']]
+    self.step_index(home, visitor, result)
+
+  def step_index(self,
+                 home: int,
+                 visitor: int,
+                 result: float,
+                 rng: np.random.Generator=None) -> None:
+    """Perform a single step of SGD, given team indices."""
+    p = self.predict_proba_index(home, visitor)
     self.params['rating'][home] += self.params['k'] * (result - p)
     self.params['rating'][visitor] += self.params['k'] * (p - result)
+
+  def train_batch(self,
+                  home: np.ndarray,
+                  visitor: np.ndarray,
+                  result: np.ndarray,
+                  day: np.ndarray=None,
+                  rng: np.random.Generator=None) -> np.ndarray:
+    """Train the model with games given as arrays (see Model.train_batch).
+
+    SGD is inherently sequential, so this runs the same recursion as
+    step_index over a list of floats, without the per-game ModelState
+    and numpy scalar overhead. The arithmetic is the same, so the ratings
+    are identical to training game by game.
+    """
+    a = float(self.params['a'])
+    b = float(self.params['b'])
+    k = float(self.params['k'])
+    rating = np.asarray(self.params['rating'], dtype=np.float64).tolist()
+    p = []
+    for h, v, r in zip(np.asarray(home).tolist(),
+                       np.asarray(visitor).tolist(),
+                       np.asarray(result, dtype=np.float64).tolist()):
+      logit = a * (rating[h] - rating[v])
+      logit += b
+      p_game = sigmoid(logit)
+      rating[h] += k * (r - p_game)
+      rating[v] += k * (p_game - r)
+      p.append(p_game)
+    self.params['rating'][:] = rating
+    return np.array(p)
+
+  def init_batch(self, n: int) -> Dict[str, np.ndarray]:
+    """Replicate ratings n times (one row per team, one column per replica)."""
+    rating = np.asarray(self.params['rating'], dtype=np.float64)
+    return {'rating': np.repeat(rating[:, np.newaxis], n, axis=1)}
+
+  def predict_proba_batch(self,
+                          state: Dict[str, np.ndarray],
+                          home: int,
+                          visitor: int,
+                          rng: np.random.Generator=None) -> np.ndarray:
+    """Predict probability that home team wins in each replica."""
+    diff = state['rating'][home] - state['rating'][visitor]
+    logit = self.params['a'] * diff
+    logit += self.params['b']
+    return np_sigmoid(logit)
+
+  def step_batch(self,
+                 state: Dict[str, np.ndarray],
+                 home: int,
+                 visitor: int,
+                 result: np.ndarray,
+                 p: np.ndarray=None,
+                 rng: np.random.Generator=None) -> None:
+    """Perform a single step of SGD in each replica."""
+    if p is None:
+      p = self.predict_proba_batch(state, home, visitor)
+    delta = self.params['k'] * (result - p)
+    state['rating'][home] += delta
+    state['rating'][visitor] -= delta
@@ -1,14 +1,111 @@
 # forecast.py
 """Define Forecaster module."""
+import multiprocessing
+import os
+import threading
 import numpy as np
-import random
-from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterator, List, Dict, Tuple
 from copy import deepcopy
 
-from model import Model
+from model import Model, BatchModel
 
 
-random.seed(42)
+# simulations are split into blocks of at most BLOCK_SIZE replicas, each
+# with its own random stream spawned from the forecast seed. blocks are
+# the unit of work for parallel forecasts, so results for a given seed do
+# not depend on the number of workers.
+BLOCK_SIZE = 5000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def default_workers() -> int:
+  """Number of forecast worker processes, from FORECAST-WORKERS (default 1)."""
+  return int(os.getenv('FORECAST-WORKERS', 1))
+
+def max_workers() -> int:
+  """Most worker processes a forecast may use: FORECAST-WORKERS, at most
+  the number of CPUs."""
+  return max(1, min(default_workers(), os.cpu_count() or 1))
+
+def get_pool() -> ProcessPoolExecutor:
+  """Get the persistent forecast process pool of max_workers() processes.
+
+  The pool is shared by all requests, created on first use and never
+  replaced. Processes are spawned rather than forked since the service
+  runs threaded.
+  """
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = ProcessPoolExecutor(max_workers(), mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+def simulation_blocks(n: int,
+                      seed: int,
+                      block_size: int=BLOCK_SIZE) -> List[Tuple[int, np.random.SeedSequence]]:
+  """Split n simulations into (size, seed sequence) blocks."""
+  sizes = [block_size] * (n // block_size)
+  if n % block_size:
+    sizes.append(n % block_size)
+  return list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+
+def run_sharded(fn: Callable,
+                args: Tuple,
+                blocks: List[Tuple[int, np.random.SeedSequence]],
+                workers: int=None) -> List[Any]:
+  """Call fn(*args, shard) for shards of blocks, in parallel if workers > 1.
+
+  workers is clamped to max_workers(). Returns the list of results, one
+  per shard.
+  """
+  workers = max_workers() if workers is None else int(workers)
+  workers = max(1, min(workers, max_workers(), len(blocks)))
+  if workers == 1:
+    return [fn(*args, blocks)]
+
+  pool = get_pool()
+  futures = [pool.submit(fn, *args, blocks[i::workers]) for i in range(workers)]
+  return [future.result() for future in futures]
+
+def _simulate_blocks(model: BatchModel,
+                     home: np.ndarray,
+                     visitor: np.ndarray,
+                     blocks: List[Tuple[int, np.random.SeedSequence]]) -> np.ndarray:
+  """Simulate the given blocks. Runs in forecast worker processes."""
+  forecaster = Forecaster(model)
+  wins = np.zeros(len(home), dtype=np.int64)
+  for size, seed_seq in blocks:
+    rng = np.random.default_rng(seed_seq)
+    wins += forecaster.simulate_indices(home, visitor, size, rng)
+  return wins
+
+def _simulate_moment_blocks(model: BatchModel,
+                            home: np.ndarray,
+                            visitor: np.ndarray,
+                            antithetic: bool,
+                            rao_blackwell: bool,
+                            blocks: List[Tuple[int, np.random.SeedSequence]]
+                            ) -> Tuple[np.ndarray, int]:
+  """Simulate the given blocks with simulate_moments and add up the moments."""
+  forecaster = Forecaster(model)
+  moments = np.zeros((2, len(home)))
+  units = 0
+  for size, seed_seq in blocks:
+    rng = np.random.default_rng(seed_seq)
+    block_moments, block_units = forecaster.simulate_moments(
+      home, visitor, size, rng, antithetic, rao_blackwell
+    )
+    moments += block_moments
+    units += block_units
+  return moments, units
+
+def estimate(moments: np.ndarray, units: int) -> Tuple[np.ndarray, np.ndarray]:
+  """Probabilities and their standard errors from simulate_moments sums."""
+  mean = moments[0] / units
+  var = np.maximum(moments[1] - units * mean ** 2, 0) / max(units - 1, 1)
+  return mean, np.sqrt(var / units)
 
 class Forecaster():
   """Forecast.
@@ -20,23 +117,26 @@ class Forecaster():
     """Init."""
     self.model = model
 
-  def simulate_game(self, game: Dict) -> int:
+  def simulate_game(self, game: Dict, rng: np.random.Generator) -> int:
     """Simulate game by sampling Bernoulli RV.
-    
+
     Returns:
     --------
     1 if home team wins,
     0 if visitor wins.
     """
-    p = self.model.predict_proba(game)
-    return int(random.uniform(0, 1) <= p)
+    p = self.model.predict_proba(game, rng)
+    return int(rng.random() <= p)
 
-  def simulate_schedule(self, schedule: List[Dict]) -> np.ndarray:
+  def simulate_schedule(self,
+                        schedule: List[Dict],
+                        rng: np.random.Generator) -> np.ndarray:
     """Simulate schedule.
 
     Args:
     -----
     schedule: chronologically ordered list of games.
+    rng: random generator for the game results (and the model).
 
     Returns:
     --------
@@ -45,24 +145,229 @@ class Forecaster():
     results = []
 
     for game in schedule:
-      result = self.simulate_game(game)
-      self.model.step(game, result)
+      result = self.simulate_game(game, rng)
+      self.model.step(game, result, rng)
       results.append(result)
 
     return np.array(results)
 
-  def forecast(self, schedule: List[Dict], n: int=1000) -> np.ndarray:
+  def simulate_batch(self,
+                     schedule: List[Dict],
+                     n: int,
+                     rng: np.random.Generator=None) -> np.ndarray:
+    """Simulate schedule n times at once.
+
+    All n replicas of the model state are held in one array and each game
+    is simulated with a single vectorized predict / sample / update step
+    across the replicas. Requires a BatchModel.
+
+    Returns:
+    --------
+    An array with the number of simulations in which the home team won
+    each game (same order as schedule).
+    """
+    home, visitor = self.model.team_indices(schedule)
+    return self.simulate_indices(home, visitor, n, rng)
+
+  def simulate_indices(self,
+                       home: np.ndarray,
+                       visitor: np.ndarray,
+                       n: int,
+                       rng: np.random.Generator=None,
+                       team_wins: np.ndarray=None) -> np.ndarray:
+    """Same as simulate_batch with the schedule given as team index arrays.
+
+    If team_wins (shape (number of teams, n)) is given, the wins of each
+    team in each simulation are added to it.
+    """
+    if rng is None:
+      rng = np.random.default_rng()
+    state = self.model.init_batch(n)
+    wins = np.zeros(len(home), dtype=np.int64)
+
+    for i, (h, v) in enumerate(zip(home, visitor)):
+      p = self.model.predict_proba_batch(state, h, v, rng)
+      result = rng.random(n) <= p
+      self.model.step_batch(state, h, v, result, p, rng)
+      wins[i] = np.count_nonzero(result)
+      if team_wins is not None:
+        team_wins[h] += result
+        team_wins[v] += ~result
+
+    return wins
+
+  def simulate_moments(self,
+                       home: np.ndarray,
+                       visitor: np.ndarray,
+                       n: int,
+                       rng: np.random.Generator=None,
+                       antithetic: bool=False,
+                       rao_blackwell: bool=False) -> Tuple[np.ndarray, int]:
+    """Simulate schedule n times with optional variance reduction.
+
+    Each independent unit (a replica, or with antithetic=True a pair of
+    replicas) gives an unbiased estimate x of the probability that the
+    home team wins each game:
+
+      plain: the simulated result of the game.
+      rao_blackwell: the model's probability for the game given the
+        replica's state, i.e. the expected result instead of a draw
+        from it.
+      antithetic: the two replicas of a pair use uniforms u and 1 - u
+        for every game, and x is the mean of the pair.
+
+    Returns:
+    --------
+    Array of shape (2, number of games) with the sums of x and x ** 2
+    over the units, and the number of units (see estimate).
+    """
+    if rng is None:
+      rng = np.random.default_rng()
+    if antithetic and n % 2:
+      raise ValueError("antithetic simulation needs an even n")
+    half = n // 2
+    state = self.model.init_batch(n)
+    moments = np.zeros((2, len(home)))
+
+    for i, (h, v) in enumerate(zip(home, visitor)):
+      p = self.model.predict_proba_batch(state, h, v, rng)
+      if antithetic:
+        u = rng.random(half)
+        u = np.concatenate([u, 1 - u])
+      else:
+        u = rng.random(n)
+      result = u <= p
+      self.model.step_batch(state, h, v, result, p, rng)
+
+      x = p if rao_blackwell else result.astype(np.float64)
+      if antithetic:
+        x = (x[:half] + x[half:]) / 2
+      moments[0, i] = x.sum()
+      moments[1, i] = np.dot(x, x)
+
+    return moments, (half if antithetic else n)
+
+  def forecast(self,
+               schedule: List[Dict],
+               n: int=1000,
+               seed: int=42,
+               workers: int=None,
+               antithetic: bool=False,
+               rao_blackwell: bool=False) -> np.ndarray:
     """Simulate schedule n times.
 
+    Uses simulate_batch if the model supports it, in which case the
+    simulations are sharded across `workers` processes (default:
+    FORECAST-WORKERS). The result for a given seed is the same for any
+    number of workers. All randomness (game results and the model's, if
+    any) comes from generators seeded by `seed`, so forecasts are
+    reproducible and independent of other concurrent forecasts.
+
+    antithetic and rao_blackwell select variance reduction (see
+    simulate_moments). Forecasts with the same seed and n use the same
+    uniforms for each game and replica (common random numbers), so the
+    difference between two models' forecasts has much less variance than
+    either forecast.
+
     Returns:
     --------
     An array of game result probabilities (same order as schedule).
     """
+    if antithetic or rao_blackwell:
+      update = None
+      for update in self.forecast_stream(schedule, n, seed, BLOCK_SIZE, None, workers,
+                                         antithetic, rao_blackwell):
+        pass
+      return update['forecast']
+
+    if isinstance(self.model, BatchModel):
+      home, visitor = self.model.team_indices(schedule)
+      blocks = simulation_blocks(n, seed)
+      wins = sum(run_sharded(_simulate_blocks, (self.model, home, visitor), blocks, workers))
+      return (wins / n).tolist()
+
+    rng = np.random.default_rng(seed)
     params = deepcopy(self.model.params)
     results = np.zeros(len(schedule))
 
     for i in range(n):
-      results += self.simulate_schedule(schedule)
+      results += self.simulate_schedule(schedule, rng)
       self.model.params = deepcopy(params)
 
     return list(results / n)
+
+  def forecast_stream(self,
+                      schedule: List[Dict],
+                      n: int=1000,
+                      seed: int=42,
+                      every: int=1000,
+                      target_se: float=None,
+                      workers: int=None,
+                      antithetic: bool=False,
+                      rao_blackwell: bool=False) -> Iterator[Dict]:
+    """Simulate schedule up to n times, yielding refined forecasts.
+
+    The simulations run in rounds of `every` simulations (sharded
+    across `workers` as in forecast). After each round the running
+    forecast is yielded, with the standard error of each probability.
+    The forecast stops early once the largest standard error is at most
+    target_se. See simulate_moments for antithetic and rao_blackwell,
+    which reduce the number of simulations needed for a given error.
+
+    Blocks are at most `every` simulations, so for a given seed the
+    results depend on `every` (but not on workers). With `every` a
+    multiple of BLOCK_SIZE they match forecast. With antithetic, n and
+    `every` are rounded up to even numbers.
+
+    Yields:
+    -------
+    Dicts with the number of simulations 'n', the 'forecast', the
+    standard errors 'se', their maximum 'max_se' and 'done' (True for
+    the last update).
+    """
+    if not isinstance(self.model, BatchModel):
+      p = np.array(self.forecast(schedule, n, seed, workers))
+      yield self._update(n, p, np.sqrt(p * (1 - p) / n), True)
+      return
+
+    if antithetic:
+      n += n % 2
+      every += every % 2
+    home, visitor = self.model.team_indices(schedule)
+    block_size = min(every, BLOCK_SIZE)
+    blocks = simulation_blocks(n, seed, block_size)
+    per_round = -(-every // block_size)
+
+    moments = np.zeros((2, len(home)))
+    units = 0
+    m = 0
+    for start in range(0, len(blocks), per_round):
+      round_blocks = blocks[start:start + per_round]
+      shards = run_sharded(
+        _simulate_moment_blocks,
+        (self.model, home, visitor, antithetic, rao_blackwell),
+        round_blocks,
+        workers
+      )
+      for shard_moments, shard_units in shards:
+        moments += shard_moments
+        units += shard_units
+      m += sum(size for size, _ in round_blocks)
+      p, se = estimate(moments, units)
+      update = self._update(m, p, se, start + per_round >= len(blocks))
+      if target_se is not None and update['max_se'] <= target_se:
+        update['done'] = True
+      yield update
+      if update['done']:
+        return
+
+  @staticmethod
+  def _update(m: int, p: np.ndarray, se: np.ndarray, done: bool) -> Dict:
+    """Forecast update after m simulations (see forecast_stream)."""
+    return {
+      'n': m,
+      'forecast': p.tolist(),
+      'se': se.tolist(),
+      'max_se': float(se.max()) if len(se) else 0.0,
+      'done': done
+    }
@@ -0,0 +1,148 @@
+# forecast_cache.py
+"""Cache of forecast responses.
+
+A forecast is determined by the model, the season and version of its
+parameters, the schedule (only the home and visitor teams of each game
+matter) and the options that change the simulation (n, seed, ...). Those make up the
+cache key, so a cached forecast is never stale; invalidate only frees
+entries of parameters that have been replaced. The options are the
+validated ones, with defaults filled in (see forecast_options in
+main.py), so equivalent requests share an entry.
+
+Entries are kept in memory with LRU eviction (FORECAST-CACHE-SIZE
+entries, default 128; 0 disables the cache). If FORECAST-CACHE-BUCKET is
+set, entries are also persisted there, so they survive restarts and are
+shared by all instances of the service.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from store import Version, get_store
+
+
+PREFIX = 'forecasts/'
+
+
+def schedule_hash(schedule: List[Dict]) -> str:
+  """Hash of the teams of each game, independent of other fields."""
+  canonical = json.dumps([[game['home'], game['visitor']] for game in schedule])
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def forecast_key(model_name: str,
+                 version: Version,
+                 season: Optional[int],
+                 schedule: List[Dict],
+                 options: Dict) -> str:
+  """Cache key of a forecast request (see forecast in main.py).
+
+  options are the options that change the result of the forecast
+  (workers doesn't), validated and with defaults filled in.
+  """
+  key = json.dumps(
+    [str(version), season, schedule_hash(schedule), options],
+    sort_keys=True
+  )
+  return f"{model_name.lower()}/{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+
+
+class ForecastCache():
+  """LRU cache of forecast responses keyed by forecast_key.
+
+  Args:
+  -----
+  max_entries: default FORECAST-CACHE-SIZE or 128.
+  bucket_name: bucket to persist entries in, default
+    FORECAST-CACHE-BUCKET. Entries are only kept in memory if neither
+    is set.
+  """
+  def __init__(self, max_entries: int=None, bucket_name: str=None) -> None:
+    if max_entries is None:
+      max_entries = int(os.getenv('FORECAST-CACHE-SIZE', 128))
+    self.max_entries = max_entries
+    bucket_name = bucket_name or os.getenv('FORECAST-CACHE-BUCKET')
+    self.store = get_store(bucket_name) if bucket_name else None
+    self._entries: 'OrderedDict[str, Dict]' = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.store_hits = 0
+    self.misses = 0
+
+  def get(self, key: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """Look up a forecast.
+
+    Returns:
+    --------
+    The cached response data (or None) and where it was found:
+    'memory', 'store' or None.
+    """
+    if self.max_entries <= 0:
+      return None, None
+
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key], 'memory'
+
+    if self.store is not None:
+      try:
+        data = json.loads(self.store.read(PREFIX + key + '.json'))
+      except KeyError:
+        data = None
+      if data is not None:
+        self._insert(key, data)
+        with self._lock:
+          self.store_hits += 1
+        return data, 'store'
+
+    with self._lock:
+      self.misses += 1
+    return None, None
+
+  def put(self, key: str, data: Dict) -> None:
+    """Cache the response data of a forecast."""
+    if self.max_entries <= 0:
+      return
+    self._insert(key, data)
+    if self.store is not None:
+      self.store.write(
+        PREFIX + key + '.json',
+        json.dumps(data).encode('utf-8'),
+        content_type='application/json'
+      )
+
+  def _insert(self, key: str, data: Dict) -> None:
+    with self._lock:
+      self._entries[key] = data
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, model_name: str=None) -> None:
+    """Drop the forecasts of a model (default: all models).
+
+    Called when parameters change: forecasts of older parameter versions
+    can never be hit again.
+    """
+    prefix = '' if model_name is None else model_name.lower() + '/'
+    with self._lock:
+      for key in [key for key in self._entries if key.startswith(prefix)]:
+        del self._entries[key]
+    if self.store is not None:
+      for key in self.store.list(PREFIX + prefix):
+        self.store.delete(key)
+
+  def stats(self) -> Dict:
+    """Cache counters."""
+    with self._lock:
+      return {
+        'entries': len(self._entries),
+        'max_entries': self.max_entries,
+        'hits': self.hits,
+        'store_hits': self.store_hits,
+        'misses': self.misses
+      }
@@ -0,0 +1,104 @@
+# games.py
+"""Columnar table of played games."""
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class GameTable():
+  """Games as parallel arrays, in chronological order.
+
+  Attributes:
+  -----------
+  home: home team indices (int64).
+  visitor: visiting team indices (int64).
+  day: dates (datetime64[D]).
+  result: 1.0 if the home team won, 0.0 otherwise (float64).
+
+  Team indices are given by the team map of the model that will be
+  trained on the table (params['map']).
+  """
+  __slots__ = ('home', 'visitor', 'day', 'result')
+
+  def __init__(self,
+               home: np.ndarray,
+               visitor: np.ndarray,
+               day: np.ndarray,
+               result: np.ndarray) -> None:
+    self.home = np.asarray(home, dtype=np.int64)
+    self.visitor = np.asarray(visitor, dtype=np.int64)
+    self.day = np.asarray(day, dtype='datetime64[D]')
+    self.result = np.asarray(result, dtype=np.float64)
+
+  @classmethod
+  def from_games(cls,
+                 games: List[Dict],
+                 results: List[int],
+                 team_map: Dict[str, int]) -> 'GameTable':
+    """Build a table from game dicts (with 'home', 'visitor' and 'date')."""
+    return cls(
+      [team_map[game['home']] for game in games],
+      [team_map[game['visitor']] for game in games],
+      [game['date'] for game in games],
+      results
+    )
+
+  @classmethod
+  def concatenate(cls, tables: List['GameTable']) -> 'GameTable':
+    """Concatenate tables (e.g. seasons) in the given order."""
+    return cls(*(np.concatenate([getattr(t, col) for t in tables]) for col in cls.__slots__))
+
+  @classmethod
+  def load(cls, path: str) -> 'GameTable':
+    """Load a table saved with save."""
+    with np.load(path) as data:
+      return cls(*(data[col] for col in cls.__slots__))
+
+  def share(self) -> Tuple[SharedMemory, Dict]:
+    """Copy the table into a shared memory block.
+
+    Returns:
+    --------
+    The block, which the caller must close and unlink when done, and a
+    picklable handle that other processes pass to attach.
+    """
+    n = len(self)
+    block = SharedMemory(create=True, size=max(1, 8 * n * len(self.__slots__)))
+    for i, col in enumerate(self.__slots__):
+      column = getattr(self, col)
+      np.ndarray(n, column.dtype, block.buf, offset=8 * n * i)[:] = column
+    return block, {'name': block.name, 'n': n}
+
+  @classmethod
+  def attach(cls, handle: Dict) -> Tuple['GameTable', SharedMemory]:
+    """Map a table shared with share, without copying.
+
+    Returns the table (read-only views of the block) and the block, which
+    must stay open while the table is used.
+    """
+    block = SharedMemory(name=handle['name'])
+    n = handle['n']
+    columns = []
+    for i, dtype in enumerate((np.int64, np.int64, 'datetime64[D]', np.float64)):
+      column = np.ndarray(n, dtype, block.buf, offset=8 * n * i)
+      column.flags.writeable = False
+      columns.append(column)
+    return cls(*columns), block
+
+  def save(self, path: str) -> None:
+    """Save the table as an .npz archive."""
+    with open(path, 'wb') as f:
+      np.savez(f, **{col: getattr(self, col) for col in self.__slots__})
+
+  def __len__(self) -> int:
+    return len(self.home)
+
+  def __getitem__(self, index) -> 'GameTable':
+    """Select rows with a slice, index array or boolean mask."""
+    return GameTable(*(getattr(self, col)[index] for col in self.__slots__))
+
+  def season(self, year: int) -> 'GameTable':
+    """Games played in the given calendar year."""
+    years = self.day.astype('datetime64[Y]').astype(int) + 1970
+    return self[years == year]
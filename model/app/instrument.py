@@ -0,0 +1,236 @@
+# instrument.py
+"""Timing instrumentation and request profiling.
+
+Code paths worth watching are wrapped in spans:
+
+  with span('store.read'):
+    ...
+
+  @timed('train')
+  def train_job(...):
+    ...
+
+Each span name gets a histogram of its durations. install(app) adds a
+histogram of request durations by endpoint, and serves all histograms at
+GET /metrics in the Prometheus text format.
+
+Requests can also be profiled with cProfile. Profiling is off unless
+PROFILE-REQUESTS is set to the fraction of requests to profile (e.g.
+0.01); when it is on, a request with the header 'X-Profile: 1' is always
+profiled. The stats of a profiled request are printed to the log (the
+top PROFILE-TOP functions by cumulative time, default 25) and dumped to
+PROFILE-DIR (default /tmp/profiles) for pstats / snakeviz. One request is
+profiled at a time; others running meanwhile are not.
+
+This file is shared by the services; keep the copies in sync.
+"""
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Tuple
+
+if TYPE_CHECKING:
+  import cProfile
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HELP = {
+  'span_seconds': "Time spent in instrumented code paths.",
+  'http_request_seconds': "Time to handle requests (until the response is returned)."
+}
+
+START_TIME = time.time()
+
+
+class Histogram():
+  """Cumulative-bucket histogram of durations for one label set."""
+  __slots__ = ('counts', 'sum', 'count')
+
+  def __init__(self) -> None:
+    self.counts = [0] * len(BUCKETS)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, seconds: float) -> None:
+    for i, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        self.counts[i] += 1
+    self.sum += seconds
+    self.count += 1
+
+
+class Registry():
+  """Histograms by metric name and labels."""
+  def __init__(self) -> None:
+    self._histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+    self._lock = threading.Lock()
+
+  def observe(self, metric: str, seconds: float, **labels: str) -> None:
+    """Record a duration."""
+    key = (metric, tuple(sorted(labels.items())))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = Histogram()
+      histogram.observe(seconds)
+
+  def summary(self) -> Dict[str, Dict]:
+    """Count, total and mean seconds of each span."""
+    with self._lock:
+      return {
+        dict(labels)['span']: {
+          'count': h.count,
+          'seconds': h.sum,
+          'mean': h.sum / h.count
+        }
+        for (metric, labels), h in sorted(self._histograms.items())
+        if metric == 'span_seconds' and h.count
+      }
+
+  def render(self) -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines: List[str] = []
+    with self._lock:
+      series = sorted(self._histograms.items())
+      metrics = sorted({metric for metric, _ in self._histograms})
+      for metric in metrics:
+        lines.append(f"# HELP {metric} {HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} histogram")
+        for (name, labels), h in series:
+          if name != metric:
+            continue
+          base = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+          sep = ',' if base else ''
+          for bound, count in zip(BUCKETS, h.counts):
+            lines.append(f'{metric}_bucket{{{base}{sep}le="{bound}"}} {count}')
+          lines.append(f'{metric}_bucket{{{base}{sep}le="+Inf"}} {h.count}')
+          lines.append(f'{metric}_sum{{{base}}} {h.sum!r}')
+          lines.append(f'{metric}_count{{{base}}} {h.count}')
+    lines.append("# HELP process_start_time_seconds Start time of the process (unix time).")
+    lines.append("# TYPE process_start_time_seconds gauge")
+    lines.append(f"process_start_time_seconds {START_TIME!r}")
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+  """Time the enclosed block (also if it raises)."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    REGISTRY.observe('span_seconds', time.perf_counter() - start, span=name)
+
+def timed(name: str) -> Callable:
+  """Decorator version of span."""
+  def decorator(f: Callable) -> Callable:
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return f(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+class RequestProfiler():
+  """Opt-in cProfile of sampled requests (see the module docstring).
+
+  cProfile and pstats are only imported once a request is profiled.
+  """
+  def __init__(self) -> None:
+    self.rate = float(os.getenv('PROFILE-REQUESTS', 0))
+    self.directory = os.getenv('PROFILE-DIR', '/tmp/profiles')
+    self.top = int(os.getenv('PROFILE-TOP', 25))
+    self._lock = threading.Lock()
+
+  def start(self, forced: bool) -> 'cProfile.Profile':
+    """Start profiling the current request if it is sampled.
+
+    Returns the profile, or None if the request isn't profiled.
+    """
+    if self.rate <= 0 or not (forced or random.random() < self.rate):
+      return None
+    if not self._lock.acquire(blocking=False):
+      return None
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+      profile.enable()
+    except ValueError:
+      # another profiler is active in this process
+      self._lock.release()
+      return None
+    return profile
+
+  def stop(self, profile: 'cProfile.Profile', label: str) -> str:
+    """Stop profiling, log the top functions and dump the stats.
+
+    Returns the path of the dump.
+    """
+    import io
+    import pstats
+    profile.disable()
+    self._lock.release()
+
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(self.top)
+    print(f"Profile of {label}:\n{out.getvalue()}")
+
+    os.makedirs(self.directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{label.strip('/').replace('/', '_') or 'root'}.prof"
+    path = os.path.join(self.directory, name)
+    stats.dump_stats(path)
+    return path
+
+
+def install(app) -> None:
+  """Time the requests of a Flask app, profile sampled requests and
+  serve GET /metrics."""
+  from flask import Response, g, request
+
+  profiler = RequestProfiler()
+
+  @app.before_request
+  def _start_request() -> None:
+    g.instrument_start = time.perf_counter()
+    g.instrument_profile = profiler.start(request.headers.get('X-Profile') == '1')
+
+  @app.after_request
+  def _end_request(response):
+    start = g.pop('instrument_start', None)
+    if start is not None:
+      REGISTRY.observe(
+        'http_request_seconds',
+        time.perf_counter() - start,
+        endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+        method=request.method,
+        status=str(response.status_code)
+      )
+    profile = g.pop('instrument_profile', None)
+    if profile is not None:
+      response.headers['X-Profile-Path'] = profiler.stop(profile, request.path)
+    return response
+
+  @app.teardown_request
+  def _teardown_request(error) -> None:
+    # the response wasn't finalized (e.g. the client went away)
+    profile = g.pop('instrument_profile', None)
+    if profile is not None:
+      profiler.stop(profile, request.path)
+
+  @app.route("/metrics", methods=['GET'])
+  def metrics():
+    """Prometheus metrics."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
@@ -6,6 +6,13 @@ train: Use results from played games to update model weights.
 
 forecast: generates a forecast of game results.
 
+simulate: simulates the rest of the season to get postseason odds.
+
+predict: home win probabilities of matchups, without simulating.
+
+batch: runs a list of train / forecast / simulate / predict jobs in one
+request.
+
 There is also a method for setting model parameters (e.g., to
 initialize the model at the beginning of a season).
 
@@ -16,22 +23,65 @@ to be used.
 
 Currently, model options are:
 - 'elo'
+- 'bayesian'
+
+Each request may also contain a field 'season' (e.g. 2022): the model
+then uses (and training updates) that season's parameters, which start
+from the unprefixed parameters (see utils.parameters_info). Without a
+season, the unprefixed parameters are used, as before.
+
+Loaded models are cached in memory across requests (see registry.py),
+and so are their win probability matrices and forecasts (see
+forecast_cache.py). The models and numpy are
+imported on first use, so that the service starts (and answers a ping)
+without loading them.
+
+GET /metrics serves request and span timings (see instrument.py).
 """
+import json
 import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify, Response
-from typing import Tuple
+from werkzeug.exceptions import BadRequest
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
 
-from utils import load_parameters, save_parameters
-from elo import ELO
-from forecast import Forecaster
-from model import Model
+from forecast_cache import ForecastCache, forecast_key
+from instrument import install, span
+from store import PreconditionFailed
+from teams import TEAMS
+
+if TYPE_CHECKING:
+  from forecast import Forecaster
+  from model import Model
+  from registry import ModelRegistry
 
 
 app = Flask(__name__)
+install(app)
+
+# attempts of a /train request to save its update if the parameters are
+# saved concurrently (see train_job)
+TRAIN_ATTEMPTS = 3
 
 load_dotenv()
 
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> 'ModelRegistry':
+  """The model registry, created (and the models imported) on first use."""
+  global _registry
+  with _registry_lock:
+    if _registry is None:
+      from registry import ModelRegistry
+      _registry = ModelRegistry()
+    return _registry
+
+forecast_cache = ForecastCache()
+
 @app.route("/", methods=['GET'])
 def ping():
   """For testing purposes."""
@@ -44,31 +94,263 @@ def set_parameters():
   Request should contain json with the following fields:
   - model-name: name of the model whose parameters will be set
   - params: dict of parameters appropriate for given model
+  - season (optional): set the parameters of this season
   """
   data = request.get_json()
 
   model_name = data['model-name']
   params = data['params']
 
-  env_param_name = model_name.upper() + "-BUCKET-NAME"
-  bucket_name = os.getenv(env_param_name)
-  if bucket_name:
-    save_parameters(bucket_name, params)
+  if get_registry().save(model_name, params, get_season(data)):
+    forecast_cache.invalidate(model_name)
     return Response("Success!", status=201, mimetype='text/plain')
 
   return Response("Invalid model name.", status=400, mimetype='text/plain')
 
-def load_model(model_name: str) -> Tuple[Model, str]:
+@app.errorhandler(BadRequest)
+def bad_request(e: BadRequest) -> Response:
+  """Invalid request data (see int_field)."""
+  return Response(e.description, status=400, mimetype='text/plain')
+
+def int_field(data: Dict,
+              field: str,
+              default: Optional[int]=None,
+              minimum: int=None) -> Optional[int]:
+  """An integer field of the request data, default if it is missing.
+
+  Raises BadRequest (a 400 response) if it isn't an integer or is less
+  than minimum.
+  """
+  value = data.get(field)
+  if value is None:
+    return default
+  try:
+    value = int(value)
+  except (TypeError, ValueError):
+    raise BadRequest(f"{field} must be an integer") from None
+  if minimum is not None and value < minimum:
+    raise BadRequest(f"{field} must be at least {minimum}")
+  return value
+
+def float_field(data: Dict, field: str, default: Optional[float]=None) -> Optional[float]:
+  """A number field of the request data, default if it is missing.
+
+  Raises BadRequest (a 400 response) if it isn't a number.
+  """
+  value = data.get(field)
+  if value is None:
+    return default
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    raise BadRequest(f"{field} must be a number") from None
+
+def team_list(data: Dict, field: str) -> Optional[List[str]]:
+  """A list of teams of the request data, or None if it is missing.
+
+  Raises BadRequest (a 400 response) if it isn't a list of strings.
+  """
+  value = data.get(field)
+  if value is None:
+    return None
+  if not isinstance(value, list) or not all(isinstance(team, str) for team in value):
+    raise BadRequest(f"{field} must be a list of teams")
+  return value
+
+def get_season(data: Dict) -> Optional[int]:
+  """The season of the request data, or None."""
+  return int_field(data, 'season')
+
+def load_model(model_name: str, copy: bool=False, season: int=None) -> Tuple['Model', str]:
   """Load model and bucket name using model name.
 
-  Add to this method as new models are added.
+  Add new models to registry.MODELS. Pass copy=True if the model will
+  be modified.
+  """
+  return get_registry().get(model_name, copy=copy, season=season)
+
+@app.route("/stats", methods=['GET'])
+def stats():
+  """Model and forecast cache hit / miss counters."""
+  return jsonify(dict(get_registry().stats(), forecast_cache=forecast_cache.stats()))
+
+def train_job(data: Dict) -> Tuple[Dict, int]:
+  """Train a model. See train for the request data.
+
+  Returns:
+  --------
+  Response data and status code.
+  """
+  import numpy as np
+  from games import GameTable
+
+  model_name = data['model-name']
+  season = get_season(data)
+  seed = int_field(data, 'seed', 42, minimum=0)
+
+  for attempt in range(TRAIN_ATTEMPTS):
+    # select the model to train, and the version it was loaded from
+    m, if_version_match = get_registry().get_for_update(model_name, season)
+    if m is None:
+      return {'error': "Invalid model name"}, 400
+
+    # skip games on or before the last day the parameters were trained
+    # on ('date'), so that a retried update never trains on a result twice
+    trained_through = m.params.extra.get('date') or ''
+    games, results = [], []
+    for game, result in zip(data['games'], data['results']):
+      if game['date'] > trained_through:
+        games.append(game)
+        results.append(result)
+    if not games:
+      return {}, 201
+
+    # train model and save new parameters, unless they were saved since
+    table = GameTable.from_games(games, results, m.params['map'])
+    rng = np.random.default_rng(seed)
+    with span('train'):
+      m.train_batch(table.home, table.visitor, table.result, table.day, rng=rng)
+    m.params.extra['date'] = max(game['date'] for game in games)
+    try:
+      get_registry().save(model_name, m.params, season, if_version_match)
+    except PreconditionFailed:
+      # trained concurrently: train again from the new parameters
+      continue
+    forecast_cache.invalidate(model_name)
+    return {}, 201
+
+  return {'error': "Parameters were updated concurrently"}, 409
+
+def forecast_job(data: Dict) -> Tuple[Dict, int]:
+  """Generate a forecast. See forecast for the request data.
+
+  Forecasts are cached (see forecast_cache.py). The response data has
+  a field 'cache' with 'hit' and, for hits, the 'source' of the entry.
+  """
+  from forecast import Forecaster
+
+  # select the model for forecasting
+  model_name = data['model-name']
+  season = get_season(data)
+  m, bucket_name, version = get_registry().get_with_version(model_name, season=season)
+  if m is None:
+    return {'error': "Invalid model name"}, 400
+
+  # validate before the lookup, so that invalid requests never reach the cache
+  options = forecast_options(data)
+  workers = int_field(data, 'workers', minimum=1)
+  cache_key = forecast_key(model_name, version, season, data['schedule'], options)
+  cached, source = forecast_cache.get(cache_key)
+  if cached is not None:
+    return dict(cached, cache={'hit': True, 'source': source}), 200
+
+  # generate forecast
+  f = Forecaster(m)
+  with span('forecast'):
+    if options['target_se'] is not None or options['antithetic'] or options['rao_blackwell']:
+      for update in f.forecast_stream(data['schedule'], workers=workers, **options):
+        pass
+      result = {key: update[key] for key in ('forecast', 'n', 'se', 'max_se')}
+    else:
+      result = {
+        'forecast': f.forecast(
+          data['schedule'],
+          n=options['n'],
+          seed=options['seed'],
+          workers=workers
+        )
+      }
+
+  forecast_cache.put(cache_key, result)
+  return dict(result, cache={'hit': False}), 200
+
+def forecast_options(data: Dict) -> Dict:
+  """The forecast options of the request data (see forecast), validated
+  and with defaults filled in, as keyword arguments of
+  Forecaster.forecast_stream.
+
+  Raises BadRequest (a 400 response) if an option is invalid.
   """
-  if model_name.upper() == 'ELO':
-    bucket_name = os.getenv("ELO-BUCKET-NAME")
-    params = load_parameters(bucket_name)
-    return ELO(params), bucket_name
-  else:
-    return None, ""
+  target_se = float_field(data, 'target-se')
+  if target_se is not None and not target_se > 0:
+    raise BadRequest("target-se must be positive")
+  return {
+    'n': int_field(data, 'n', 1000, minimum=1),
+    'seed': int_field(data, 'seed', 42, minimum=0),
+    'every': int_field(data, 'every', 1000, minimum=1),
+    'target_se': target_se,
+    'antithetic': bool(data.get('antithetic', False)),
+    'rao_blackwell': bool(data.get('rao-blackwell', False))
+  }
+
+def forecast_updates(f: 'Forecaster', data: Dict) -> Iterator[Dict]:
+  """Streamed forecast updates for the request data (see forecast).
+
+  The request data is validated here, before the first update is
+  computed, so that a streamed response fails before it starts.
+  """
+  return f.forecast_stream(
+    data['schedule'],
+    workers=int_field(data, 'workers', minimum=1),
+    **forecast_options(data)
+  )
+
+def simulate_job(data: Dict) -> Tuple[Dict, int]:
+  """Simulate the rest of the season. See simulate for the request data."""
+  from season import simulate_season
+
+  # select the model for the simulation
+  model_name = data['model-name']
+  m, bucket_name = load_model(model_name, season=get_season(data))
+  if m is None:
+    return {'error': "Invalid model name"}, 400
+
+  with span('simulate'):
+    odds = simulate_season(
+      m,
+      data['schedule'],
+      data['standings'],
+      data['divisions'],
+      data['leagues'],
+      wildcards=int_field(data, 'wildcards', 3, minimum=0),
+      n=int_field(data, 'n', 10000, minimum=1),
+      seed=int_field(data, 'seed', 42, minimum=0),
+      workers=int_field(data, 'workers', minimum=1)
+    )
+  return {'odds': odds}, 200
+
+def predict_job(data: Dict) -> Tuple[Dict, int]:
+  """Matchup probabilities. See predict for the request data."""
+  import numpy as np
+
+  with span('predict'):
+    m, matrix, hit = get_registry().get_matrix(data['model-name'], get_season(data))
+    if m is None:
+      return {'error': "Invalid model name"}, 400
+
+    home = team_list(data, 'home') or TEAMS
+    visitor = team_list(data, 'visitor') or home
+    team_map = m.params['map']
+    unknown = [team for team in home + visitor if team not in team_map]
+    if unknown:
+      return {'error': f"Unknown teams: {', '.join(unknown)}"}, 400
+
+    h = np.array([team_map[team] for team in home], dtype=np.intp)
+    v = np.array([team_map[team] for team in visitor], dtype=np.intp)
+    rows = matrix[np.ix_(h, v)].tolist()
+    # a team doesn't play itself
+    for i, j in zip(*np.nonzero(h[:, np.newaxis] == v[np.newaxis, :])):
+      rows[i][j] = None
+
+  return {'home': home, 'visitor': visitor, 'matrix': rows, 'cache': {'hit': hit}}, 200
+
+# op name -> job function, for /batch
+JOBS = {
+  'train': train_job,
+  'forecast': forecast_job,
+  'simulate': simulate_job,
+  'predict': predict_job
+}
 
 @app.route("/train", methods=['POST'])
 def train():
@@ -81,19 +363,19 @@ def train():
   - games: a list of dicts. each dict must include
     home, visitor, and date.
   - results: a list of ints of the same length as games.
-  """
-  # unpack request data
-  data = request.get_json()
-
-  # select the model to train
-  model_name = data['model-name']
-  m, bucket_name = load_model(model_name)
-  if m is None:
-    Response("Invalid model name", status=400, mimetype='text/plain')
+    Games on or before the 'date' of the parameters (the last
+    day the model was trained on) are skipped, so whole days
+    of games can be sent again safely.
+  - seed (optional): random seed for models that train with
+    Monte Carlo integration, default 42.
+  - season (optional): train the parameters of this season.
 
-  # train model and save new parameters
-  m.train(data['games'], data['results'])
-  save_parameters(bucket_name, m.params)
+  Concurrent updates of the same parameters are trained one after
+  the other; the response is 409 if the parameters keep changing.
+  """
+  data, status = train_job(request.get_json())
+  if status != 201:
+    return Response(data['error'], status=status, mimetype='text/plain')
 
   return Response("Success!", status=201, mimetype='text/plain')
 
@@ -104,30 +386,157 @@ def forecast():
   Expects the request to contain one list:
 
   model-name: 
+  season (optional): forecast with this season's parameters.
   schedule: a list of games yet to be played,
     in chronological order, where each game
     is represented as a dict with keys such as
     'home', 'visitor', and 'date'.
+  n (optional): number of simulations, default 1000.
+  seed (optional): random seed, default 42.
+  workers (optional): number of worker processes to shard the
+    simulations across, default and at most FORECAST-WORKERS (and
+    the number of CPUs).
+  target-se (optional): stop simulating once the standard error
+    of every probability is at most this (n is then the maximum).
+  every (optional): simulations per round when streaming or
+    stopping early, default 1000.
+  antithetic (optional): if true, use antithetic variates.
+  rao-blackwell (optional): if true, average the model's
+    probabilities instead of simulated results. Both reduce
+    the number of simulations needed for a given target-se
+    (see Forecaster.simulate_moments).
+  stream (optional): if true, respond with NDJSON: one line per
+    round with the running 'forecast', number of simulations 'n',
+    standard errors 'se' and 'max_se', and 'done'.
 
   The response contains a list of probabilities that
   the home team won each game in the schedule. The
   order of the probabilities is the same as the order
-  of the schedule.
+  of the schedule. With target-se, antithetic or
+  rao-blackwell, it also contains the number of
+  simulations used 'n' and the achieved standard errors
+  'se' and 'max_se'.
   """
   data = request.get_json()
+  if data.get('stream'):
+    from forecast import Forecaster
+    m, bucket_name = load_model(data['model-name'], season=get_season(data))
+    if m is None:
+      return Response("Invalid model name", status=400, mimetype='text/plain')
+    updates = forecast_updates(Forecaster(m), data)
+    return Response(
+      (json.dumps(update) + '\n' for update in updates),
+      mimetype='application/x-ndjson'
+    )
 
-  # select the model for forecasting
-  model_name = data['model-name']
-  m, bucket_name = load_model(model_name)
-  if m is None:
-    Response("Invalid model name", status=400, mimetype='application/json')
+  data, status = forecast_job(data)
+  if status != 200:
+    return Response(data['error'], status=status, mimetype='text/plain')
 
-  # generate forecast
-  f = Forecaster(m)
-  results = f.forecast(data['schedule'])
- 
   # package forecast and return 
-  return jsonify({'forecast': results})
+  return jsonify(data)
+
+@app.route("/simulate", methods=['POST'])
+def simulate():
+  """Simulate the rest of the season.
+
+  Expects the request to contain:
+
+  model-name:
+  season (optional): simulate with this season's parameters.
+  schedule: a list of the remaining games of the season,
+    in chronological order (see forecast).
+  standings: dict of team -> current number of wins.
+  divisions: dict of division name -> list of teams.
+  leagues: dict of league name -> list of division names.
+  wildcards (optional): wild card teams per league, default 3.
+  n (optional): number of simulations, default 10000.
+  seed (optional): random seed, default 42.
+  workers (optional): see forecast.
+
+  The response contains a dict 'odds' of team -> postseason odds
+  (see season.simulate_season).
+  """
+  data, status = simulate_job(request.get_json())
+  if status != 200:
+    return Response(data['error'], status=status, mimetype='text/plain')
+
+  return jsonify(data)
+
+@app.route("/predict", methods=['POST'])
+def predict():
+  """Home win probabilities of matchups.
+
+  Expects the request to contain:
+
+  model-name:
+  season (optional): use this season's parameters.
+  home (optional): list of home teams, default all teams (teams.TEAMS).
+  visitor (optional): list of visiting teams, default home.
+
+  The probabilities come from the model's current parameters, without
+  simulation (see Model.predict_matrix): sigmoid(a * (r_h - r_v) + b)
+  for ELO and the posterior predictive for the bayesian model. The
+  matrix of all teams is computed once per version of the parameters
+  and cached, so a request only selects from it.
+
+  The response contains 'home', 'visitor' and a 'matrix' with a row per
+  home team and a column per visiting team: the probability that the
+  home team wins, or null if both are the same team. 'cache' has 'hit'.
+  """
+  data, status = predict_job(request.get_json())
+  if status != 200:
+    return Response(data['error'], status=status, mimetype='text/plain')
+
+  return jsonify(data)
+
+@app.route("/batch", methods=['POST'])
+def batch():
+  """Run several jobs in one request.
+
+  Expects the request to contain:
+
+  jobs: a list of jobs. Each job is a dict with a field 'op'
+    ('train', 'forecast', 'simulate' or 'predict') and the same fields as a
+    request to the endpoint of that name, including 'model-name'.
+
+  Jobs for the same model run in order (e.g., a forecast after a train
+  uses the trained parameters). Jobs for different models run
+  concurrently.
+
+  The response contains a list 'results' with one dict per job, in the
+  order of the jobs: the response data of the job (e.g., 'forecast')
+  and its 'status' code, or an 'error' message.
+  """
+  jobs = request.get_json()['jobs']
+
+  # group jobs by model, keeping their order
+  groups = defaultdict(list)
+  for i, job in enumerate(jobs):
+    groups[str(job.get('model-name', '')).lower()].append(i)
+
+  results = [None] * len(jobs)
+  def run_jobs(indices: List[int]) -> None:
+    for i in indices:
+      job = jobs[i]
+      if job.get('op') not in JOBS:
+        results[i] = {'error': f"Invalid op: {job.get('op')}", 'status': 400}
+        continue
+      try:
+        data, status = JOBS[job['op']](job)
+      except KeyError as e:
+        data, status = {'error': f"Missing field: {e}"}, 400
+      except BadRequest as e:
+        data, status = {'error': e.description}, 400
+      except Exception as e:
+        data, status = {'error': repr(e)}, 500
+      results[i] = dict(data, status=status)
+
+  if groups:
+    with ThreadPoolExecutor(len(groups)) as executor:
+      list(executor.map(run_jobs, groups.values()))
+
+  return jsonify({'results': results})
 
 if __name__ == "__main__":
   app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
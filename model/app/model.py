@@ -1,8 +1,10 @@
 # model.py
 """Define Model abstract base class."""
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 
 class Model(ABC):
   """Model abstract base class.
@@ -10,18 +12,170 @@ class Model(ABC):
   Represents a model that predicts win probabilities
   for individual games and has an online learning
   algorithm (implemented by step).
+
+  predict_proba_index and step_index are the same operations on team
+  indices (see params['map']); train_batch uses them to train on games
+  given as arrays (see games.GameTable). By default they call
+  predict_proba and step.
+
+  Models that also implement the batch interface subclass BatchModel.
+
+  Methods that take an rng use it for any randomness of the model (e.g.
+  Monte Carlo integration), so that results are reproducible for a given
+  seed and concurrent requests don't share random state. Deterministic
+  models ignore it.
   """
+
   @abstractmethod
-  def predict_proba(self, game: Dict) -> float:
+  def predict_proba(self, game: Dict, rng: np.random.Generator=None) -> float:
     """Predict probability that home team wins."""
     pass
 
   @abstractmethod
-  def step(self, game: Dict, result: float) -> None:
+  def step(self, game: Dict, result: float, rng: np.random.Generator=None) -> None:
     """Perform single step parameter update."""
     pass
 
-  def train(self, schedule: List[Dict], results: List[float]) -> None:
+  def predict_proba_index(self,
+                          home: int,
+                          visitor: int,
+                          rng: np.random.Generator=None) -> float:
+    """Predict probability that home team wins, given team indices.
+
+    Defaults to predict_proba; models override it to skip the lookups.
+    """
+    abbrs = self.team_abbrs()
+    return self.predict_proba({'home': abbrs[home], 'visitor': abbrs[visitor]}, rng)
+
+  def step_index(self,
+                 home: int,
+                 visitor: int,
+                 result: float,
+                 rng: np.random.Generator=None) -> None:
+    """Perform single step parameter update, given team indices.
+
+    Defaults to step; models override it to skip the lookups.
+    """
+    abbrs = self.team_abbrs()
+    self.step({'home': abbrs[home], 'visitor': abbrs[visitor]}, result, rng)
+
+  def team_abbrs(self) -> List[str]:
+    """A team abbreviation for each team index (inverse of params['map']).
+
+    The map has aliases (e.g. old abbreviations), so an index maps to
+    the first abbreviation with that index.
+    """
+    team_map = self.params['map']
+    cached = getattr(self, '_team_abbrs', None)
+    if cached is None or cached[0] is not team_map:
+      abbrs = [None] * self.params.num_teams
+      for abbr, i in team_map.items():
+        if abbrs[i] is None:
+          abbrs[i] = abbr
+      cached = self._team_abbrs = (team_map, abbrs)
+    return cached[1]
+
+  def predict_matrix(self, rng: np.random.Generator=None) -> np.ndarray:
+    """Probability that the home team wins, for every pair of teams.
+
+    Returns:
+    --------
+    Array of shape (number of teams, number of teams); entry [h, v] is
+    the probability that team h wins at home against team v (team
+    indices, see params['map']). The diagonal is meaningless.
+    """
+    n = self.params.num_teams
+    p = np.empty((n, n))
+    for h in range(n):
+      for v in range(n):
+        p[h, v] = self.predict_proba_index(h, v, rng)
+    return p
+
+  def train(self,
+            schedule: List[Dict],
+            results: List[float],
+            rng: np.random.Generator=None) -> None:
     """Train the model with game results."""
     for game, result in zip(schedule, results):
-      self.step(game, result)
+      self.step(game, result, rng)
+
+  def train_batch(self,
+                  home: np.ndarray,
+                  visitor: np.ndarray,
+                  result: np.ndarray,
+                  day: np.ndarray=None,
+                  rng: np.random.Generator=None) -> np.ndarray:
+    """Train the model with games given as arrays, in chronological order.
+
+    Args:
+    -----
+    home, visitor: team indices.
+    result: 1 if home team won, 0 otherwise.
+    day (optional): dates of the games. Unused by models that update
+      after every game.
+    rng (optional): random generator for models that need one.
+
+    Returns:
+    --------
+    Probability that the home team won each game, predicted before
+    training on it (one-step-ahead predictions).
+    """
+    p = np.empty(len(home))
+    for i, (h, v, r) in enumerate(zip(np.asarray(home).tolist(),
+                                      np.asarray(visitor).tolist(),
+                                      np.asarray(result).tolist())):
+      p[i] = self.predict_proba_index(h, v, rng)
+      self.step_index(h, v, r, rng)
+    return p
+
+  def team_indices(self, schedule: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """Map a schedule to arrays of home and visitor team indices."""
+    team_map = self.params['map']
+    home = np.array([team_map[game['home']] for game in schedule], dtype=np.intp)
+    visitor = np.array([team_map[game['visitor']] for game in schedule], dtype=np.intp)
+    return home, visitor
+
+
+class BatchModel(Model):
+  """Model with a batch interface.
+
+  The batch interface (init_batch, predict_proba_batch, step_batch)
+  runs many independent replicas of the model state at once. Forecaster
+  uses it to simulate all replicas of a season with one vectorized step
+  per game.
+  """
+
+  @abstractmethod
+  def init_batch(self, n: int) -> Dict[str, np.ndarray]:
+    """Replicate the model state n times.
+
+    Returns:
+    --------
+    Dict of arrays of shape (number of teams, n). Each column is one
+    replica of the model state.
+    """
+    pass
+
+  @abstractmethod
+  def predict_proba_batch(self,
+                          state: Dict[str, np.ndarray],
+                          home: int,
+                          visitor: int,
+                          rng: np.random.Generator=None) -> np.ndarray:
+    """Predict probability that home team wins in each replica."""
+    pass
+
+  @abstractmethod
+  def step_batch(self,
+                 state: Dict[str, np.ndarray],
+                 home: int,
+                 visitor: int,
+                 result: np.ndarray,
+                 p: np.ndarray=None,
+                 rng: np.random.Generator=None) -> None:
+    """Perform single step parameter update in each replica.
+
+    p (optional) is the output of predict_proba_batch for the same
+    game and state, if the caller already has it.
+    """
+    pass
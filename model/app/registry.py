@@ -0,0 +1,238 @@
+# registry.py
+"""Process-level cache of deserialized models.
+
+Models are kept in memory across requests. Each lookup revalidates the
+cached model against the version of its parameters blob (see store.py:
+the generation for GCS, the file mtime for the local backend), which is
+a metadata request, not a download. Writes through the registry update
+the cache immediately.
+
+Models are kept per season (see utils.parameters_info); lookups without
+a season use the unprefixed parameters.
+
+The win probability matrix of a model (see Model.predict_matrix) is
+computed on first use and kept with the model, so it is recomputed once
+per version of the parameters.
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+
+from bayesian import BayesianLogisticRegressionWithADF
+from elo import ELO
+from model import Model
+from state import ModelState
+from store import BlobInfo, Version
+from utils import load_parameters, parameters_info, params_blob_id, save_parameters
+
+
+# model name -> model class. add to this as new models are added.
+MODELS = {
+  'elo': ELO,
+  'bayesian': BayesianLogisticRegressionWithADF
+}
+
+def bucket_name(model_name: str) -> str:
+  """Bucket holding the parameters of a model, from <MODEL-NAME>-BUCKET-NAME."""
+  return os.getenv(model_name.upper() + "-BUCKET-NAME")
+
+
+class ModelRegistry():
+  """Cache of models keyed by model name and season.
+
+  Counters (see stats):
+    hits / misses: lookups served from memory / loaded from storage.
+    hit_seconds / miss_seconds: total time spent in each kind of lookup.
+    matrix_hits / matrix_misses: win probability matrices served from
+      memory / computed.
+  """
+  def __init__(self) -> None:
+    self._models: Dict[Tuple[str, Optional[int]], Tuple[Tuple[str, Version], Model]] = {}
+    # the model each matrix was computed from
+    self._matrices: Dict[Tuple[str, Optional[int]], Tuple[Model, np.ndarray]] = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.hit_seconds = 0.0
+    self.miss_seconds = 0.0
+    self.matrix_hits = 0
+    self.matrix_misses = 0
+
+  def get(self, model_name: str, copy: bool=False, season: int=None) -> Tuple[Model, str]:
+    """Load model and bucket name using model name.
+
+    Args:
+    -----
+    model_name: e.g., 'elo'.
+    copy: return a model with a copy of the cached parameters. Use this
+      if the model will be modified (e.g., trained).
+    season (optional): e.g. 2022, see utils.parameters_info.
+
+    Returns:
+    --------
+    (None, "") if the model name is unknown or has no parameters.
+    """
+    model, bucket, _ = self.get_with_version(model_name, copy, season)
+    return model, bucket
+
+  def get_for_update(self, model_name: str, season: int=None) -> Tuple[Model, Version]:
+    """A copy of a model to modify (e.g., train) and save.
+
+    Returns:
+    --------
+    The model and the if_version_match to save it with (see save): the
+    version of the season's parameters blob it was loaded from, or 0 if
+    it was loaded from another blob (the season has no parameters of its
+    own yet). (None, None) if the model name is unknown or has no
+    parameters.
+    """
+    model, _, info = self._get(model_name, True, season)
+    if model is None:
+      return None, None
+    return model, info.version if info.key == params_blob_id(season) else 0
+
+  def get_with_version(self,
+                       model_name: str,
+                       copy: bool=False,
+                       season: int=None) -> Tuple[Model, str, Version]:
+    """Same as get, also returning the version of the model's parameters.
+
+    Returns:
+    --------
+    (None, "", None) if the model name is unknown or has no parameters.
+    """
+    model, bucket, info = self._get(model_name, copy, season)
+    return model, bucket, info.version if info is not None else None
+
+  def _get(self,
+           model_name: str,
+           copy: bool,
+           season: Optional[int]) -> Tuple[Model, str, Optional[BlobInfo]]:
+    """Same as get, also returning the parameters blob of the model."""
+    start = time.perf_counter()
+    model_name = model_name.lower()
+    bucket = bucket_name(model_name)
+    if model_name not in MODELS or not bucket:
+      return None, "", None
+
+    info = parameters_info(bucket, season)
+    if info is None:
+      return None, "", None
+
+    # versions are per blob; a season may still use the unprefixed one
+    version_id = (info.key, info.version)
+    with self._lock:
+      version, model = self._models.get((model_name, season), (None, None))
+    hit = (model is not None) and (version == version_id)
+
+    if not hit:
+      model = MODELS[model_name](load_parameters(bucket, info))
+      with self._lock:
+        self._models[(model_name, season)] = (version_id, model)
+
+    if copy:
+      model = MODELS[model_name](model.params.copy())
+
+    with self._lock:
+      if hit:
+        self.hits += 1
+        self.hit_seconds += time.perf_counter() - start
+      else:
+        self.misses += 1
+        self.miss_seconds += time.perf_counter() - start
+
+    return model, bucket, info
+
+  def get_matrix(self,
+                 model_name: str,
+                 season: int=None) -> Tuple[Model, np.ndarray, bool]:
+    """Win probability matrix of a model (see Model.predict_matrix).
+
+    The matrix is read-only and is only recomputed when the parameters
+    change.
+
+    Returns:
+    --------
+    The model, the matrix and whether it was cached. (None, None, False)
+    if the model name is unknown or has no parameters.
+    """
+    model, _, _ = self.get_with_version(model_name, season=season)
+    if model is None:
+      return None, None, False
+
+    key = (model_name.lower(), season)
+    with self._lock:
+      cached_model, matrix = self._matrices.get(key, (None, None))
+    hit = cached_model is model
+
+    if not hit:
+      matrix = model.predict_matrix()
+      matrix.setflags(write=False)
+      with self._lock:
+        self._matrices[key] = (model, matrix)
+
+    with self._lock:
+      if hit:
+        self.matrix_hits += 1
+      else:
+        self.matrix_misses += 1
+
+    return model, matrix, hit
+
+  def save(self,
+           model_name: str,
+           params: Union[Dict, ModelState],
+           season: int=None,
+           if_version_match: Version=None) -> bool:
+    """Save model parameters (of season, if given) and update the cache.
+
+    Raises store.PreconditionFailed if if_version_match is given and
+    isn't the current version of the parameters (see get_for_update).
+
+    Returns:
+    --------
+    False if there is no bucket for the model name.
+    """
+    model_name = model_name.lower()
+    bucket = bucket_name(model_name)
+    if not bucket:
+      return False
+
+    version = save_parameters(bucket, params, season, if_version_match)
+    with self._lock:
+      if model_name in MODELS:
+        version_id = (params_blob_id(season), version)
+        self._models[(model_name, season)] = (version_id, MODELS[model_name](params))
+      else:
+        self._models.pop((model_name, season), None)
+    return True
+
+  def invalidate(self, model_name: str=None) -> None:
+    """Drop a model (default: all models), of every season, from the cache."""
+    with self._lock:
+      if model_name is None:
+        self._models.clear()
+        self._matrices.clear()
+      else:
+        for cache in (self._models, self._matrices):
+          for key in [key for key in cache if key[0] == model_name.lower()]:
+            del cache[key]
+
+  def stats(self) -> Dict:
+    """Cache counters."""
+    with self._lock:
+      return {
+        'models': sorted(
+          name if season is None else f"{name}/{season}"
+          for name, season in self._models
+        ),
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_seconds': self.hit_seconds,
+        'miss_seconds': self.miss_seconds,
+        'matrix_hits': self.matrix_hits,
+        'matrix_misses': self.matrix_misses
+      }
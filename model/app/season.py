@@ -0,0 +1,164 @@
+# season.py
+"""Simulate the rest of the season to get postseason odds.
+
+Uses the same block / worker machinery as Forecaster.forecast, but also
+tracks each team's wins in each simulation. Final standings are
+aggregated with array operations over all simulations of a block at once.
+"""
+from typing import Dict, List
+
+import numpy as np
+
+from forecast import Forecaster, run_sharded, simulation_blocks
+from model import BatchModel
+
+
+def _simulate_season_blocks(model: BatchModel,
+                            home: np.ndarray,
+                            visitor: np.ndarray,
+                            base_wins: np.ndarray,
+                            leagues: List[List[np.ndarray]],
+                            wildcards: int,
+                            max_wins: int,
+                            blocks: List) -> Dict[str, np.ndarray]:
+  """Simulate blocks of seasons and count outcomes.
+
+  Runs in forecast worker processes.
+
+  Args:
+  -----
+  base_wins: current wins of each team (by model team index).
+  leagues: for each league, a list of divisions, each an array of
+    team indices.
+
+  Returns:
+  --------
+  Dict of count arrays indexed by team: 'wins' (final win totals,
+  shape (number of teams, max_wins + 1)), 'division', 'wildcard' and
+  'seed' (shape (number of teams, number of seeds)).
+  """
+  num_teams = len(base_wins)
+  num_seeds = max(len(divisions) for divisions in leagues) + wildcards
+  counts = {
+    'wins': np.zeros((num_teams, max_wins + 1), dtype=np.int64),
+    'division': np.zeros(num_teams, dtype=np.int64),
+    'wildcard': np.zeros(num_teams, dtype=np.int64),
+    'seed': np.zeros((num_teams, num_seeds), dtype=np.int64)
+  }
+  forecaster = Forecaster(model)
+
+  for size, seed_seq in blocks:
+    rng = np.random.default_rng(seed_seq)
+    team_wins = np.repeat(base_wins[:, np.newaxis], size, axis=1)
+    forecaster.simulate_indices(home, visitor, size, rng, team_wins)
+
+    # histogram of win totals for all teams in one bincount
+    offsets = (np.arange(num_teams) * (max_wins + 1))[:, np.newaxis]
+    counts['wins'] += np.bincount(
+      (team_wins + offsets).ravel(), minlength=num_teams * (max_wins + 1)
+    ).reshape(num_teams, max_wins + 1)
+
+    # ties are broken at random: the fractional part never changes the
+    # order of teams with different win totals
+    key = team_wins + rng.random(team_wins.shape)
+
+    for divisions in leagues:
+      teams = np.concatenate(divisions)
+      sims = np.arange(size)
+
+      # division winners
+      is_winner = np.zeros((len(teams), size), dtype=bool)
+      offset = 0
+      for division in divisions:
+        is_winner[offset + np.argmax(key[division], axis=0), sims] = True
+        offset += len(division)
+
+      # division winners are seeded first, then wild cards, each by record
+      league_key = key[teams]
+      num_wildcards = min(wildcards, len(teams) - len(divisions))
+      winner_order = np.argsort(-np.where(is_winner, league_key, -np.inf), axis=0)
+      wildcard_order = np.argsort(-np.where(is_winner, -np.inf, league_key), axis=0)
+      order = np.vstack([winner_order[:len(divisions)], wildcard_order[:num_wildcards]])
+
+      for s, positions in enumerate(order):
+        counts['seed'][teams, s] += np.bincount(positions, minlength=len(teams))
+      counts['division'][teams] += is_winner.sum(axis=1)
+      counts['wildcard'][teams] += np.bincount(
+        wildcard_order[:num_wildcards].ravel(), minlength=len(teams)
+      )
+
+  return counts
+
+def simulate_season(model: BatchModel,
+                    schedule: List[Dict],
+                    standings: Dict[str, int],
+                    divisions: Dict[str, List[str]],
+                    leagues: Dict[str, List[str]],
+                    wildcards: int=3,
+                    n: int=10000,
+                    seed: int=42,
+                    workers: int=None) -> Dict[str, Dict]:
+  """Simulate the rest of the season n times.
+
+  Requires a BatchModel.
+
+  Args:
+  -----
+  schedule: remaining games, in chronological order.
+  standings: current number of wins of each team.
+  divisions: division name -> list of teams.
+  leagues: league name -> list of division names.
+  wildcards: number of wild card teams per league.
+
+  Returns:
+  --------
+  Dict of team -> dict with keys
+    'wins': distribution of final win totals, as {'min': w, 'p': [...]}
+      where p[i] is the probability of finishing with w + i wins.
+    'mean_wins': expected final win total.
+    'division': probability of winning the division.
+    'wildcard': probability of a wild card.
+    'playoffs': probability of making the playoffs.
+    'seed': list of probabilities of each playoff seed (1, 2, ...).
+  """
+  team_map = model.params['map']
+  num_teams = max(team_map.values()) + 1
+
+  home, visitor = model.team_indices(schedule)
+  base_wins = np.zeros(num_teams, dtype=np.int64)
+  for team, wins in standings.items():
+    base_wins[team_map[team]] = wins
+  games_left = np.bincount(np.concatenate([home, visitor]), minlength=num_teams)
+  max_wins = int(np.max(base_wins + games_left))
+
+  league_indices = [
+    [np.array([team_map[team] for team in divisions[division]]) for division in league]
+    for league in leagues.values()
+  ]
+
+  shards = run_sharded(
+    _simulate_season_blocks,
+    (model, home, visitor, base_wins, league_indices, wildcards, max_wins),
+    simulation_blocks(n, seed),
+    workers
+  )
+  counts = {key: sum(shard[key] for shard in shards) for key in shards[0]}
+
+  odds = {}
+  for teams in divisions.values():
+    for team in teams:
+      i = team_map[team]
+      p = counts['wins'][i] / n
+      support = np.flatnonzero(p)
+      lo, hi = support[0], support[-1]
+      seeds = counts['seed'][i] / n
+      odds[team] = {
+        'wins': {'min': int(lo), 'p': np.round(p[lo:hi + 1], 5).tolist()},
+        'mean_wins': float(np.dot(np.arange(len(p)), p)),
+        'division': float(counts['division'][i] / n),
+        'wildcard': float(counts['wildcard'][i] / n),
+        'playoffs': float(seeds.sum()),
+        'seed': seeds.tolist()
+      }
+
+  return odds
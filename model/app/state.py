@@ -0,0 +1,225 @@
+# state.py
+"""Compact, array-backed model state.
+
+ModelState replaces the free-form params dict. Per-team parameters (e.g.
+'rating', 'mu', 'var') are float64 arrays, hyperparameters (e.g. 'a', 'b',
+'k') are floats, and the team abbreviation -> index table is interned so
+that every state with the same table shares one dict.
+
+ModelState supports the same item access as the old dict
+(state['rating'][i], state['a'], state['map']), so models don't need to
+know which one they were given.
+
+Binary layout (version 1, little endian):
+
+  magic    4 bytes   b'MLBS'
+  version  uint16
+  flags    uint16    reserved, 0
+  meta     uint32    length of the json metadata in bytes
+  json metadata, zero padded to a multiple of 8 bytes:
+    {'scalars': [names], 'vectors': [names], 'teams': int,
+     'map': [[abbr, index], ...], 'extra': {...}}
+  float64  scalars, in the order listed in the metadata
+  float64  vectors, row major, one row of length 'teams' per vector
+"""
+import json
+import struct
+import sys
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+
+
+MAGIC = b'MLBS'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHI')
+
+# interned team index tables, keyed by their (abbr, index) items
+_team_maps: Dict[Tuple[Tuple[str, int], ...], Dict[str, int]] = {}
+
+def intern_team_map(team_map: Dict[str, int]) -> Dict[str, int]:
+  """Return the shared copy of a team abbreviation -> index table.
+
+  The returned dict is shared between states and must not be modified.
+  """
+  for interned in _team_maps.values():
+    if team_map is interned:
+      return team_map
+
+  items = tuple(sorted((sys.intern(str(k)), int(v)) for k, v in team_map.items()))
+  if items not in _team_maps:
+    _team_maps[items] = dict(items)
+  return _team_maps[items]
+
+@lru_cache(maxsize=64)
+def _parse_meta(meta: bytes) -> Tuple[List[str], List[str], int, Dict[str, int], str]:
+  """Parse the json metadata of a serialized ModelState.
+
+  Cached because the metadata rarely changes between saves.
+  """
+  meta = json.loads(meta.rstrip(b'\0'))
+  return (
+    meta['scalars'],
+    meta['vectors'],
+    meta['teams'],
+    intern_team_map(dict(meta['map'])),
+    json.dumps(meta['extra'])
+  )
+
+
+class ModelState():
+  """Model parameters.
+
+  Attributes:
+  -----------
+  vectors: per-team float64 arrays, all of the same length.
+  scalars: float hyperparameters.
+  map: interned team abbreviation -> index table.
+  extra: any other json-serializable entries (e.g. 'date').
+  """
+  __slots__ = ('vectors', 'scalars', 'map', 'extra')
+
+  def __init__(self,
+               vectors: Dict[str, np.ndarray],
+               scalars: Dict[str, float],
+               team_map: Dict[str, int],
+               extra: Dict[str, Any]=None) -> None:
+    self.vectors = vectors
+    self.scalars = scalars
+    self.map = intern_team_map(team_map)
+    self.extra = extra if extra is not None else {}
+
+  @classmethod
+  def from_dict(cls, params: Dict) -> 'ModelState':
+    """Convert a params dict (as sent to /set_parameters) to a ModelState."""
+    vectors, scalars, extra = {}, {}, {}
+    for key, value in params.items():
+      if key == 'map':
+        continue
+      elif isinstance(value, (list, tuple, np.ndarray)):
+        vectors[key] = np.array(value, dtype=np.float64)
+      elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        scalars[key] = float(value)
+      else:
+        extra[key] = value
+    return cls(vectors, scalars, params['map'], extra)
+
+  def to_dict(self) -> Dict:
+    """Convert to a json-serializable dict."""
+    params = {key: value.tolist() for key, value in self.vectors.items()}
+    params.update(self.scalars)
+    params['map'] = dict(self.map)
+    params.update(self.extra)
+    return params
+
+  def to_bytes(self) -> bytes:
+    """Serialize using the fixed binary layout described above."""
+    meta = json.dumps({
+      'scalars': list(self.scalars),
+      'vectors': list(self.vectors),
+      'teams': self.num_teams,
+      'map': list(self.map.items()),
+      'extra': self.extra
+    }, separators=(',', ':')).encode('utf-8')
+    meta += b'\0' * (-(_HEADER.size + len(meta)) % 8)
+
+    block = np.empty(len(self.scalars) + len(self.vectors) * self.num_teams)
+    block[:len(self.scalars)] = list(self.scalars.values())
+    if self.vectors:
+      block[len(self.scalars):] = np.concatenate(list(self.vectors.values()))
+
+    header = _HEADER.pack(MAGIC, VERSION, 0, len(meta))
+    return b''.join([header, meta, block.astype('<f8', copy=False).tobytes()])
+
+  @classmethod
+  def from_bytes(cls, buf: Union[bytes, bytearray, memoryview]) -> 'ModelState':
+    """Deserialize from the binary layout described above.
+
+    The vectors are views into buf (no copy), so they are writable only
+    if buf is writable (e.g. a bytearray).
+    """
+    magic, version, _, meta_len = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+      raise ValueError("Not a serialized ModelState.")
+    if version != VERSION:
+      raise ValueError(f"Unsupported ModelState version: {version}")
+
+    offset = _HEADER.size + meta_len
+    scalar_names, vector_names, teams, team_map, extra = _parse_meta(
+      bytes(buf[_HEADER.size:offset])
+    )
+    block = np.frombuffer(
+      buf, dtype='<f8', count=len(scalar_names) + len(vector_names) * teams, offset=offset
+    )
+
+    scalars = dict(zip(scalar_names, block[:len(scalar_names)].tolist()))
+    rows = block[len(scalar_names):].reshape(len(vector_names), teams)
+    vectors = dict(zip(vector_names, rows))
+    return cls(vectors, scalars, team_map, json.loads(extra))
+
+  @property
+  def num_teams(self) -> int:
+    """Length of the per-team vectors."""
+    for value in self.vectors.values():
+      return len(value)
+    return 0
+
+  def copy(self) -> 'ModelState':
+    """Copy vectors; the interned team map is shared."""
+    return ModelState(
+      {key: value.copy() for key, value in self.vectors.items()},
+      dict(self.scalars),
+      self.map,
+      json.loads(json.dumps(self.extra))
+    )
+
+  def __deepcopy__(self, memo: Dict) -> 'ModelState':
+    return self.copy()
+
+  def __reduce__(self) -> Tuple:
+    # pickle (e.g. to forecast worker processes) via the compact layout
+    return (ModelState.from_bytes, (bytearray(self.to_bytes()),))
+
+  def __getitem__(self, key: str) -> Any:
+    if key in self.vectors:
+      return self.vectors[key]
+    elif key in self.scalars:
+      return self.scalars[key]
+    elif key == 'map':
+      return self.map
+    return self.extra[key]
+
+  def __setitem__(self, key: str, value: Any) -> None:
+    if key == 'map':
+      self.map = intern_team_map(value)
+    elif isinstance(value, (list, tuple, np.ndarray)):
+      self.vectors[key] = np.array(value, dtype=np.float64)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      self.scalars[key] = float(value)
+    else:
+      self.extra[key] = value
+
+  def __contains__(self, key: str) -> bool:
+    return (key == 'map') or (key in self.vectors) or (key in self.scalars) or (key in self.extra)
+
+  def __iter__(self) -> Iterator[str]:
+    yield from self.vectors
+    yield from self.scalars
+    yield 'map'
+    yield from self.extra
+
+  def get(self, key: str, default: Any=None) -> Any:
+    """Dict-style get."""
+    return self[key] if key in self else default
+
+  def __repr__(self) -> str:
+    scalars = ', '.join(f"{k}={v:g}" for k, v in self.scalars.items())
+    vectors = ', '.join(self.vectors)
+    return f"ModelState({scalars}; vectors: {vectors}; teams={self.num_teams}; {self.extra})"
+
+def as_state(params: Union[Dict, ModelState]) -> ModelState:
+  """Convert params to a ModelState if needed."""
+  if isinstance(params, dict):
+    return ModelState.from_dict(params)
+  return params
@@ -0,0 +1,41 @@
+# teams.py
+"""Current team abbreviations."""
+
+# statsapi team id -> abbreviation. ids don't change when a team is
+# renamed or moves (e.g. the Montreal Expos / Washington Nationals are 120)
+team_id_abbr = {
+  147: 'NYY',
+  139: 'TBR',
+  141: 'TOR',
+  110: 'BAL',
+  111: 'BOS',
+  145: 'CHW',
+  114: 'CLE',
+  116: 'DET',
+  118: 'KCR',
+  142: 'MIN',
+  108: 'LAA',
+  133: 'OAK',
+  136: 'SEA',
+  140: 'TEX',
+  117: 'HOU',
+  144: 'ATL',
+  121: 'NYM',
+  143: 'PHI',
+  146: 'MIA',
+  120: 'WSN',
+  112: 'CHC',
+  158: 'MIL',
+  138: 'STL',
+  134: 'PIT',
+  113: 'CIN',
+  119: 'LAD',
+  115: 'COL',
+  109: 'ARI',
+  137: 'SFG',
+  135: 'SDP'
+}
+
+# the current abbreviations, e.g. the default teams of /predict (the team
+# map of the parameters also has historical aliases)
+TEAMS = list(team_id_abbr.values())
@@ -3,9 +3,16 @@
 import pickle
 import numpy as np
 from math import exp
-from typing import Dict
+from typing import Dict, Optional, Union
 
-from google.cloud import storage
+from instrument import timed
+from state import ModelState, as_state
+from store import BlobInfo, Version, get_store
+
+
+PARAMS_BLOB_ID = 'params.bin'
+LEGACY_PARAMS_BLOB_ID = 'params.pkl'
+SEASONS_PREFIX = 'seasons/'
 
 
 def sigmoid(x: float):
@@ -17,44 +24,78 @@ def sigmoid(x: float):
 
 def np_sigmoid(x: np.ndarray) -> np.ndarray:
   """Numerically stable element-wise sigmoid for numpy arrays."""
-  return np.where(
-    x >= 0, 
-    1 / (1 + np.exp(-x)), 
-    np.exp(x) / (1 + np.exp(x))
-  )
+  # exp(-|x|) never overflows and is the same value both branches need
+  e = np.exp(-np.abs(x))
+  return np.where(x >= 0, 1 / (1 + e), e / (1 + e))
+
+def params_blob_id(season: int=None) -> str:
+  """Key of the parameters of a season (default: the unprefixed blob)."""
+  if season is None:
+    return PARAMS_BLOB_ID
+  return f"{SEASONS_PREFIX}{season}/{PARAMS_BLOB_ID}"
 
-def load_parameters(bucket_name: str) -> Dict:
-  """Load model parameters from storage."""
-  storage_client = storage.Client()
-  bucket = storage_client.bucket(bucket_name)
+def parameters_info(bucket_name: str, season: int=None) -> Optional[BlobInfo]:
+  """Get the metadata of the parameters blob, or None if there isn't one.
 
-  blob_id = 'params.pkl'
-  blob = bucket.blob(blob_id)
+  Looks for the season's parameters (if a season is given), then the
+  unprefixed binary ModelState blob, then the legacy pickled params dict
+  if the bucket hasn't been migrated yet. A season without parameters of
+  its own thus starts from the unprefixed ones. The version of the
+  returned blob identifies the version of the parameters.
+  """
+  store = get_store(bucket_name)
+  blob_ids = (PARAMS_BLOB_ID, LEGACY_PARAMS_BLOB_ID)
+  if season is not None:
+    blob_ids = (params_blob_id(season),) + blob_ids
+  for blob_id in blob_ids:
+    info = store.stat(blob_id)
+    if info is not None:
+      return info
+  return None
 
-  if not blob.exists(storage_client):
-    return None
+@timed('params.load')
+def load_parameters(bucket_name: str, info: BlobInfo=None) -> ModelState:
+  """Load model parameters from storage.
 
-  pkl = blob.download_as_string()
-  params = pickle.loads(pkl)
+  If info (from parameters_info) is given, that version of the
+  parameters is loaded.
+  """
+  if info is None:
+    info = parameters_info(bucket_name)
+    if info is None:
+      return None
+
+  data = get_store(bucket_name).read(info.key, version=info.version)
+  if info.key != LEGACY_PARAMS_BLOB_ID:
+    # bytearray so that the zero-copy vectors are writable
+    params = ModelState.from_bytes(bytearray(data))
+  else:
+    params = ModelState.from_dict(pickle.loads(data))
 
   # log to console
-  print("Loaded params:")
-  print(params)
-  
+  print(f"Loaded params: {params}")
+
   return params
 
-def save_parameters(bucket_name: str, params) -> None:
-  """Save parameters to storage."""
-  storage_client = storage.Client()
-  bucket = storage_client.bucket(bucket_name)
+@timed('params.save')
+def save_parameters(bucket_name: str,
+                    params: Union[Dict, ModelState],
+                    season: int=None,
+                    if_version_match: Version=None) -> Version:
+  """Save parameters to storage, as the parameters of season if given.
 
-  blob_id = 'params.pkl'
-  blob = bucket.blob(blob_id)
+  Raises store.PreconditionFailed if if_version_match is given and
+  isn't the current version of the blob (0: it must not exist).
 
-  pkl = pickle.dumps(params)
-  blob.upload_from_string(pkl)
+  Returns:
+  --------
+  The version of the saved blob.
+  """
+  params = as_state(params)
+  version = get_store(bucket_name).write(
+    params_blob_id(season), params.to_bytes(), if_version_match=if_version_match
+  )
 
   # log to console
-  print("Saved params:")
-  print(params)
-  return
+  print(f"Saved params: {params}")
+  return version
@@ -0,0 +1,222 @@
+# backtest.py
+"""Backtest models and search their hyperparameters.
+
+A backtest replays the games of a GameTable in chronological order and
+scores the model's one-step-ahead predictions (each game is predicted
+before the model trains on it). Configurations are evaluated in parallel
+by a process pool; the game table is placed in shared memory once and
+mapped by every worker without copying.
+
+Score the default hyperparameters (see train.HYPERPARAMETERS):
+
+  python backtest.py elo --table games.npz
+
+Grid search (every combination of the listed values):
+
+  python backtest.py elo --table games.npz --param a=0.002,0.0025,0.003 --param k=2,4,6
+
+Random search (uniform on lo:hi, or a choice from a list):
+
+  python backtest.py bayesian --table games.npz --samples 1000 --param k=0.5:8 --param var=1:50
+
+The table is fetched with train.py's date range arguments if --table
+doesn't exist yet, and saved there.
+"""
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+
+import numpy as np
+
+from app.games import GameTable
+from app.registry import MODELS
+from train import HYPERPARAMETERS, get_game_table, initial_params, parse_date
+
+
+def score(p: np.ndarray, result: np.ndarray, bins: int=10) -> Dict:
+  """Score probabilistic predictions of game results.
+
+  Args:
+  -----
+  p: predicted probabilities that the home team won.
+  result: 1 if the home team won, 0 otherwise.
+  bins: number of equal-width calibration bins on [0, 1].
+
+  Returns:
+  --------
+  Dict with the number of games 'n', 'log_loss', 'brier', 'accuracy'
+  and 'calibration': for each non-empty bin, its range, the number of
+  games, the mean prediction and the observed home win rate.
+  """
+  p = np.asarray(p, dtype=np.float64)
+  result = np.asarray(result, dtype=np.float64)
+  clipped = np.clip(p, 1e-15, 1 - 1e-15)
+  log_loss = -np.mean(result * np.log(clipped) + (1 - result) * np.log(1 - clipped))
+
+  edges = np.linspace(0, 1, bins + 1)
+  which = np.clip(np.searchsorted(edges, p, side='right') - 1, 0, bins - 1)
+  count = np.bincount(which, minlength=bins)
+  p_sum = np.bincount(which, weights=p, minlength=bins)
+  win_sum = np.bincount(which, weights=result, minlength=bins)
+  calibration = [
+    {
+      'bin': [round(float(edges[i]), 6), round(float(edges[i + 1]), 6)],
+      'n': int(count[i]),
+      'mean_p': float(p_sum[i] / count[i]),
+      'win_rate': float(win_sum[i] / count[i])
+    }
+    for i in np.flatnonzero(count)
+  ]
+
+  return {
+    'n': len(p),
+    'log_loss': float(log_loss),
+    'brier': float(np.mean((p - result) ** 2)),
+    'accuracy': float(np.mean((p >= 0.5) == (result == 1))),
+    'calibration': calibration
+  }
+
+def backtest(model_name: str,
+             hyperparameters: Dict,
+             table: GameTable,
+             burn_in: int=0) -> Dict:
+  """Train an untrained model on the table and score its predictions.
+
+  Args:
+  -----
+  model_name: 'elo' or 'bayesian'.
+  hyperparameters: overrides of train.HYPERPARAMETERS.
+  table: games in chronological order.
+  burn_in: number of initial games that are trained on but not scored.
+
+  Models with Monte Carlo integration draw from the same seeded stream
+  for every configuration, so their scores are comparable.
+  """
+  model = MODELS[model_name](initial_params(model_name, hyperparameters))
+  rng = np.random.default_rng(0)
+  p = model.train_batch(table.home, table.visitor, table.result, table.day, rng=rng)
+  result = score(p[burn_in:], table.result[burn_in:])
+  result['hyperparameters'] = hyperparameters
+  return result
+
+def grid(params: Dict[str, List[float]]) -> List[Dict]:
+  """Every combination of the given values."""
+  names = sorted(params)
+  return [dict(zip(names, values)) for values in itertools.product(*(params[n] for n in names))]
+
+def random_search(params: Dict, samples: int, seed: int=0) -> List[Dict]:
+  """Random configurations.
+
+  Each value of params is either a (lo, hi) tuple, sampled uniformly, or
+  a list of values to choose from.
+  """
+  rng = np.random.default_rng(seed)
+  configs = [{} for _ in range(samples)]
+  for name, values in sorted(params.items()):
+    if isinstance(values, tuple):
+      column = rng.uniform(values[0], values[1], samples)
+    else:
+      column = rng.choice(values, samples)
+    for config, value in zip(configs, column.tolist()):
+      config[name] = value
+  return configs
+
+
+# state of each worker process (see _init_worker)
+_worker = {}
+
+def _init_worker(handle: Dict, model_name: str, burn_in: int) -> None:
+  """Map the shared game table in a worker process."""
+  table, block = GameTable.attach(handle)
+  _worker.update(table=table, block=block, model_name=model_name, burn_in=burn_in)
+
+def _backtest(hyperparameters: Dict) -> Dict:
+  return backtest(_worker['model_name'], hyperparameters, _worker['table'], _worker['burn_in'])
+
+def search(model_name: str,
+           configs: List[Dict],
+           table: GameTable,
+           burn_in: int=0,
+           workers: int=None) -> List[Dict]:
+  """Backtest each configuration across a process pool.
+
+  Returns:
+  --------
+  The backtest results, sorted by log loss.
+  """
+  workers = workers or os.cpu_count() or 1
+  block, handle = table.share()
+  try:
+    with ProcessPoolExecutor(
+      max_workers=workers,
+      mp_context=get_context('spawn'),
+      initializer=_init_worker,
+      initargs=(handle, model_name, burn_in)
+    ) as executor:
+      chunksize = max(1, len(configs) // (4 * workers))
+      results = list(executor.map(_backtest, configs, chunksize=chunksize))
+  finally:
+    block.close()
+    block.unlink()
+  return sorted(results, key=lambda r: r['log_loss'])
+
+def parse_param(s: str):
+  """Parse name=v1,v2,... (list of values) or name=lo:hi (range)."""
+  name, values = s.split('=', 1)
+  if ':' in values:
+    lo, hi = values.split(':')
+    return name, (float(lo), float(hi))
+  return name, [float(v) for v in values.split(',')]
+
+
+parser = argparse.ArgumentParser(description="Backtest models and search their hyperparameters.")
+parser.add_argument("model", help="model name", type=str, choices=sorted(HYPERPARAMETERS))
+parser.add_argument("--table", help="game table (.npz, see train.py --table)", type=str, required=True)
+parser.add_argument("--start", help="first day if the table is fetched (YYYY-MM-DD)",
+                    type=parse_date, default=None)
+parser.add_argument("--end", help="last day if the table is fetched (YYYY-MM-DD)",
+                    type=parse_date, default=None)
+parser.add_argument("--param", help="name=v1,v2,... or name=lo:hi (repeatable)",
+                    type=parse_param, action='append', default=[])
+parser.add_argument("--samples", help="number of random configurations (default: grid search)",
+                    type=int, default=None)
+parser.add_argument("--seed", help="random search seed", type=int, default=0)
+parser.add_argument("--burn-in", help="number of initial games not scored", type=int, default=0)
+parser.add_argument("--workers", help="number of processes, default cpu count", type=int, default=None)
+parser.add_argument("--top", help="number of results to print", type=int, default=10)
+parser.add_argument("--out", help="write all results to this json file", type=str, default=None)
+
+if __name__ == '__main__':
+
+  args = parser.parse_args()
+
+  if os.path.exists(args.table):
+    table = GameTable.load(args.table)
+  else:
+    if args.start is None or args.end is None:
+      parser.error("--start and --end are needed to fetch a new table")
+    table = get_game_table(args.start, args.end)
+    table.save(args.table)
+
+  params = dict(args.param)
+  if args.samples is not None:
+    configs = random_search(params, args.samples, args.seed)
+  elif any(isinstance(values, tuple) for values in params.values()):
+    parser.error("ranges (lo:hi) need --samples")
+  else:
+    configs = grid(params)
+
+  results = search(args.model, configs, table, args.burn_in, args.workers)
+
+  print(f"{len(configs)} configurations, {len(table) - args.burn_in} games scored")
+  for r in results[:args.top]:
+    print(f"log loss {r['log_loss']:.5f}  brier {r['brier']:.5f}  "
+          f"accuracy {r['accuracy']:.4f}  {r['hyperparameters']}")
+
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -0,0 +1,91 @@
+# bayesian.py
+"""Benchmark logistic-Gaussian integration methods for the Bayesian model.
+
+Compares speed and accuracy of Gauss-Hermite quadrature, the probit
+approximation and the 10k-sample Monte Carlo estimate previously used by
+BayesianLogisticRegressionWithADF. The reference values are computed
+with high-order quadrature.
+
+Usage (from the model directory):
+
+  python -m benchmarks.bayesian
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from app.bayesian import logistic_gaussian_mean, logistic_gaussian_moments
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--cases", help="number of (mean, var) test cases", type=int, default=2000)
+parser.add_argument("--orders", help="quadrature orders", type=int, nargs='+', default=[8, 16, 32])
+parser.add_argument("--seed", type=int, default=0)
+
+REFERENCE_ORDER = 200
+
+def time_per_call(f: Callable, args: List, repeat: int=3) -> float:
+  """Best-of-repeat mean time per call in microseconds."""
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for x in args:
+      f(*x)
+    best = min(best, (time.perf_counter() - start) / len(args))
+  return best * 1e6
+
+def run(cases: int, orders: List[int], seed: int) -> List[Dict]:
+  """Run the benchmark on random log-odds distributions."""
+  rng = np.random.default_rng(seed)
+  mean = rng.normal(0, 1.5, cases)
+  var = rng.uniform(1e-4, 4, cases)
+  result = rng.integers(0, 2, cases)
+
+  ref_p = logistic_gaussian_mean(mean, var, 'quadrature', REFERENCE_ORDER)
+  ref_m, ref_v = logistic_gaussian_moments(mean, var, result, 'quadrature', REFERENCE_ORDER)
+
+  configs = [('mc', {'samples': 10000})]
+  configs += [('quadrature', {'order': order}) for order in orders]
+  configs += [('probit', {})]
+
+  rows = []
+  for method, kw in configs:
+    mc_rng = np.random.default_rng(seed)
+    p = logistic_gaussian_mean(mean, var, method, rng=mc_rng, **kw)
+    m, v = logistic_gaussian_moments(mean, var, result, method, rng=mc_rng, **kw)
+
+    # scalar calls, which is how the model calls these per game
+    scalar_args = list(zip(mean[:200], var[:200]))
+    t_predict = time_per_call(
+      lambda a, b: logistic_gaussian_mean(a, b, method, **kw), scalar_args
+    )
+    step_args = list(zip(mean[:200], var[:200], result[:200]))
+    t_step = time_per_call(
+      lambda a, b, c: logistic_gaussian_moments(a, b, c, method, **kw), step_args
+    )
+
+    rows.append({
+      'method': method + ''.join(f" {k}={val}" for k, val in kw.items()),
+      'predict_us': t_predict,
+      'step_us': t_step,
+      'max_err_p': float(np.max(np.abs(p - ref_p))),
+      'max_err_mean': float(np.max(np.abs(m - ref_m))),
+      'max_err_var': float(np.max(np.abs(v - ref_v)))
+    })
+
+  return rows
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  rows = run(args.cases, args.orders, args.seed)
+
+  baseline = rows[0]
+  print(f"{'method':<20}{'predict us':>12}{'step us':>10}{'speedup':>9}"
+        f"{'err p':>11}{'err mean':>11}{'err var':>11}")
+  for row in rows:
+    speedup = (baseline['predict_us'] + baseline['step_us']) / (row['predict_us'] + row['step_us'])
+    print(f"{row['method']:<20}{row['predict_us']:>12.1f}{row['step_us']:>10.1f}"
+          f"{speedup:>8.0f}x{row['max_err_p']:>11.2e}"
+          f"{row['max_err_mean']:>11.2e}{row['max_err_var']:>11.2e}")
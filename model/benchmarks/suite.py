@@ -0,0 +1,208 @@
+# suite.py
+"""Offline benchmark suite for the model service.
+
+Times training steps, predictions, forecasts and parameter
+(de)serialization on synthetic seasons (see synthetic.py), and records
+the results as JSON so they can be compared between commits.
+
+Usage (from the model directory):
+
+  python -m benchmarks.suite --out before.json
+  # ... change something ...
+  python -m benchmarks.suite --out after.json --compare before.json
+
+Every result is a time (lower is better): microseconds per call for the
+step / predict / serialization benchmarks and seconds per forecast.
+Each is the best of --repeat runs.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from app.bayesian import BayesianLogisticRegressionWithADF
+from app.elo import ELO
+from app.forecast import Forecaster
+from app.state import ModelState, as_state
+from benchmarks.synthetic import synthetic_season
+from train import initial_params
+
+
+parser = argparse.ArgumentParser(description="Benchmark the model service offline.")
+parser.add_argument("--seed", help="synthetic season seed", type=int, default=0)
+parser.add_argument("--repeat", help="runs per benchmark (the best is kept)", type=int, default=3)
+parser.add_argument("--n", help="forecast simulation counts", type=int, nargs='+', default=[1000, 5000])
+parser.add_argument("--games", help="forecast schedule lengths", type=int, nargs='+',
+                    default=[243, 1215, 2430])
+parser.add_argument("--workers", help="forecast worker processes", type=int, default=1)
+parser.add_argument("--only", help="run benchmarks whose name starts with one of these",
+                    type=str, nargs='+', default=None)
+parser.add_argument("--out", help="write the results to this json file", type=str, default=None)
+parser.add_argument("--compare", help="json results of an earlier run to compare with",
+                    type=str, default=None)
+
+MODELS = {
+  'elo': ELO,
+  'bayesian': BayesianLogisticRegressionWithADF
+}
+
+
+def best_time(f: Callable[[], None], repeat: int) -> float:
+  """Best wall time of f() over repeat runs, in seconds."""
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    f()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+def trained_model(model_name: str, schedule: List[Dict], results: List[int]):
+  """A model trained on a season."""
+  model = MODELS[model_name](initial_params(model_name))
+  model.train(schedule, results, rng=np.random.default_rng(0))
+  return model
+
+def bench_steps(model_name: str,
+                schedule: List[Dict],
+                results: List[int],
+                repeat: int) -> List[Dict]:
+  """Per-game step and predict_proba times over a season."""
+  def steps():
+    model = MODELS[model_name](initial_params(model_name))
+    for game, result in zip(schedule, results):
+      model.step(game, result)
+
+  model = trained_model(model_name, schedule, results)
+  def predictions():
+    for game in schedule:
+      model.predict_proba(game)
+
+  games = len(schedule)
+  return [
+    {'name': f"{model_name}.step", 'unit': 'us', 'value': 1e6 * best_time(steps, repeat) / games},
+    {'name': f"{model_name}.predict_proba", 'unit': 'us',
+     'value': 1e6 * best_time(predictions, repeat) / games}
+  ]
+
+def bench_forecasts(model_name: str,
+                    model,
+                    schedule: List[Dict],
+                    ns: List[int],
+                    lengths: List[int],
+                    workers: int,
+                    repeat: int) -> List[Dict]:
+  """Forecast times for each number of simulations and schedule length."""
+  forecaster = Forecaster(model)
+  rows = []
+  for games in lengths:
+    for n in ns:
+      t = best_time(lambda: forecaster.forecast(schedule[:games], n, workers=workers), repeat)
+      rows.append({
+        'name': f"{model_name}.forecast/n={n}/games={games}",
+        'unit': 's',
+        'value': t,
+        'games_per_s': n * games / t
+      })
+  return rows
+
+def bench_serialization(model_name: str, model, repeat: int) -> List[Dict]:
+  """Parameter (de)serialization times, binary (ModelState) and json."""
+  state = as_state(model.params)
+  buf = state.to_bytes()
+  text = json.dumps(state.to_dict())
+  calls = 100
+
+  def timed(f: Callable[[], object]) -> float:
+    return 1e6 * best_time(lambda: [f() for _ in range(calls)], repeat) / calls
+
+  return [
+    {'name': f"{model_name}.params.to_bytes", 'unit': 'us', 'value': timed(state.to_bytes),
+     'bytes': len(buf)},
+    {'name': f"{model_name}.params.from_bytes", 'unit': 'us',
+     'value': timed(lambda: ModelState.from_bytes(buf))},
+    {'name': f"{model_name}.params.to_json", 'unit': 'us',
+     'value': timed(lambda: json.dumps(state.to_dict())), 'bytes': len(text)},
+    {'name': f"{model_name}.params.from_json", 'unit': 'us',
+     'value': timed(lambda: as_state(json.loads(text)))}
+  ]
+
+def git_commit() -> str:
+  """Short hash of the checked out commit, or None outside a git tree."""
+  try:
+    out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                         capture_output=True, text=True, check=True)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return out.stdout.strip()
+
+def run(args: argparse.Namespace) -> Dict:
+  """Run the suite and return the results with run metadata."""
+  train_schedule, train_results = synthetic_season(args.seed)
+  schedule, results = synthetic_season(args.seed + 1)
+
+  def selected(name: str) -> bool:
+    return args.only is None or any(name.startswith(prefix) for prefix in args.only)
+
+  rows = []
+  for model_name in MODELS:
+    if selected(f"{model_name}.step") or selected(f"{model_name}.predict_proba"):
+      rows += bench_steps(model_name, schedule, results, args.repeat)
+
+    model = trained_model(model_name, train_schedule, train_results)
+    if selected(f"{model_name}.forecast"):
+      rows += bench_forecasts(model_name, model, schedule, args.n, args.games,
+                              args.workers, args.repeat)
+    if selected(f"{model_name}.params"):
+      rows += bench_serialization(model_name, model, args.repeat)
+
+  return {
+    'commit': git_commit(),
+    'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'config': {
+      'seed': args.seed,
+      'repeat': args.repeat,
+      'workers': args.workers,
+      'season_games': len(schedule)
+    },
+    'results': [row for row in rows if selected(row['name'])]
+  }
+
+def compare(results: Dict, baseline: Dict) -> List[Dict]:
+  """Ratio of each result to the baseline's (> 1 is slower)."""
+  base = {row['name']: row['value'] for row in baseline['results']}
+  return [
+    {'name': row['name'], 'ratio': row['value'] / base[row['name']]}
+    for row in results['results'] if row['name'] in base
+  ]
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  results = run(args)
+
+  print(f"{'benchmark':<42}{'time':>14}")
+  for row in results['results']:
+    print(f"{row['name']:<42}{row['value']:>12.4g} {row['unit']}")
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    print(f"\ncompared with {args.compare} ({baseline.get('commit')}):")
+    for row in compare(results, baseline):
+      flag = '  <- slower' if row['ratio'] > 1.1 else ''
+      print(f"{row['name']:<42}{row['ratio']:>10.2f}x{flag}")
+
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(results, f, indent=2)
+    print(f"\nwrote {args.out}", file=sys.stderr)
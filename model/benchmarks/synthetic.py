@@ -0,0 +1,106 @@
+# synthetic.py
+"""Synthetic seasons for benchmarks.
+
+A season is 30 teams playing 54 rounds of three-game series, so every
+team plays 162 games (81 at home, give or take a series). In each round the
+teams are paired at random, and the team of a pair with fewer home games
+so far hosts the series. There is an off day after every second round,
+so a season spans about six months like the real one.
+
+Results are drawn from a logistic model with a hidden strength per team
+and a home advantage, so trained models have something to learn.
+"""
+from datetime import date, timedelta
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from app.utils import np_sigmoid
+from train import team_abbr_map
+
+
+SEASON_START = date(2022, 4, 7)
+ROUNDS = 54
+SERIES_LENGTH = 3
+HOME_ADVANTAGE = 0.15
+STRENGTH_SD = 0.35
+
+
+def team_abbrs(team_map: Dict[str, int]=team_abbr_map) -> List[str]:
+  """One abbreviation per team index (the first one in the map)."""
+  abbrs = {}
+  for abbr, index in team_map.items():
+    abbrs.setdefault(index, abbr)
+  return [abbrs[i] for i in sorted(abbrs)]
+
+def generate_schedule(rng: np.random.Generator,
+                      teams: List[str]=None,
+                      rounds: int=ROUNDS,
+                      series_length: int=SERIES_LENGTH,
+                      start: date=SEASON_START) -> List[Dict]:
+  """Generate a chronological schedule of games.
+
+  Args:
+  -----
+  rng: random generator.
+  teams (optional): team abbreviations, default team_abbrs(). Must be
+    an even number of teams.
+  rounds: number of series each team plays.
+  series_length: games per series.
+  start: day of the first game.
+
+  Returns:
+  --------
+  A list of games (dicts with 'home', 'visitor' and 'date').
+  """
+  teams = team_abbrs() if teams is None else teams
+  if len(teams) % 2:
+    raise ValueError("need an even number of teams")
+  home_games = np.zeros(len(teams), dtype=np.int64)
+  schedule = []
+  day = start
+  for r in range(rounds):
+    order = rng.permutation(len(teams))
+    pairs = order.reshape(-1, 2)
+    for i, (a, b) in enumerate(pairs):
+      if home_games[b] < home_games[a] or (home_games[a] == home_games[b] and rng.random() < 0.5):
+        pairs[i] = b, a
+    home_games[pairs[:, 0]] += series_length
+
+    for _ in range(series_length):
+      schedule += [
+        {'home': teams[h], 'visitor': teams[v], 'date': str(day)}
+        for h, v in pairs
+      ]
+      day += timedelta(days=1)
+    if r % 2:
+      day += timedelta(days=1)
+  return schedule
+
+def generate_results(schedule: List[Dict],
+                     rng: np.random.Generator,
+                     teams: List[str]=None,
+                     strength_sd: float=STRENGTH_SD,
+                     home_advantage: float=HOME_ADVANTAGE) -> Tuple[List[int], Dict[str, float]]:
+  """Draw results of the games of a schedule.
+
+  Returns:
+  --------
+  The results (1 if the home team won, 0 otherwise) and the hidden
+  strength (log-odds scale) of each team.
+  """
+  teams = team_abbrs() if teams is None else teams
+  strength = dict(zip(teams, rng.normal(0, strength_sd, len(teams)).tolist()))
+  logit = np.array([
+    home_advantage + strength[game['home']] - strength[game['visitor']]
+    for game in schedule
+  ])
+  results = (rng.random(len(schedule)) < np_sigmoid(logit)).astype(int).tolist()
+  return results, strength
+
+def synthetic_season(seed: int=0, **kwargs) -> Tuple[List[Dict], List[int]]:
+  """Schedule and results of a synthetic season (see generate_schedule)."""
+  rng = np.random.default_rng(seed)
+  schedule = generate_schedule(rng, **kwargs)
+  results, _ = generate_results(schedule, rng, kwargs.get('teams'))
+  return schedule, results
@@ -0,0 +1,268 @@
+# statsapi.py
+"""Client for the MLB statsapi.
+
+One client is shared by the whole process (see get_client). It keeps a
+keep-alive connection per thread, retries failed requests with
+exponential backoff, and caches responses on disk (in STATSAPI-CACHE-DIR,
+if set) keyed by URL. Responses for past dates in which every game is
+final never change, so they are cached permanently; anything else is
+cached for `ttl` seconds.
+
+The base url can be pointed at a local stub server with STATSAPI-URL.
+
+This file is shared by the data pipeline and model/train.py; keep the
+copies in sync.
+"""
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import urlencode, urlsplit
+
+
+DEFAULT_URL = "https://statsapi.mlb.com"
+
+# server errors and rate limiting are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class StatsAPIError(Exception):
+  """Request to the statsapi failed."""
+
+
+class StatsAPIClient():
+  """Pooled, retrying and caching statsapi client.
+
+  Args:
+  -----
+  base_url: default STATSAPI-URL or https://statsapi.mlb.com.
+  cache_dir: directory for cached responses, default STATSAPI-CACHE-DIR.
+    No disk cache if neither is set.
+  timeout: socket timeout in seconds.
+  retries: number of retries after the first attempt.
+  backoff: delay before the first retry in seconds, doubled each retry.
+  workers: maximum number of concurrent requests for range fetches.
+  ttl: seconds to keep responses that may still change.
+  """
+  def __init__(self,
+               base_url: str=None,
+               cache_dir: str=None,
+               timeout: float=10.0,
+               retries: int=4,
+               backoff: float=0.5,
+               workers: int=8,
+               ttl: float=300.0) -> None:
+    self.base_url = (base_url or os.getenv('STATSAPI-URL') or DEFAULT_URL).rstrip('/')
+    url = urlsplit(self.base_url)
+    self._https = (url.scheme == 'https')
+    self._host = url.netloc
+    self._prefix = url.path
+
+    self.cache_dir = cache_dir or os.getenv('STATSAPI-CACHE-DIR')
+    if self.cache_dir:
+      os.makedirs(self.cache_dir, exist_ok=True)
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.workers = workers
+    self.ttl = ttl
+    self._local = threading.local()
+    self._executor = None
+    self._executor_lock = threading.Lock()
+
+  def _connection(self) -> http.client.HTTPConnection:
+    """Keep-alive connection for the current thread."""
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+      conn = cls(self._host, timeout=self.timeout)
+      self._local.conn = conn
+    return conn
+
+  def _reset(self) -> None:
+    """Drop the connection of the current thread after an error."""
+    conn = getattr(self._local, 'conn', None)
+    if conn is not None:
+      conn.close()
+      self._local.conn = None
+
+  def _fetch(self, path: str) -> bytes:
+    """GET path with retries."""
+    error = None
+    for attempt in range(self.retries + 1):
+      if attempt > 0:
+        time.sleep(self.backoff * 2 ** (attempt - 1))
+      try:
+        conn = self._connection()
+        conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+        response = conn.getresponse()
+        body = response.read()
+      except (OSError, http.client.HTTPException) as e:
+        self._reset()
+        error = e
+        continue
+
+      if response.status == 200:
+        if response.getheader('Content-Encoding') == 'gzip':
+          body = gzip.decompress(body)
+        return body
+      error = StatsAPIError(f"{response.status} {response.reason}: {path}")
+      if response.status not in RETRY_STATUSES:
+        break
+
+    raise StatsAPIError(f"Request failed: {path}") from error
+
+  def _cache_path(self, path: str) -> str:
+    key = hashlib.sha256((self.base_url + path).encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, key + '.json')
+
+  def get(self, endpoint: str, params: Dict=None, permanent=None) -> Dict:
+    """GET a statsapi endpoint and parse the json response.
+
+    Args:
+    -----
+    endpoint: e.g. '/api/v1/schedule'.
+    params: query parameters.
+    permanent (optional): function of the parsed response that returns
+      True if the response can be cached permanently.
+    """
+    path = self._prefix + endpoint
+    if params:
+      path += '?' + urlencode(params, safe='/')
+
+    if self.cache_dir:
+      try:
+        with open(self._cache_path(path)) as f:
+          entry = json.load(f)
+        if entry['permanent'] or time.time() - entry['fetched'] < self.ttl:
+          return entry['data']
+      except (OSError, ValueError, KeyError):
+        pass
+
+    data = json.loads(self._fetch(path))
+
+    if self.cache_dir:
+      entry = {
+        'url': self.base_url + path,
+        'fetched': time.time(),
+        'permanent': bool(permanent and permanent(data)),
+        'data': data
+      }
+      cache_path = self._cache_path(path)
+      tmp = f"{cache_path}.{threading.get_ident()}.tmp"
+      with open(tmp, 'w') as f:
+        json.dump(entry, f)
+      os.replace(tmp, cache_path)
+
+    return data
+
+  def schedule(self, start_date: date, end_date: date=None) -> List[Dict]:
+    """Get the schedule for a day or a date range (inclusive).
+
+    Returns:
+    --------
+    The 'dates' list of the statsapi response: one dict per date with
+    games, each with a 'games' list.
+    """
+    params = {'language': 'en', 'sportId': 1}
+    if end_date is None or end_date == start_date:
+      end_date = start_date
+      params['date'] = start_date.strftime("%m/%d/%Y")
+    else:
+      params['startDate'] = start_date.strftime("%m/%d/%Y")
+      params['endDate'] = end_date.strftime("%m/%d/%Y")
+
+    def finished(data: Dict) -> bool:
+      # results for past dates are final once every game is final
+      return (end_date < date.today()) and all(
+        game['status']['abstractGameState'] == 'Final'
+        for day in data['dates'] for game in day['games']
+      )
+
+    return self.get('/api/v1/schedule', params, permanent=finished)['dates']
+
+  def season_dates(self, season: int) -> Tuple[date, date]:
+    """First and last day of a regular season.
+
+    Past seasons are cached permanently.
+    """
+    data = self.get(
+      f'/api/v1/seasons/{season}',
+      {'sportId': 1},
+      permanent=lambda data: season < date.today().year
+    )
+    season_data = data['seasons'][0]
+    return (
+      date.fromisoformat(season_data['regularSeasonStartDate']),
+      date.fromisoformat(season_data['regularSeasonEndDate'])
+    )
+
+  def teams(self, season: int) -> List[Dict]:
+    """MLB teams of a season ('id', 'name', 'abbreviation', ...).
+
+    Past seasons are cached permanently.
+    """
+    data = self.get(
+      '/api/v1/teams',
+      {'sportId': 1, 'season': season},
+      permanent=lambda data: season < date.today().year
+    )
+    return data['teams']
+
+  def schedule_range(self,
+                     start_date: date,
+                     end_date: date,
+                     chunk_days: int=31) -> List[Dict]:
+    """Get the schedule for a long date range (inclusive).
+
+    The range is split into chunks of chunk_days which are fetched
+    concurrently. Returns the concatenated 'dates' lists.
+    """
+    chunks = []
+    while start_date <= end_date:
+      chunk_end = min(start_date + timedelta(days=chunk_days - 1), end_date)
+      chunks.append((start_date, chunk_end))
+      start_date = chunk_end + timedelta(days=1)
+
+    dates = []
+    for chunk in self._map(lambda chunk: self.schedule(*chunk), chunks):
+      dates += chunk
+    return dates
+
+  def schedule_days(self, days: Iterable[date]) -> Iterator[Tuple[date, List[Dict]]]:
+    """Get the schedule of each day, fetching concurrently.
+
+    Yields (day, dates) in the order of days.
+    """
+    days = list(days)
+    yield from zip(days, self._map(self.schedule, days))
+
+  def _map(self, f, items: List) -> Iterator:
+    """Map f over items with at most self.workers concurrent requests.
+
+    The worker threads persist, and so do their connections.
+    """
+    if len(items) <= 1:
+      return map(f, items)
+    with self._executor_lock:
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='statsapi')
+    return self._executor.map(f, items)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> StatsAPIClient:
+  """Client shared by the whole process."""
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = StatsAPIClient()
+    return _client
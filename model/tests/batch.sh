@@ -0,0 +1,33 @@
+#!/bin/sh
+
+# test the batch method: train both models, then forecast with each
+
+curl -X POST https://model-5odpqk6ypq-ue.a.run.app/batch \
+  -H "Content-Type: application/json; charset=utf-8" \
+  -H "Authorization: Bearer $(gcloud auth print-identity-token)" \
+  -d '{
+    "jobs":[
+      {
+        "op":"train",
+        "model-name":"elo",
+        "games":[{"home":"TOR","visitor":"CHW","date":"2022-07-17"}],
+        "results":[1]
+      },
+      {
+        "op":"train",
+        "model-name":"bayesian",
+        "games":[{"home":"TOR","visitor":"CHW","date":"2022-07-17"}],
+        "results":[1]
+      },
+      {
+        "op":"forecast",
+        "model-name":"elo",
+        "schedule":[{"home":"BOS","visitor":"NYY","date":"2022-07-18"}]
+      },
+      {
+        "op":"forecast",
+        "model-name":"bayesian",
+        "schedule":[{"home":"BOS","visitor":"NYY","date":"2022-07-18"}]
+      }
+    ]
+  }'
@@ -0,0 +1,12 @@
+#!/bin/sh
+
+# test the predict method
+
+curl -X POST https://model-5odpqk6ypq-ue.a.run.app/predict \
+  -H "Content-Type: application/json; charset=utf-8" \
+  -H "Authorization: Bearer $(gcloud auth print-identity-token)" \
+  -d '{
+    "model-name":"elo",
+    "home":["TOR","NYY"],
+    "visitor":["BOS","TBR","BAL"]
+  }'
@@ -1,18 +1,40 @@
 # train.py
 """Script for training a model on historical data."""
-import urllib.request
-import json
-import pickle
 import argparse
 from datetime import datetime, date, timedelta
-from typing import Dict, Tuple, List
+from typing import Dict, List
 
-from app.elo import ELO
-from app.bayesian import BayesianLogisticRegressionWithADF
+import numpy as np
 
+from app.games import GameTable
+from app.registry import MODELS
+from app.teams import team_id_abbr
+from statsapi import get_client
+
+
+def parse_date(s: str) -> date:
+	"""Parse a YYYY-MM-DD command line argument."""
+	return datetime.strptime(s, "%Y-%m-%d").date()
 
 parser = argparse.ArgumentParser()
-parser.add_argument("model", help="model name", type=str)
+parser.add_argument("model", help="model name", type=str, choices=['elo', 'bayesian'])
+parser.add_argument("--season", help="season, default the current year",
+	type=int, default=date.today().year)
+parser.add_argument("--start", help="first day (YYYY-MM-DD), default the start of the season",
+	type=parse_date, default=None)
+parser.add_argument("--end", help="last day (YYYY-MM-DD), default the end of the season or two days ago",
+	type=parse_date, default=None)
+parser.add_argument("--table", help="also save the game table to this .npz file",
+	type=str, default=None)
+
+# default hyperparameters of each model (see backtest.py for tuning them)
+HYPERPARAMETERS = {
+	'elo': {'a': 0.0025, 'b': 0.152, 'k': 4},
+	'bayesian': {'a': 0.0025, 'b': 0.152, 'k': 4, 'var': 10}
+}
+
+# only regular season games are used for training, as in the pipeline
+REGULAR_SEASON = 'R'
 
 team_abbr_map = {
 	"ANA": 0,
@@ -62,119 +84,94 @@ team_abbr_map = {
 	"FLO": 22
 }
 
-team_name_abbr = {
-  'New York Yankees': 'NYY',
-  'Tampa Bay Rays': 'TBR',
-  'Toronto Blue Jays': 'TOR',
-  'Baltimore Orioles': 'BAL',
-  'Boston Red Sox': 'BOS',
-  'Chicago White Sox': 'CHW',
-  'Cleveland Guardians': 'CLE',
-  'Detroit Tigers': 'DET',
-  'Kansas City Royals': 'KCR',
-  'Minnesota Twins': 'MIN',
-  'Los Angeles Angels': 'LAA',
-  'Oakland Athletics': 'OAK',
-  'Seattle Mariners': 'SEA',
-  'Texas Rangers': 'TEX',
-  'Houston Astros': 'HOU',
-  'Atlanta Braves': 'ATL',
-  'New York Mets': 'NYM',
-  'Philadelphia Phillies': 'PHI',
-  'Miami Marlins': 'MIA',
-  'Washington Nationals': 'WSN',
-  'Chicago Cubs': 'CHC',
-  'Milwaukee Brewers': 'MIL',
-  'St. Louis Cardinals': 'STL',
-  'Pittsburgh Pirates': 'PIT',
-  'Cincinnati Reds': 'CIN',
-  'Los Angeles Dodgers': 'LAD',
-  'Colorado Rockies': 'COL',
-  'Arizona Diamondbacks': 'ARI',
-  'San Francisco Giants': 'SFG',
-  'San Diego Padres': 'SDP'
-}
+def team_abbr(team: Dict) -> str:
+	"""Abbreviation of a statsapi team, by its id.
+
+	Raises ValueError for unknown teams, so that their games aren't
+	silently dropped.
+	"""
+	try:
+		return team_id_abbr[team['id']]
+	except KeyError:
+		raise ValueError(f"Unknown team: {team.get('name')} (id {team.get('id')})") from None
 
-def parse_game_results(game: Dict) -> Tuple[Dict, int]:
-	"""Parse data from MLB statsapi.
+def parse_schedule_table(dates: List[Dict]) -> GameTable:
+	"""Parse played games from the 'dates' of a statsAPI schedule into a GameTable.
 
-	Returns:
-	--------
-	parsed_game: selected fields from statsAPI data
-	result: 1 if home team won, 0 if home team lost, None if game was not played
+	Team indices are given by team_abbr_map.
 	"""
-	home_name = game['teams']['home']['team']['name']
-	visitor_name = game['teams']['away']['team']['name']
-	if (home_name in team_name_abbr) and (visitor_name in team_name_abbr):
-		parsed_game = {
-			'home': team_name_abbr[home_name],
-			'visitor': team_name_abbr[visitor_name],
-			'date': game['officialDate']
-		}
-	else:
-		parsed_game = None
-
-	if 'isWinner' in game['teams']['home']:
-		result = int(game['teams']['home']['isWinner'])
-	else:
-		result = None
-	return parsed_game, result
-
-def get_game_results(day: date) -> Tuple[List[Dict], List[int]]:
-	"""Get game results for given day from MLB statsAPI."""
-	url = "https://statsapi.mlb.com/api/v1/schedule?language=en&sportId=1&date="
-	url += day.strftime("%m/%d/%Y")
-
-	response = urllib.request.urlopen(url)
-
-	data = json.loads(response.read())
-
-	games = []
-	results = []
-	for game in data['dates'][0]['games']:
-		parsed_game, result = parse_game_results(game)
-		if (parsed_game is not None) and (result is not None):
-			games.append(parsed_game)
-			results.append(result)
-
-	return games, results
+	home, visitor, day, result = [], [], [], []
+	for d in dates:
+		for game in d['games']:
+			if game.get('gameType', REGULAR_SEASON) != REGULAR_SEASON:
+				continue
+			teams = game['teams']
+			if 'isWinner' not in teams['home']:
+				continue
+			h = team_abbr(teams['home']['team'])
+			v = team_abbr(teams['away']['team'])
+			home.append(team_abbr_map[h])
+			visitor.append(team_abbr_map[v])
+			day.append(game['officialDate'])
+			result.append(int(teams['home']['isWinner']))
+
+	return GameTable(home, visitor, day, result)
+
+def initial_params(model_name: str, hyperparameters: Dict=None, day: date=None) -> Dict:
+	"""Parameters of an untrained model.
+
+	Args:
+	-----
+	model_name: 'elo' or 'bayesian'.
+	hyperparameters (optional): values overriding HYPERPARAMETERS. For the
+		bayesian model, 'var' is the initial rating variance.
+	day (optional): the 'date' of the parameters: the last day trained
+		on. /train skips games on or before it. Default none (untrained).
+	"""
+	h = dict(HYPERPARAMETERS[model_name], **(hyperparameters or {}))
+	params = {
+		'a': h['a'],
+		'b': h['b'],
+		'k': h['k'],
+		'map': team_abbr_map
+	}
+	if day is not None:
+		params['date'] = str(day)
+	if model_name == 'elo':
+		params['rating'] = 30 * [0]
+	elif model_name == 'bayesian':
+		params['mu'] = 30 * [0]
+		params['var'] = 30 * [h['var']]
+	return params
+
+def get_game_table(start_date: date, end_date: date) -> GameTable:
+	"""Get all games played in a date range (inclusive) from MLB statsAPI.
+
+	The range is fetched with a few range requests (see
+	StatsAPIClient.schedule_range), not one request per day, so whole
+	seasons can be ingested at once.
+	"""
+	return parse_schedule_table(get_client().schedule_range(start_date, end_date))
 
 if __name__ == '__main__':
 
 	args = parser.parse_args()
-  
-	if args.model == 'elo':
-		# initialize the elo model
-		params = {
-			'rating': 30 * [0],
-			'a': 0.0025,
-			'b': 0.152,
-			'k': 4,
-			'map': team_abbr_map,
-			"date": "2022-07-17"
-		}
-		model = ELO(params)
-	elif args.model == 'bayesian':
-		# initialize the elo model
-		params = {
-			'mu': 30 * [0],
-			'var': 30 * [10],
-			'a': 0.0025,
-			'b': 0.152,
-			'k': 4,
-			'map': team_abbr_map,
-			"date": "2022-07-17"
-		}
-		model = BayesianLogisticRegressionWithADF(params)
-
-	# start and end dates
-	day = datetime(2022, 4, 7).date()
-	end_date = date.today() - timedelta(days=2)
-
-	# train the model
-	while day <= end_date:
-		games, results = get_game_results(day)
-		model.train(games, results)
-		day += timedelta(days=1)
-
-	pickle.dump(params, open('params.pkl', 'wb'))
+
+	# default to the whole season, up to two days ago
+	if (args.start is None) or (args.end is None):
+		season_start, season_end = get_client().season_dates(args.season)
+		args.start = args.start or season_start
+		args.end = args.end or min(season_end, date.today() - timedelta(days=2))
+
+	model = MODELS[args.model](initial_params(args.model, day=args.end))
+
+	# fetch all games in the date range, then train on them in order
+	table = get_game_table(args.start, args.end)
+	print(f"Training on {len(table)} games from {args.start} to {args.end}")
+	if args.table:
+		table.save(args.table)
+	model.train_batch(table.home, table.visitor, table.result, table.day,
+	                  rng=np.random.default_rng(42))
+
+	with open('params.bin', 'wb') as f:
+		f.write(model.params.to_bytes())